@@ -0,0 +1,224 @@
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+
+import fake_motion
+import hass_stub
+
+hass_stub.install()
+
+import motioneye
+
+##################################################
+# MotionEye load benchmark
+#
+# Runs MotionEye apps for N simulated cameras, spread over H fake motion hosts ( fake_motion.FakeMotion ), inside the
+# hass_stub AppDaemon stand-in and drives them through the user facing paths:
+#
+#   initialize      : app start up, until every bound entity is seeded
+#   slider storm    : a brightness slider dragged through `steps` values on every camera
+#   prop event      : one motion_prop_changed event per camera setting three properties
+#   snapshot ALL    : one motion_snapshot event for entity_id ALL
+#
+# For each scenario it reports webcontrol requests per user action, p50/p99 of the server side request time, p50/p99
+# of the app callback time ( from dispatch, so it includes waiting for the app's thread ) and the wall time until
+# everything has settled.  It then breaks the whole run down per webcontrol endpoint from the clients' own metrics.
+#
+#   python benchmarks/bench_motioneye.py --cameras 12 --hosts 3 --latency 0.01
+#   python benchmarks/bench_motioneye.py --app async --mode slow
+#   python benchmarks/bench_motioneye.py --app fleet
+##################################################
+
+APPS = { "sync" : motioneye.MotionEye, "async" : motioneye.MotionEyeAsync }
+
+
+def percentile( values, pct ):
+  if not values: return 0.0
+  ordered = sorted( values )
+  return ordered[ min( len( ordered ) - 1, int( round( pct / 100.0 * ( len( ordered ) - 1 ) ) ) ) ]
+
+class Bench( object ):
+
+  def __init__( self, opts ):
+    self.opts    = opts
+    self.hub     = hass_stub.Hub( threads = opts.threads )
+    self.servers = [ fake_motion.FakeMotion( cameras = opts.cameras, latency = opts.latency, jitter = opts.jitter,
+                                             error_rate = opts.error_rate, mode = opts.mode, slow_latency = opts.slow_latency ).start()
+                     for h in range( opts.hosts ) ]
+    self.apps    = []
+    self.fleet   = None
+    self.tasks   = []                                         # futures the fleet handed to its pool
+    self.rows    = []
+
+  def camera_args( self, index ):
+    server = self.servers[ index % len( self.servers ) ]
+    name   = "cam{}".format( index )
+    args   = { "URL"               : server.url( index // len( self.servers ) + 1 ),
+               "entity_id"         : "camera." + name,
+               "brightness_entity" : "input_number.{}_brightness".format( name ),
+               "contrast_entity"   : "input_number.{}_contrast".format( name ),
+               "hue_entity"        : "input_number.{}_hue".format( name ),
+               "saturation_entity" : "input_number.{}_saturation".format( name ),
+               "threshold_entity"  : "input_number.{}_threshold".format( name ),
+               "detection_entity"  : "input_boolean.{}_detection".format( name ),
+               "timeout"           : self.opts.timeout }
+    return name, args
+
+  def seed_entities( self, args ):
+    # The apps validate their bindings against the HASS state, so the bound entities have to exist
+    for key, entity in args.items():
+      if key.endswith( "_entity" ) and entity not in self.hub.states:
+        self.hub.states[ entity ] = { "state" : "on" if entity.startswith( "input_boolean." ) else 0, "attributes" : {} }
+
+  #########################################################
+  def measure( self, label, actions, run ):
+    for server in self.servers: server.reset()
+    mark  = len( self.hub.durations )
+    start = time.perf_counter()
+    run()
+    settled = self.settle( time.monotonic() + self.opts.settle_timeout )
+    wall    = time.perf_counter() - start
+
+    requests  = sum( server.total() for server in self.servers )
+    latencies = [ l for server in self.servers for l in server.latencies ]
+    callbacks = [ d for name, d in self.hub.durations[ mark: ] ]
+    self.rows.append( ( label, actions, requests, latencies, callbacks, wall, settled ) )
+
+  def settle( self, deadline ):
+    # The fleet's callbacks return as soon as they have queued their work on its pool, so wait for that work as well,
+    # and for whatever callbacks it set off, until both are done
+    while True:
+      if not self.hub.wait_idle( timeout = max( 0, deadline - time.monotonic() ) ): return False
+      tasks, self.tasks = self.tasks, []
+      if not tasks: return True
+      done, waiting = concurrent.futures.wait( tasks, timeout = max( 0, deadline - time.monotonic() ) )
+      if waiting: return False
+
+  def track_fleet( self ):
+    submit = self.fleet.pool.submit
+    def tracked( *args, **kwargs ):
+      future = submit( *args, **kwargs )
+      self.tasks.append( future )
+      return future
+    self.fleet.pool.submit = tracked
+
+  def scenario_initialize( self ):
+    def run():
+      for index in range( self.opts.cameras ):
+        name, args = self.camera_args( index )
+        self.seed_entities( args )
+        self.apps.append( self.hub.create( APPS.get( self.opts.app, motioneye.MotionEye ), name, args ) )
+      if self.opts.app == "fleet":
+        # The fleet takes over the events;  the per camera apps only keep their slider bindings
+        for app in self.apps: self.hub.unlisten_events( app )
+        cameras    = { app.args[ "entity_id" ] : app.args[ "URL" ] for app in self.apps }
+        self.fleet = self.hub.create( motioneye.MotionEyeFleet, "fleet", { "cameras" : cameras } )
+        self.track_fleet()
+    self.measure( "initialize", self.opts.cameras, run )
+
+  def scenario_slider_storm( self ):
+    steps = self.opts.steps
+    def run():
+      for step in range( steps ):
+        for app in self.apps:
+          self.hub.set_state( app.args[ "brightness_entity" ], 10 + step * 80.0 / steps )
+        time.sleep( self.opts.drag_time / steps )
+    self.measure( "slider storm ( per drag )", len( self.apps ), run )
+
+  def scenario_prop_event( self ):
+    def run():
+      for app in self.apps:
+        self.hub.fire_event( "motion_prop_changed", entity_id = app.args[ "entity_id" ], brightness = 90, contrast = 70, threshold = 2000 )
+    self.measure( "prop event", len( self.apps ), run )
+
+  def scenario_snapshot_all( self ):
+    self.measure( "snapshot ALL", 1, lambda : self.hub.fire_event( "motion_snapshot", entity_id = "ALL" ) )
+
+  #########################################################
+  def run( self ):
+    self.scenario_initialize()
+    self.scenario_slider_storm()
+    self.scenario_prop_event()
+    self.scenario_snapshot_all()
+    self.report()
+
+  def report( self ):
+    o = self.opts
+    print( "{} app, {} cameras on {} hosts, latency {}ms +{}ms, error rate {}, mode {}".format(
+           o.app, o.cameras, o.hosts, o.latency * 1000, o.jitter * 1000, o.error_rate, o.mode ) )
+    print( "{:<26} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+           "scenario", "actions", "req", "req/act", "srv p50", "srv p99", "cb p50", "cb p99", "wall" ) )
+    for label, actions, requests, latencies, callbacks, wall, settled in self.rows:
+      print( "{:<26} {:>8} {:>9} {:>9.2f} {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>8.2f}s{}".format(
+             label, actions, requests, requests / float( actions or 1 ),
+             percentile( latencies, 50 ) * 1000, percentile( latencies, 99 ) * 1000,
+             percentile( callbacks, 50 ) * 1000, percentile( callbacks, 99 ) * 1000,
+             wall, "" if settled else "  ( did not settle )" ) )
+    self.report_endpoints()
+
+  def report_endpoints( self ):
+    clients = { id( app.client ) : app.client for app in self.apps if getattr( app, "client", None ) }
+    if self.fleet:
+      clients.update( { id( camera.client ) : camera.client for camera in self.fleet.cameras.values() } )
+
+    totals = {}
+    for client in clients.values():
+      for ( camera, endpoint ), stats in client.metrics.snapshot().items():
+        total = totals.setdefault( endpoint, [ 0, 0, 0, 0, 0.0, 0.0 ] )
+        total[0] += stats[ "calls" ]
+        total[1] += stats[ "errors" ]
+        total[2] += stats[ "timeouts" ]
+        total[3] += stats[ "rejected" ]
+        total[4] += stats[ "mean" ] * stats[ "calls" ]
+        total[5]  = max( total[5], stats[ "p99" ] )
+
+    print( "" )
+    print( "{:<26} {:>8} {:>9} {:>9} {:>9}".format( "host queue ( whole run )", "queued", "dedup", "max", "wait" ) )
+    for client in clients.values():
+      stats = client.queue.stats
+      print( "{:<26} {:>8} {:>9} {:>9} {:>7.1f}ms".format( "{}:{}".format( client.host, client.port ), stats[ "queued" ], stats[ "deduplicated" ],
+             stats[ "max_depth" ], stats[ "waited" ] / ( stats[ "queued" ] or 1 ) * 1000 ) )
+
+    print( "" )
+    print( "{:<26} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format( "endpoint ( whole run )", "calls", "errors", "timeouts", "rejected", "mean", "p99 <=" ) )
+    for endpoint in sorted( totals ):
+      calls, errors, timeouts, rejected, seconds, p99 = totals[ endpoint ]
+      print( "{:<26} {:>8} {:>9} {:>9} {:>9} {:>7.1f}ms {:>7.1f}ms".format(
+             endpoint, calls, errors, timeouts, rejected, seconds / ( calls or 1 ) * 1000, p99 * 1000 ) )
+
+  def close( self ):
+    for app in self.apps + ( [ self.fleet ] if self.fleet else [] ):
+      self.hub.terminate( app )
+    self.hub.close()
+    for server in self.servers: server.stop()
+
+
+def main( argv = None ):
+  parser = argparse.ArgumentParser( description = "MotionEye load benchmark against fake motion hosts" )
+  parser.add_argument( "--app",            default = "sync", choices = [ "sync", "async", "fleet" ] )
+  parser.add_argument( "--cameras",        type = int,   default = 8 )
+  parser.add_argument( "--hosts",          type = int,   default = 2 )
+  parser.add_argument( "--threads",        type = int,   default = 10,    help = "AppDaemon worker threads" )
+  parser.add_argument( "--latency",        type = float, default = 0.005, help = "seconds per request" )
+  parser.add_argument( "--jitter",         type = float, default = 0.0 )
+  parser.add_argument( "--error-rate",     type = float, default = 0.0 )
+  parser.add_argument( "--mode",           default = "ok", choices = [ "ok", "slow", "dead" ] )
+  parser.add_argument( "--slow-latency",   type = float, default = 2.0 )
+  parser.add_argument( "--timeout",        type = float, default = 1.0,   help = "MotionEye request timeout" )
+  parser.add_argument( "--steps",          type = int,   default = 40,    help = "slider values per drag" )
+  parser.add_argument( "--drag-time",      type = float, default = 1.0,   help = "seconds a drag lasts" )
+  parser.add_argument( "--settle-timeout", type = float, default = 60.0 )
+  opts = parser.parse_args( argv )
+
+  bench = Bench( opts )
+  try:
+    bench.run()
+  finally:
+    bench.close()
+
+if __name__ == "__main__":
+  main()
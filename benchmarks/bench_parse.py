@@ -0,0 +1,56 @@
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+
+import motion_parse
+
+##################################################
+# Micro-benchmark for motion_parse
+#
+# Measures the cost of parsing each captured webcontrol response in payloads/, for both output modes, and compares it
+# with the per-call regex scrape MotionEye used before ( a fresh pattern built for every get_property ).
+#
+#   python benchmarks/bench_parse.py [ iterations ]
+##################################################
+
+PAYLOADS = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "payloads" )
+IMAGE    = [ 'brightness', 'contrast', 'hue', 'saturation', 'threshold' ]
+
+def load( name ):
+  with open( os.path.join( PAYLOADS, name ) ) as f:
+    return f.read()
+
+def legacy_property( html, prop_name ):
+  return re.findall( '{}\\s=\\s([\\d]+)'.format( prop_name ), html )[0]
+
+def legacy_status( html ):
+  return re.findall( 'Detection\\sstatus\\s([\\w]+)', html )[0] == 'ACTIVE'
+
+def report( label, func, iterations ):
+  try:
+    func()
+  except ( IndexError, KeyError, ValueError ):
+    print( "{:<46} {:>13}".format( label, "fails" ) )
+    return
+  per_call = min( timeit.repeat( func, number = iterations, repeat = 5 ) ) / iterations
+  print( "{:<46} {:>10.2f} us".format( label, per_call * 1e6 ) )
+
+def main( iterations ):
+  for mode in ( "txt", "html" ):
+    listing = load( "config_list." + mode )
+    single  = load( "config_get."  + mode )
+    status  = load( "detection_status." + mode )
+
+    print( "--- {} output ( config/list {} bytes, {} settings )".format( mode, len( listing ), len( motion_parse.parse_config( listing ) ) ) )
+    report( "config/get   parse_property",            lambda : motion_parse.parse_property( single, 'brightness' ), iterations )
+    report( "config/get   legacy regex",              lambda : legacy_property( single, 'brightness' ),             iterations )
+    report( "config/list  parse_config ( all )",      lambda : motion_parse.parse_config( listing ),                iterations )
+    report( "config/list  legacy regex ( 5 props )",  lambda : [ legacy_property( listing, p ) for p in IMAGE ],    iterations )
+    report( "detection/status  parse_detection_status", lambda : motion_parse.parse_detection_status( status ), iterations )
+    report( "detection/status  legacy regex",           lambda : legacy_status( status ),                       iterations )
+
+if __name__ == "__main__":
+  main( int( sys.argv[1] ) if len( sys.argv ) > 1 else 2000 )
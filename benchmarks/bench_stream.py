@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+
+import fake_motion
+import motion_stream
+
+##################################################
+# Stream monitor benchmark
+#
+# Watches N MJPEG streams from fake_motion.FakeStream with motion_stream.StreamMonitor and reports the CPU time the
+# shared monitor thread used per camera, the frame rate the monitors measured, and how long they took to notice a
+# stall and a recovery.
+#
+#   python benchmarks/bench_stream.py --cameras 30 --fps 15 --frame-size 60000
+##################################################
+
+async def thread_cpu():
+  return time.thread_time()
+
+def monitor_cpu():
+  # CPU seconds used by the monitor thread so far ( read on that thread )
+  return asyncio.run_coroutine_threadsafe( thread_cpu(), motion_stream._monitor_loop() ).result()
+
+def wait_for( condition, timeout ):
+  start = time.perf_counter()
+  while not condition() and time.perf_counter() - start < timeout:
+    time.sleep( 0.01 )
+  return time.perf_counter() - start
+
+
+def main( argv = None ):
+  parser = argparse.ArgumentParser( description = "StreamMonitor CPU cost and stall detection" )
+  parser.add_argument( "--cameras",       type = int,   default = 24 )
+  parser.add_argument( "--fps",           type = float, default = 15 )
+  parser.add_argument( "--frame-size",    type = int,   default = 50000, help = "bytes per frame" )
+  parser.add_argument( "--duration",      type = float, default = 5.0,   help = "seconds to measure" )
+  parser.add_argument( "--stall-timeout", type = float, default = 1.0 )
+  opts = parser.parse_args( argv )
+
+  stream   = fake_motion.FakeStream( fps = opts.fps, frame_size = opts.frame_size ).start()
+  changes  = []
+  monitors = [ motion_stream.StreamMonitor( stream.url( i + 1 ), opts.stall_timeout, changes.append ).start()
+               for i in range( opts.cameras ) ]
+  try:
+    wait_for( lambda : all( m.counter.count for m in monitors ), 10 )
+    for m in monitors: m.sample()
+
+    cpu, start = monitor_cpu(), time.perf_counter()
+    time.sleep( opts.duration )
+    cpu, wall = monitor_cpu() - cpu, time.perf_counter() - start
+    samples   = [ m.sample() for m in monitors ]
+
+    fps = sum( s[ "fps" ] for s in samples ) / len( samples )
+    mb  = sum( s[ "bytes" ] for s in samples ) / 1e6
+    print( "{} cameras at {} fps, {} byte frames".format( opts.cameras, opts.fps, opts.frame_size ) )
+    print( "measured fps per camera   {:8.2f}".format( fps ) )
+    print( "monitor thread cpu        {:8.1f} %   ( {:.2f} % per camera )".format( cpu / wall * 100, cpu / wall * 100 / opts.cameras ) )
+    print( "cpu per frame             {:8.1f} us".format( cpu / max( 1, fps * wall * opts.cameras ) * 1e6 ) )
+    print( "stream data read          {:8.1f} MB total".format( mb ) )
+
+    stream.stalled = True
+    took = wait_for( lambda : all( m.stalled for m in monitors ), opts.stall_timeout * 5 + 10 )
+    print( "stall noticed after       {:8.2f} s    ( stall_timeout {} s )".format( took, opts.stall_timeout ) )
+    stream.stalled = False
+    took = wait_for( lambda : not any( m.stalled for m in monitors ), 120 )
+    print( "recovery noticed after    {:8.2f} s    ( includes reconnect backoff )".format( took ) )
+  finally:
+    for m in monitors: m.stop()
+    stream.stop()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,163 @@
+import argparse
+import bisect
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), ".." ) )
+
+import hass_stub
+
+hass_stub.install()
+
+import sunrise_alarm
+import sunrise_fade
+
+##################################################
+# SunriseAlarm simulation benchmark
+#
+# Runs one SunriseAlarm app hosting `alarms` alarms of `lights` lights each, for `days` days, on hass_stub's virtual
+# clock.  Alarm times are staggered a quarter of an hour apart, so fades overlap.  A whole run takes well under a second.
+# Each light is modelled as a bulb that ramps linearly from wherever it is to each level it is sent, over the transition it
+# is sent with.  `smooth` is the share of each room's lights that support transitions.  The rest are stepped.  The lights
+# are switched off again at noon each day.  The run reports:
+#
+#   calls       : light service calls, and what the old once a minute per light engine would have made
+#   wakeups     : timer callbacks fired
+#   curve error : worst and mean distance of the lights from the ideal perceptual curve, in perceived brightness ( 0 - 1 ),
+#                 sampled every `sample` seconds
+#   end drift   : how far from the alarm time the lights reached full, worst over every fade
+#
+#   python benchmarks/bench_sunrise.py --alarms 10 --lights 6
+#   python benchmarks/bench_sunrise.py --smooth 0.5 --jitter 30
+##################################################
+
+START = datetime.datetime( 2026, 1, 5, 0, 0 )          # a Monday
+
+
+class Bench( object ):
+
+  def __init__( self, opts ):
+    self.opts = opts
+    self.hub  = hass_stub.Hub( start = START, jitter = opts.jitter )
+    self.app  = None
+
+  def setup( self ):
+    o      = self.opts
+    alarms = {}
+    smooth = int( round( o.smooth * o.lights ) )
+    self.hub.states[ "input_number.pre_trip" ] = { "state" : str( o.pre_trip ), "attributes" : {} }
+    for a in range( o.alarms ):
+      ring   = datetime.datetime.combine( START.date(), datetime.time( 6 ) ) + datetime.timedelta( minutes = 15 * ( a % 4 ) )
+      entity = "input_datetime.alarm{}".format( a )
+      lights = [ "light.room{}_{}".format( a, l ) for l in range( o.lights ) ]
+      self.hub.states[ entity ] = { "state" : ring.strftime( "%H:%M:%S" ), "attributes" : {} }
+      for l, light in enumerate( lights ):
+        self.hub.states[ light ] = { "state" : "off", "attributes" : { "supported_features" : sunrise_fade.SUPPORT_TRANSITION if l < smooth else 0 } }
+      alarms[ "room{}".format( a ) ] = { "time_entity" : entity, "lights" : lights }
+
+    self.app = self.hub.create( sunrise_alarm.SunriseAlarm, "sunrise", { "alarms" : alarms, "pre_trip" : "input_number.pre_trip",
+                                                                         "max_transition" : o.max_transition } )
+
+  def run( self ):
+    start = time.perf_counter()
+    self.setup()
+    for day in range( self.opts.days ):
+      noon = START + datetime.timedelta( days = day, hours = 12 )
+      self.hub.advance( until = noon )
+      for alarm in self.app.alarms.values():
+        for light in alarm.lights:
+          self.hub.set_state( light, "off", dict( self.hub.states[ light ][ "attributes" ], brightness = None ) )
+    self.wall = time.perf_counter() - start
+    self.report()
+
+  #########################################################
+  def commands( self ):
+    # light -> [ ( time, level, transition ) ] sent to it
+    sent = {}
+    for when, service, kwargs in self.hub.services:
+      if service != "light/turn_on": continue
+      entities = kwargs[ "entity_id" ] if isinstance( kwargs[ "entity_id" ], list ) else [ kwargs[ "entity_id" ] ]
+      for light in entities:
+        sent.setdefault( light, [] ).append( ( when, kwargs[ "brightness" ], kwargs.get( "transition", 0 ) ) )
+    return sent
+
+  def trajectory( self, commands ):
+    # Returns level( t ) for a bulb given these commands, starting from off
+    ramps, level = [], 0.0
+    for when, target, transition in commands:
+      if ramps:
+        level = self.ramp_level( ramps[-1], when )
+      ramps.append( ( when, level, target, transition ) )
+    times = [ ramp[0] for ramp in ramps ]
+
+    def level_at( t ):
+      i = bisect.bisect_right( times, t ) - 1
+      return 0.0 if i < 0 else self.ramp_level( ramps[ i ], t )
+    return level_at
+
+  def ramp_level( self, ramp, t ):
+    when, start, target, transition = ramp
+    if not transition: return float( target )
+    done = min( 1.0, max( 0.0, ( t - when ).total_seconds() / transition ) )
+    return start + ( target - start ) * done
+
+  def fades( self, alarm ):
+    # ( start, end ) of every fade the alarm ran
+    for day in range( self.opts.days + 1 ):
+      end = datetime.datetime.combine( START.date() + datetime.timedelta( days = day ), alarm.time )
+      if end <= START + datetime.timedelta( days = self.opts.days ) and end - alarm.pre_trip > START and alarm.rings_on( end.date() ):
+        yield end - alarm.pre_trip, end
+
+  def report( self ):
+    o        = self.opts
+    sent     = self.commands()
+    calls    = sum( 1 for when, service, kwargs in self.hub.services if service == "light/turn_on" )
+    errors   = []
+    drift    = 0.0
+    fades    = 0
+    legacy   = 0
+    for alarm in self.app.alarms.values():
+      for start, end in self.fades( alarm ):
+        fades   += 1
+        duration = ( end - start ).total_seconds()
+        legacy  += len( alarm.lights ) * int( duration / 60 )
+        for light in alarm.lights:
+          commands = [ c for c in sent.get( light, [] ) if start <= c[0] <= end + datetime.timedelta( hours = 1 ) ]
+          level    = self.trajectory( commands )
+          t        = 0.0
+          while t <= duration:
+            ideal = sunrise_fade.level_at( 0, sunrise_fade.FULL, t / duration )
+            errors.append( abs( sunrise_fade.perceived( level( start + datetime.timedelta( seconds = t ) ) ) - sunrise_fade.perceived( ideal ) ) )
+            t += o.sample
+          full = [ c[0] + datetime.timedelta( seconds = c[2] ) for c in commands if c[1] >= sunrise_fade.FULL ]
+          if full: drift = max( drift, abs( ( full[0] - end ).total_seconds() ) )
+          else:    drift = float( "inf" )
+
+    print( "{} alarms x {} lights ( {:.0%} smooth ), {} days, {} minute fades, timer jitter {}s".format(
+           o.alarms, o.lights, o.smooth, o.days, o.pre_trip, o.jitter ) )
+    print( "{:<14} {:>10}".format( "fades", fades ) )
+    print( "{:<14} {:>10}   ( {} with the once a minute engine )".format( "calls", calls, legacy ) )
+    print( "{:<14} {:>10}".format( "wakeups", self.hub.wakeups ) )
+    print( "{:<14} {:>10.3f}   ( mean {:.4f} )".format( "curve error", max( errors or [ 0 ] ), sum( errors ) / ( len( errors ) or 1 ) ) )
+    print( "{:<14} {:>9.1f}s".format( "end drift", drift ) )
+    print( "{:<14} {:>8.0f}ms".format( "run time", self.wall * 1000 ) )
+
+
+def main( argv = None ):
+  parser = argparse.ArgumentParser( description = "SunriseAlarm simulation on a virtual clock" )
+  parser.add_argument( "--alarms",         type = int,   default = 4 )
+  parser.add_argument( "--lights",         type = int,   default = 6,    help = "lights per alarm" )
+  parser.add_argument( "--smooth",         type = float, default = 1.0,  help = "share of lights that support transitions" )
+  parser.add_argument( "--days",           type = int,   default = 7 )
+  parser.add_argument( "--pre-trip",       type = float, default = 30,   help = "fade minutes" )
+  parser.add_argument( "--max-transition", type = float, default = sunrise_fade.MAX_TRANSITION )
+  parser.add_argument( "--jitter",         type = float, default = 0.0,  help = "seconds a timer may fire late" )
+  parser.add_argument( "--sample",         type = float, default = 10.0, help = "seconds between curve error samples" )
+  opts = parser.parse_args( argv )
+
+  Bench( opts ).run()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,221 @@
+import collections
+import http.server
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+##################################################
+# Fake motion webcontrol server
+#
+# A local stand-in for one motion daemon's webcontrol port.  It serves config/list, config/get, config/set,
+# detection/status|start|pause and action/snapshot for `cameras` threads ( plus thread 0 for all of them ), over
+# HTTP/1.1 keep-alive, in html or text output mode.
+#
+#  latency    : seconds added to every request ( plus up to `jitter` more )
+#  error_rate : fraction of requests answered with HTTP 500
+#  mode       : "ok"    normal service
+#               "slow"  every request takes slow_latency seconds
+#               "dead"  connections are accepted but never answered
+#  serial     : handle one request at a time, as motion's webcontrol does [ default = True ]
+#
+# Every request is counted per endpoint in server.counts, and its service time ( including the wait for the serial
+# lock ) recorded in server.latencies.
+#
+#   server = FakeMotion( cameras = 4, latency = 0.005 ).start()
+#   url    = server.url( 1 )                                  # http://127.0.0.1:<port>/1/
+#
+# FakeStream stands in for a camera's stream_port:  a multipart/x-mixed-replace MJPEG stream of random `frame_size` byte
+# frames at `fps`, to every client that connects.  Setting stream.stalled holds the frames back while keeping the
+# connections open, as a frozen camera does.
+##################################################
+
+DEFAULT_CONFIG = { "brightness" : 128, "contrast" : 64, "hue" : 10, "saturation" : 96, "threshold" : 1500,
+                   "stream_port" : 0, "framerate" : 15, "text_left" : "CAMERA", "emulate_motion" : "off" }
+
+
+class FakeMotion( object ):
+
+  def __init__( self, cameras = 1, latency = 0.0, jitter = 0.0, error_rate = 0.0, mode = "ok", slow_latency = 10.0,
+                html = True, serial = True, host = "127.0.0.1", port = 0 ):
+    self.latency      = latency
+    self.jitter       = jitter
+    self.error_rate   = error_rate
+    self.mode         = mode
+    self.slow_latency = slow_latency
+    self.html         = html
+    self.serial       = serial
+
+    self.config    = { thread : dict( DEFAULT_CONFIG ) for thread in range( 1, cameras + 1 ) }
+    self.detection = { thread : True for thread in range( 1, cameras + 1 ) }
+    self.counts    = collections.Counter()
+    self.latencies = []
+    self.lock      = threading.Lock()                         # protects the counters
+    self.busy      = threading.Lock()                         # serialises requests when serial is set
+    self.stopping  = threading.Event()
+
+    self.server = http.server.ThreadingHTTPServer( ( host, port ), self.handler_class() )
+    self.server.daemon_threads = True
+
+  def start( self ):
+    threading.Thread( target = self.server.serve_forever, daemon = True ).start()
+    return self
+
+  def stop( self ):
+    self.stopping.set()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def url( self, thread ):
+    return "http://{}:{}/{}/".format( self.server.server_address[0], self.server.server_address[1], thread )
+
+  def total( self ):
+    with self.lock:
+      return sum( self.counts.values() )
+
+  def reset( self ):
+    with self.lock:
+      self.counts.clear()
+      self.latencies = []
+
+  #########################################################
+  def handler_class( self ):
+    fake = self
+
+    class Handler( http.server.BaseHTTPRequestHandler ):
+      protocol_version = "HTTP/1.1"
+
+      def do_GET( self ):
+        start = time.perf_counter()
+        if fake.mode == "dead":
+          fake.stopping.wait()
+          return
+
+        if fake.serial: fake.busy.acquire()
+        try:
+          delay = fake.slow_latency if fake.mode == "slow" else fake.latency + random.uniform( 0, fake.jitter )
+          if delay: time.sleep( delay )
+          status, body, kind = fake.answer( self.path )
+        finally:
+          if fake.serial: fake.busy.release()
+
+        with fake.lock:
+          fake.counts[ kind ] += 1
+          fake.latencies.append( time.perf_counter() - start )
+
+        data = body.encode( 'utf-8' )
+        self.send_response( status )
+        self.send_header( "Content-Type", "text/html" if fake.html else "text/plain" )
+        self.send_header( "Content-Length", str( len( data ) ) )
+        self.end_headers()
+        self.wfile.write( data )
+
+      def log_message( self, *args ):
+        pass
+
+    return Handler
+
+  def answer( self, path ):
+    # Returns ( status, body, endpoint kind )
+    parts  = urllib.parse.urlsplit( path )
+    pieces = parts.path.strip( "/" ).split( "/" )
+    if len( pieces ) < 3 or not pieces[0].isdigit():
+      return 404, "not found", "invalid"
+
+    thread  = int( pieces[0] )
+    kind    = "/".join( pieces[1:3] )
+    threads = list( self.config ) if thread == 0 else [ thread ]
+    if thread and thread not in self.config:
+      return 404, "no such camera", kind
+
+    if self.error_rate and random.random() < self.error_rate:
+      return 500, "internal error", kind
+
+    if kind == "config/list":
+      return 200, self.render( thread, self.config[ threads[0] ] ), kind
+
+    if kind == "config/get":
+      name = urllib.parse.parse_qs( parts.query ).get( "query", [ "" ] )[0]
+      if name not in self.config[ threads[0] ]: return 200, self.render( thread, {} ), kind
+      return 200, self.render( thread, { name : self.config[ threads[0] ][ name ] } ), kind
+
+    if kind == "config/set":
+      for name, value in urllib.parse.parse_qsl( parts.query, keep_blank_values = True ):
+        for t in threads: self.config[ t ][ name ] = value
+      return 200, self.render( thread, dict( urllib.parse.parse_qsl( parts.query ) ) ) + "\nDone", kind
+
+    if kind in ( "detection/start", "detection/pause" ):
+      for t in threads: self.detection[ t ] = kind == "detection/start"
+      return 200, "Camera {} Detection {}\nDone".format( thread, "resumed" if kind == "detection/start" else "paused" ), kind
+
+    if kind == "detection/status":
+      return 200, "Camera {} Detection status {}\n".format( thread, "ACTIVE" if self.detection[ threads[0] ] else "PAUSE" ), kind
+
+    if kind == "action/snapshot":
+      return 200, "Snapshot for camera {}\nDone".format( thread ), kind
+
+    return 404, "not found", kind
+
+  def render( self, thread, values ):
+    if not self.html:
+      return "Camera {}\n".format( thread ) + "".join( "{} = {}\n".format( n, values[ n ] ) for n in values )
+    items = "".join( "<li>{} = {}</li>\n".format( n, values[ n ] ) for n in values )
+    return "<!DOCTYPE html>\n<html>\n<body>\n<b>Camera {}</b>\n<ul>\n{}</ul>\n</body>\n</html>\n".format( thread, items )
+
+
+##################################################
+class FakeStream( object ):
+
+  BOUNDARY = b"BoundaryString"
+
+  def __init__( self, fps = 15, frame_size = 50000, host = "127.0.0.1", port = 0 ):
+    self.fps      = fps
+    self.frame    = os.urandom( frame_size )
+    self.stalled  = False
+    self.clients  = 0
+    self.stopping = threading.Event()
+
+    self.server = http.server.ThreadingHTTPServer( ( host, port ), self.handler_class() )
+    self.server.daemon_threads = True
+
+  def start( self ):
+    threading.Thread( target = self.server.serve_forever, daemon = True ).start()
+    return self
+
+  def stop( self ):
+    self.stopping.set()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def url( self, camera = 1 ):
+    return "http://{}:{}/{}/".format( self.server.server_address[0], self.server.server_address[1], camera )
+
+  def handler_class( self ):
+    fake = self
+
+    class Handler( http.server.BaseHTTPRequestHandler ):
+
+      def do_GET( self ):
+        self.send_response( 200 )
+        self.send_header( "Content-Type", "multipart/x-mixed-replace; boundary=" + fake.BOUNDARY.decode( 'ascii' ) )
+        self.end_headers()
+
+        part = b"--" + fake.BOUNDARY + b"\r\nContent-Type: image/jpeg\r\nContent-Length: " + str( len( fake.frame ) ).encode( 'ascii' ) + \
+               b"\r\n\r\n" + fake.frame + b"\r\n"
+        fake.clients += 1
+        due = time.monotonic()
+        try:
+          while not fake.stopping.is_set():
+            due += 1.0 / fake.fps
+            if not fake.stalled: self.wfile.write( part )
+            time.sleep( max( 0, due - time.monotonic() ) )
+        except OSError:
+          pass
+        finally:
+          fake.clients -= 1
+
+      def log_message( self, *args ):
+        pass
+
+    return Handler
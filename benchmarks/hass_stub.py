@@ -0,0 +1,380 @@
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import heapq
+import random
+import sys
+import threading
+import time
+import types
+
+##################################################
+# Stand-in for AppDaemon's hass.Hass API
+#
+# Just enough of the AppDaemon 4 app API to run the apps in this repo outside of AppDaemon:  a state store, state and
+# event listeners, run_in / run_every / run_daily / cancel_timer, call_service recording ( input_boolean and light
+# turn_on / turn_off also set the state ) and log capture.  Callbacks are dispatched
+# the way AppDaemon does it:  plain functions on a fixed set of worker threads with each app pinned to one of them, so a
+# blocked callback holds up every app sharing its thread, and coroutine functions on a shared event loop.  Like
+# AppDaemon's sync_wrapper, API calls made from the event loop return an awaitable.
+#
+# install() registers the stub as appdaemon.plugins.hass.hassapi so app modules can be imported unchanged.
+#
+#   hub = hass_stub.Hub()
+#   app = hub.create( motioneye.MotionEye, "kitchen_camera", { "URL" : ... } )
+#   hub.set_state( "input_number.kitchen_brightness", 50 )      # fires the app's listen_state callbacks
+#   hub.wait_idle()
+#
+# With a start time the hub runs on a virtual clock instead:  timers go on a heap rather than real threads, every
+# callback runs inline on the caller's thread, and advance() jumps the clock forward firing the timers in order, so
+# hours of schedule run in milliseconds.  hub.wakeups counts the timer callbacks fired, and `jitter` makes each timer
+# fire up to that many seconds late.
+#
+#   hub = hass_stub.Hub( start = datetime.datetime( 2026, 1, 5, 6, 0 ) )
+#   app = hub.create( sunrise_alarm.SunriseAlarm, "sunrise", { ... } )
+#   hub.advance( 3600 )
+##################################################
+
+class Hub( object ):
+
+  def __init__( self, threads = 10, start = None, jitter = 0.0 ):
+    self.states    = {}                                       # entity_id -> { "state" : .., "attributes" : {} }
+    self.state_cbs = []                                       # ( app, callback, entity_id, kwargs )
+    self.event_cbs = []                                       # ( app, callback, event, filters )
+    self.services  = []                                       # ( time, service, kwargs )
+    self.logs      = []
+    self.timers    = {}                                       # handle -> threading.Timer
+    self.oneshots  = set()                                    # handles of pending run_in timers
+    self.lock      = threading.Lock()
+    self.next_id   = 0
+    self.busy      = 0                                        # callbacks queued or running, one shot timers pending
+    self.durations = []                                       # ( callback name, seconds from dispatch to completion )
+
+    self.virtual   = start is not None
+    self.now       = start                                    # virtual clock
+    self.jitter    = jitter
+    self.queue     = []                                       # virtual timers:  ( due, handle, app, callback, interval, kwargs )
+    self.wakeups   = 0
+
+    self.workers = [ concurrent.futures.ThreadPoolExecutor( max_workers = 1 ) for i in range( threads ) ]
+    self.apps    = 0
+    self.loop = asyncio.new_event_loop()
+    self.loop_thread = threading.Thread( target = self.loop.run_forever, daemon = True )
+    self.loop_thread.start()
+
+  def create( self, cls, name, args ):
+    app = cls( self, name, args )
+    app.worker = self.workers[ self.apps % len( self.workers ) ]        # pin the app to a thread, as AppDaemon does
+    self.apps += 1
+    self.run_sync( app, app.initialize )
+    return app
+
+  def terminate( self, app ):
+    self.run_sync( app, app.terminate )
+
+  def run_sync( self, app, func ):
+    if self.virtual and not asyncio.iscoroutinefunction( func ): return func()
+    if asyncio.iscoroutinefunction( func ):
+      return asyncio.run_coroutine_threadsafe( func(), self.loop ).result()
+    return app.worker.submit( func ).result()
+
+  def close( self ):
+    for timer in list( self.timers.values() ): timer.cancel()
+    for worker in self.workers: worker.shutdown( wait = False )
+    self.loop.call_soon_threadsafe( self.loop.stop )
+
+  def clock( self ):
+    return self.now if self.virtual else time.monotonic()
+
+  def today( self ):
+    return self.now if self.virtual else datetime.datetime.now()
+
+  #########################################################
+  def schedule( self, app, callback, due, interval, kwargs ):
+    # Virtual timers only
+    handle = self.handle()
+    if self.jitter: due += datetime.timedelta( seconds = random.uniform( 0, self.jitter ) )
+    with self.lock:
+      self.timers[ handle ] = due
+      heapq.heappush( self.queue, ( due, handle, app, callback, interval, kwargs ) )
+    return handle
+
+  def advance( self, seconds = None, until = None ):
+    # Moves the virtual clock on, firing every timer due on the way in order
+    until = until or self.now + datetime.timedelta( seconds = seconds )
+    while True:
+      with self.lock:
+        if not self.queue or self.queue[0][0] > until: break
+        due, handle, app, callback, interval, kwargs = heapq.heappop( self.queue )
+        if self.timers.get( handle ) != due: continue        # cancelled
+        if interval:
+          self.timers[ handle ] = due + interval
+          heapq.heappush( self.queue, ( due + interval, handle, app, callback, interval, kwargs ) )
+        else:
+          del self.timers[ handle ]
+      self.now      = max( self.now, due )
+      self.wakeups += 1
+      self.dispatch( app, callback, kwargs )
+    self.now = max( self.now, until )
+
+  #########################################################
+  def handle( self ):
+    with self.lock:
+      self.next_id += 1
+      return self.next_id
+
+  def dispatch( self, app, callback, *args ):
+    with self.lock:
+      self.busy += 1
+
+    name  = getattr( callback, "__name__", str( callback ) )
+    start = time.perf_counter()                               # includes the wait for the app's thread
+    if self.virtual and not asyncio.iscoroutinefunction( callback ):
+      try:
+        callback( *args )
+      finally:
+        self.finished( name, start )
+    elif asyncio.iscoroutinefunction( callback ):
+      async def run():
+        try:
+          await callback( *args )
+        finally:
+          self.finished( name, start )
+      asyncio.run_coroutine_threadsafe( run(), self.loop )
+    else:
+      def run():
+        try:
+          callback( *args )
+        finally:
+          self.finished( name, start )
+      app.worker.submit( run )
+
+  def finished( self, name, start ):
+    with self.lock:
+      self.durations.append( ( name, time.perf_counter() - start ) )
+      self.busy -= 1
+
+  def wait_idle( self, settle = 0.05, timeout = 60 ):
+    # Blocks until no callbacks are running and no one shot timers are pending
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+      with self.lock: busy = self.busy
+      if busy == 0:
+        time.sleep( settle )
+        with self.lock:
+          if self.busy == 0: return True
+      time.sleep( 0.005 )
+    return False
+
+  #########################################################
+  def set_state( self, entity_id, state, attributes = None ):
+    with self.lock:
+      old_entry = self.states.get( entity_id, {} )
+      new_entry = { "state" : state, "attributes" : attributes or {} }
+      self.states[ entity_id ] = new_entry
+      callbacks = [ entry for entry in self.state_cbs if entry[2] == entity_id ]
+
+    for app, callback, entity, kwargs in callbacks:
+      if kwargs.get( "attribute" ) == "all":
+        if old_entry != new_entry: self.dispatch( app, callback, entity_id, "all", old_entry or None, new_entry, kwargs )
+      elif old_entry.get( "state" ) != state:
+        self.dispatch( app, callback, entity_id, "state", old_entry.get( "state" ), state, kwargs )
+
+  def unlisten_events( self, app ):
+    with self.lock:
+      self.event_cbs = [ entry for entry in self.event_cbs if entry[0] is not app ]
+
+  def fire_event( self, event, **data ):
+    with self.lock:
+      callbacks = [ entry for entry in self.event_cbs if entry[2] == event ]
+
+    for app, callback, name, filters in callbacks:
+      if all( data.get( key ) == filters[ key ] for key in filters ):
+        self.dispatch( app, callback, event, data, {} )
+
+
+def _in_loop( app ):
+  # sync_wrapper only asks whether the calling thread runs an event loop, not which one.  A call made on any other loop
+  # would have its coroutine scheduled there, away from AppDaemon, so it is refused rather than run
+  try:
+    loop = asyncio.get_running_loop()
+  except RuntimeError:
+    return False
+  if loop is not app.hub.loop:
+    raise RuntimeError( "AppDaemon API called from a foreign event loop" )
+  return True
+
+def api( func ):
+  # AppDaemon's sync_wrapper:  awaitable when called from the event loop, a plain call everywhere else
+  @functools.wraps( func )
+  def wrapper( self, *args, **kwargs ):
+    in_loop = _in_loop( self )
+    result  = func( self, *args, **kwargs )
+    if in_loop:
+      future = self.hub.loop.create_future()
+      future.set_result( result )
+      return future
+    return result
+  return wrapper
+
+
+##################################################
+class Hass( object ):
+
+  def __init__( self, hub, name, args ):
+    self.hub  = hub
+    self.name = name
+    self.args = args
+
+  def log( self, msg, level = "INFO" ):
+    self.hub.logs.append( ( self.name, level, msg ) )
+
+  def error( self, msg, level = "WARNING" ):
+    self.hub.logs.append( ( self.name, level, msg ) )
+
+  #########################################################
+  @api
+  def entity_exists( self, entity_id ):
+    return True
+
+  @api
+  def get_state( self, entity_id = None, attribute = None ):
+    if entity_id is None:
+      return dict( self.hub.states )
+    if "." not in entity_id:
+      return { e : s for e, s in self.hub.states.items() if e.split( "." )[0] == entity_id }
+    entry = self.hub.states.get( entity_id )
+    if entry is None: return None
+    if attribute == "all": return entry
+    if attribute:          return entry[ "attributes" ].get( attribute )
+    return entry[ "state" ]
+
+  @api
+  def set_state( self, entity_id, state = None, attributes = None ):
+    self.hub.set_state( entity_id, state, attributes )
+
+  @api
+  def set_value( self, entity_id, value ):
+    self.hub.set_state( entity_id, value )
+
+  @api
+  def call_service( self, service, **kwargs ):
+    self.hub.services.append( ( self.hub.clock(), service, kwargs ) )
+    if service in ( "input_boolean/turn_on", "input_boolean/turn_off" ):
+      self.hub.set_state( kwargs[ "entity_id" ], "on" if service.endswith( "on" ) else "off" )
+    if service in ( "light/turn_on", "light/turn_off" ):
+      # The light reports its target straight away, as most integrations do
+      entities = kwargs[ "entity_id" ] if isinstance( kwargs[ "entity_id" ], list ) else [ kwargs[ "entity_id" ] ]
+      for entity in entities:
+        attributes = dict( self.hub.states.get( entity, {} ).get( "attributes", {} ) )
+        if service.endswith( "on" ): attributes[ "brightness" ] = kwargs.get( "brightness", attributes.get( "brightness" ) or 255 )
+        else:                        attributes[ "brightness" ] = None
+        self.hub.set_state( entity, "on" if service.endswith( "on" ) else "off", attributes )
+
+  @api
+  def fire_event( self, event, **data ):
+    self.hub.fire_event( event, **data )
+
+  @api
+  def datetime( self ):
+    return self.hub.today()
+
+  @api
+  def date( self ):
+    return self.hub.today().date()
+
+  #########################################################
+  @api
+  def listen_state( self, callback, entity_id = None, **kwargs ):
+    handle = self.hub.handle()
+    with self.hub.lock:
+      self.hub.state_cbs.append( ( self, callback, entity_id, kwargs ) )
+    return handle
+
+  @api
+  def listen_event( self, callback, event = None, **filters ):
+    handle = self.hub.handle()
+    with self.hub.lock:
+      self.hub.event_cbs.append( ( self, callback, event, filters ) )
+    return handle
+
+  @api
+  def run_in( self, callback, delay, **kwargs ):
+    hub    = self.hub
+    if hub.virtual: return hub.schedule( self, callback, hub.now + datetime.timedelta( seconds = delay ), None, kwargs )
+    handle = hub.handle()
+
+    def fire():
+      with hub.lock:
+        if hub.timers.pop( handle, None ) is None: return
+        hub.oneshots.discard( handle )
+      hub.dispatch( self, callback, kwargs )
+      with hub.lock: hub.busy -= 1
+
+    timer = threading.Timer( delay, fire )
+    timer.daemon = True
+    with hub.lock:
+      hub.timers[ handle ] = timer
+      hub.oneshots.add( handle )
+      hub.busy += 1
+    timer.start()
+    return handle
+
+  @api
+  def run_every( self, callback, start, interval, **kwargs ):
+    hub    = self.hub
+    if hub.virtual:
+      due = start if isinstance( start, datetime.datetime ) else hub.now
+      return hub.schedule( self, callback, max( due, hub.now ), datetime.timedelta( seconds = interval ), kwargs )
+    handle = hub.handle()
+    delay  = max( 0, ( start - datetime.datetime.now() ).total_seconds() ) if isinstance( start, datetime.datetime ) else 0
+
+    def fire():
+      with hub.lock:
+        if handle not in hub.timers: return
+        timer = threading.Timer( interval, fire )
+        timer.daemon = True
+        hub.timers[ handle ] = timer
+      timer.start()
+      hub.dispatch( self, callback, kwargs )
+
+    timer = threading.Timer( delay, fire )
+    timer.daemon = True
+    with hub.lock:
+      hub.timers[ handle ] = timer
+    timer.start()
+    return handle
+
+  @api
+  def run_daily( self, callback, start, **kwargs ):
+    # start : datetime.time of day
+    now = self.hub.today()
+    due = datetime.datetime.combine( now.date(), start )
+    if due <= now: due += datetime.timedelta( days = 1 )
+    return self.run_every( callback, due, 86400, **kwargs )
+
+  @api
+  def cancel_timer( self, handle ):
+    hub = self.hub
+    if hub.virtual:
+      with hub.lock: hub.timers.pop( handle, None )
+      return
+    with hub.lock:
+      timer = hub.timers.pop( handle, None )
+      if timer is not None and handle in hub.oneshots:
+        hub.oneshots.discard( handle )
+        hub.busy -= 1
+    if timer is not None:
+      timer.cancel()
+
+
+def install():
+  # Makes `import appdaemon.plugins.hass.hassapi as hass` resolve to this stub
+  hassapi = types.ModuleType( "appdaemon.plugins.hass.hassapi" )
+  hassapi.Hass = Hass
+  for name in ( "appdaemon", "appdaemon.plugins", "appdaemon.plugins.hass" ):
+    sys.modules.setdefault( name, types.ModuleType( name ) )
+  sys.modules[ "appdaemon.plugins.hass.hassapi" ] = hassapi
+  sys.modules[ "appdaemon.plugins.hass" ].hassapi = hassapi
+  return hassapi
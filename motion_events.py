@@ -0,0 +1,177 @@
+import http.server
+import queue
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+##################################################
+# Motion event listener
+#
+# Receives motion's event hooks ( on_event_start, on_event_end, on_picture_save ... ) so apps learn about motion as it
+# happens instead of polling.  One listener exists per port and is shared by every app in the AppDaemon process;  apps
+# register the camera name they answer to and get called with each event for it.
+#
+# Hooks reach the listener either over HTTP or as a single UDP datagram, e.g. in the camera's motion config:
+#
+#    on_event_start  curl -s "http://appdaemon:8099/kitchen/start"
+#    on_event_end    curl -s "http://appdaemon:8099/kitchen/end"
+#    on_picture_save curl -s "http://appdaemon:8099/kitchen/picture?file=%f"
+#    on_event_start  echo "kitchen start" | nc -u -w0 appdaemon 8099            ( UDP:  camera event [ key=value ... ] )
+#
+# Requests are answered as soon as they are queued.  A single dispatcher thread hands the events to the apps in the
+# order they arrived, so a burst from many cameras never ties up AppDaemon's worker threads or motion's hook processes.
+# When the queue is full new events are dropped and counted rather than blocking the sender.
+#
+# listener.stats:
+#  received : events queued
+#  unknown  : events for a camera no app has registered
+#  dropped  : events lost to a full queue
+#  failed   : events whose callback raised
+#
+# NOTE: this module is shared between apps.  Add it to global_modules in appdaemon.yaml so it is not reloaded
+#       underneath running apps.
+##################################################
+
+DEFAULT_PORT  = 8099
+DEFAULT_HOST  = "0.0.0.0"
+QUEUE_SIZE    = 1024
+UDP_BUFFER    = 1024 * 1024            # socket receive buffer, so a burst of datagrams is not dropped by the kernel
+
+
+class EventListener( object ):
+
+  def __init__( self, host = DEFAULT_HOST, port = DEFAULT_PORT, udp = True ):
+    self.host  = host
+    self.port  = port
+    self.users = 0
+
+    self.routes = {}                                          # camera name -> callback( event, data )
+    self.queue  = queue.Queue( QUEUE_SIZE )
+    self.lock   = threading.Lock()
+    self.stats  = { "received" : 0, "unknown" : 0, "dropped" : 0, "failed" : 0 }
+    self.last_error = None
+
+    # Datagrams are only parsed and queued, so the UDP server handles them inline rather than a thread each
+    self.servers = [ http.server.ThreadingHTTPServer( ( host, port ), self.http_handler() ) ]
+    if udp:
+      server = socketserver.UDPServer( ( host, port ), self.udp_handler() )
+      server.socket.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER )
+      self.servers.append( server )
+    for server in self.servers:
+      server.daemon_threads = True
+      threading.Thread( target = server.serve_forever, name = "motion_events", daemon = True ).start()
+    threading.Thread( target = self.dispatch, name = "motion_events_dispatch", daemon = True ).start()
+
+  #########################################################
+  def register( self, camera, callback ):
+    with self.lock:
+      self.routes[ camera ] = callback
+
+  def unregister( self, camera ):
+    with self.lock:
+      self.routes.pop( camera, None )
+
+  def submit( self, camera, event, data ):
+    # Called from the server threads.  Returns False when the event is not wanted or cannot be queued
+    with self.lock:
+      if camera not in self.routes:
+        self.stats[ "unknown" ] += 1
+        return False
+      try:
+        self.queue.put_nowait( ( camera, event, data, time.time() ) )
+      except queue.Full:
+        self.stats[ "dropped" ] += 1
+        return False
+      self.stats[ "received" ] += 1
+      return True
+
+  def dispatch( self ):
+    while True:
+      item = self.queue.get()
+      if item is None: return
+      camera, event, data, received = item
+      with self.lock:
+        callback = self.routes.get( camera )
+      if callback is None: continue
+      data[ "received" ] = received
+      try:
+        callback( event, data )
+      except Exception as err:
+        with self.lock:
+          self.stats[ "failed" ] += 1
+          self.last_error = "{}: {}".format( type( err ).__name__, err )
+
+  def close( self ):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+    self.queue.put( None )
+
+  #########################################################
+  def http_handler( self ):
+    listener = self
+
+    class Handler( http.server.BaseHTTPRequestHandler ):
+
+      def do_GET( self ):
+        parts  = urllib.parse.urlsplit( self.path )
+        pieces = [ urllib.parse.unquote( p ) for p in parts.path.strip( "/" ).split( "/" ) ]
+        if len( pieces ) != 2 or not all( pieces ):
+          self.answer( 400, "expected /<camera>/<event>" )
+          return
+        data = dict( urllib.parse.parse_qsl( parts.query ) )
+        if listener.submit( pieces[0], pieces[1], data ): self.answer( 200, "OK" )
+        else:                                             self.answer( 404, "not accepted" )
+
+      do_POST = do_GET
+
+      def answer( self, status, text ):
+        body = ( text + "\n" ).encode( 'utf-8' )
+        self.send_response( status )
+        self.send_header( "Content-Type", "text/plain" )
+        self.send_header( "Content-Length", str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+      def log_message( self, *args ):
+        pass
+
+    return Handler
+
+  def udp_handler( self ):
+    listener = self
+
+    class Handler( socketserver.BaseRequestHandler ):
+
+      def handle( self ):
+        # "camera event key=value key=value"
+        words = self.request[0].decode( 'utf-8', 'replace' ).split()
+        if len( words ) < 2: return
+        data = dict( word.partition( "=" )[::2] for word in words[2:] )
+        listener.submit( words[0], words[1], data )
+
+    return Handler
+
+
+##################################################
+_listeners      = {}
+_listeners_lock = threading.Lock()
+
+def get_listener( port = DEFAULT_PORT, host = DEFAULT_HOST, udp = True ):
+  # Returns the shared listener for the port, starting it on first use.  host and udp only take effect for the first caller
+  with _listeners_lock:
+    listener = _listeners.get( port )
+    if listener is None:
+      listener = EventListener( host, port, udp )
+      _listeners[ port ] = listener
+    listener.users += 1
+  return listener
+
+def release_listener( listener ):
+  with _listeners_lock:
+    listener.users -= 1
+    if listener.users > 0: return
+    _listeners.pop( listener.port, None )
+  listener.close()
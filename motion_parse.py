@@ -0,0 +1,86 @@
+import html
+import re
+
+##################################################
+# Motion webcontrol response parser
+#
+# Parses the output of motion's webcontrol API into typed python values.  Both output modes are supported:
+#
+#    webcontrol_interface 1 / webcontrol_html_output off   : plain text, one "name = value" per line
+#    webcontrol_interface 0 / webcontrol_html_output on    : the same content wrapped in html markup
+#
+# All patterns are compiled once at import.  A whole config/list dump is parsed in a single pass over the response,
+# so reading every setting of a camera costs the same as reading one.
+#
+# Values are typed as follows:
+#    integers   -> int           "128"          -> 128
+#    decimals   -> float         "2.5"          -> 2.5
+#    on / off   -> bool          "on"           -> True
+#    empty      -> None          "(null)"       -> None
+#    anything else is returned as an unescaped string
+#
+# benchmarks/bench_parse.py measures the parse cost per response against captured payloads.
+##################################################
+
+_BREAK_RE  = re.compile( r'<\s*(?:br|/?li|/?p|/?ul|/?tr|/?div|/?h\d)\b[^>]*>', re.IGNORECASE )
+_TAG_RE    = re.compile( r'<[^>]*>' )
+_CONFIG_RE = re.compile( r'^[ \t]*(\w+)[ \t]*=[ \t]*([^\n]*)', re.MULTILINE )
+_STATUS_RE = re.compile( r'Detection\s+status\s*(?:<[^>]*>\s*)*(\w+)' )
+_FLOAT_RE  = re.compile( r'-?\d*\.\d+' )
+
+CONSTANTS = { "on" : True, "off" : False, "" : None, "(null)" : None }
+
+_property_res = {}                     # property name -> compiled pattern, built once per name
+
+
+def to_text( response ):
+  # Reduces an html response to the plain text layout:  block level tags become line breaks, other markup is dropped
+  if "<" not in response: return response
+  text = _TAG_RE.sub( '', _BREAK_RE.sub( '\n', response ) )
+  return html.unescape( text ) if "&" in text else text
+
+def parse_value( value ):
+  value = value.rstrip()
+  if value in CONSTANTS: return CONSTANTS[ value ]
+
+  # Cheap character tests first;  most values are plain integers
+  if value.isdigit():                                  return int( value )
+  if value[0] == '-' and value[1:].isdigit():          return int( value )
+  if '.' in value and _FLOAT_RE.fullmatch( value ):    return float( value )
+  return value
+
+def parse_config( response ):
+  # config/list or config/get response -> { name : typed value }
+  return { name : parse_value( value ) for name, value in _CONFIG_RE.findall( to_text( response ) ) }
+
+def parse_property( response, prop_name ):
+  # Value of a single property from a config/get response.  Raises KeyError if motion did not report it
+  pattern = _property_res.get( prop_name )
+  if pattern is None:
+    # The pattern starts with the name itself so re can scan for it as a literal;  a leading (?<!\w) would have it try
+    # the whole pattern at every offset of the page.  Names that merely end in prop_name are skipped below instead
+    pattern = re.compile( r'{}[ \t]*(?:<[^>]*>[ \t]*)*=[ \t]*([^<\n]*)'.format( re.escape( prop_name ) ) )
+    _property_res[ prop_name ] = pattern
+
+  match = pattern.search( response )
+  while match is not None and match.start() > 0 and ( response[ match.start() - 1 ].isalnum() or response[ match.start() - 1 ] == '_' ):
+    match = pattern.search( response, match.start() + 1 )
+  if match is None:
+    raise KeyError( "{} not found in response".format( prop_name ) )
+
+  value = match.group( 1 )
+  return parse_value( html.unescape( value ) if "&" in value else value )
+
+def parse_detection_status( response ):
+  # detection/status response -> True when detection is ACTIVE, False when paused
+  match = _STATUS_RE.search( response )
+  if match is None:
+    raise ValueError( "no detection status in response" )
+  return match.group( 1 ) == 'ACTIVE'
+
+def format_value( value ):
+  # Inverse of parse_value, for building config/set requests
+  if value is True:  return "on"
+  if value is False: return "off"
+  if value is None:  return ""
+  return str( value )
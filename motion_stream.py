@@ -0,0 +1,394 @@
+import asyncio
+import collections
+import http.client
+import os
+import random
+import tempfile
+import threading
+import time
+
+import motion_webcontrol
+
+##################################################
+# Motion MJPEG stream reader
+#
+# Pulls frames from motion's stream port ( stream_port in motion.conf, e.g. http://camera:8081/ ).  The stream is a
+# multipart/x-mixed-replace response;  MjpegParser walks it incrementally as chunks arrive and hands each frame's bytes
+# to a sink piece by piece, so a frame is never assembled from the whole stream and then copied out.
+#
+# Parts carrying a Content-Length header ( motion always sends one ) are read by length without scanning the image
+# data.  Parts without one fall back to scanning for the next boundary.
+#
+# Sinks:
+#   FileSink  : writes each frame straight to disk ( via a temp file and rename, so readers never see half a frame )
+#   FrameRing : bounded in-memory ring of the last N frames.  Slot buffers are reused, so memory stays flat under
+#               continuous load
+#   a sink is any object with frame_start( headers ), frame_data( memoryview ) and frame_end()
+#
+# grab_frames() / async_grab_frames() open a stream, feed `count` frames to a sink and close it again.
+#
+# StreamMonitor watches a stream continuously:  it stays connected, counts frames with a FrameCounter ( which never
+# touches the image data ) and tracks the frame rate, the gap between frames and whether the stream has stalled.  All
+# monitors in the process share one background thread running an asyncio loop, so watching dozens of cameras costs a
+# single thread and little more CPU than reading the sockets.
+##################################################
+
+CHUNK_SIZE  = 64 * 1024
+MAX_HEADERS = 8 * 1024                 # a part header larger than this means we are not looking at an mjpeg stream
+RECONNECT_MAX = 60                     # seconds, ceiling of the reconnect backoff
+
+
+class StreamError( Exception ):
+  pass
+
+
+class MjpegParser( object ):
+
+  BOUNDARY = 0
+  HEADERS  = 1
+  BODY     = 2
+
+  def __init__( self, boundary, sink ):
+    self.marker    = b"--" + boundary
+    self.delimiter = b"\r\n--" + boundary
+    self.sink      = sink
+    self.state     = self.BOUNDARY
+    self.buf       = bytearray()
+    self.remaining = None              # bytes left in the current part when its length is known
+    self.frames    = 0
+
+  def feed( self, data ):
+    # Returns the number of frames completed by this chunk
+    self.buf += data
+    done = self.frames
+    while self.step(): pass
+    return self.frames - done
+
+  def step( self ):
+    buf = self.buf
+
+    if self.state == self.BOUNDARY:
+      idx = buf.find( self.marker )
+      if idx < 0:
+        del buf[ : max( 0, len( buf ) - len( self.marker ) ) ]
+        return False
+      del buf[ : idx + len( self.marker ) ]
+      self.state = self.HEADERS
+      return True
+
+    if self.state == self.HEADERS:
+      idx = buf.find( b"\r\n\r\n" )
+      if idx < 0:
+        if len( buf ) > MAX_HEADERS: raise StreamError( "part headers too large" )
+        return False
+      headers = parse_headers( bytes( buf[ : idx ] ) )
+      del buf[ : idx + 4 ]
+      length         = headers.get( "content-length" )
+      self.remaining = int( length ) if length else None
+      self.sink.frame_start( headers )
+      self.state = self.BODY
+      return True
+
+    if self.remaining is not None:
+      take = min( self.remaining, len( buf ) )
+      if take:
+        self.sink.frame_data( memoryview( buf )[ : take ] )
+        del buf[ : take ]
+        self.remaining -= take
+      if self.remaining: return False
+      self.end_frame()
+      return True
+
+    # No length ... emit up to the next delimiter, holding back enough bytes to catch a delimiter split across chunks
+    idx = buf.find( self.delimiter )
+    if idx < 0:
+      keep = len( self.delimiter )
+      if len( buf ) > keep:
+        self.sink.frame_data( memoryview( buf )[ : len( buf ) - keep ] )
+        del buf[ : len( buf ) - keep ]
+      return False
+    if idx: self.sink.frame_data( memoryview( buf )[ : idx ] )
+    del buf[ : idx + 2 ]                                      # leave the "--boundary" for the BOUNDARY state
+    self.end_frame()
+    return True
+
+  def end_frame( self ):
+    self.sink.frame_end()
+    self.frames += 1
+    self.state   = self.BOUNDARY
+
+
+def parse_headers( block ):
+  headers = {}
+  for line in block.decode( 'latin-1' ).split( "\r\n" ):
+    name, _, value = line.partition( ":" )
+    if value: headers[ name.strip().lower() ] = value.strip()
+  return headers
+
+def boundary_of( content_type ):
+  # multipart/x-mixed-replace; boundary=BoundaryString -> b"BoundaryString"
+  for param in content_type.split( ";" )[1:]:
+    name, _, value = param.strip().partition( "=" )
+    if name.lower() == "boundary":
+      value = value.strip( '"' )
+      return ( value[2:] if value.startswith( "--" ) else value ).encode( 'latin-1' )
+  raise StreamError( "no boundary in content type '{}'".format( content_type ) )
+
+
+##################################################
+class FileSink( object ):
+
+  def __init__( self, directory, name = "frame", keep = 1 ):
+    # keep = 1 overwrites <name>.jpg in place, otherwise frames rotate through <name>-0.jpg .. <name>-<keep-1>.jpg
+    self.directory = directory
+    self.name      = name
+    self.keep      = keep
+    self.count     = 0
+    self.paths     = []                # paths completed during this grab, oldest first
+    self.file      = None
+
+  def frame_start( self, headers ):
+    fd, self.tmp_path = tempfile.mkstemp( dir = self.directory, suffix = ".part" )
+    self.file = os.fdopen( fd, "wb" )
+
+  def frame_data( self, data ):
+    self.file.write( data )
+
+  def frame_end( self ):
+    self.file.close()
+    self.file = None
+    if self.keep == 1: path = os.path.join( self.directory, "{}.jpg".format( self.name ) )
+    else:              path = os.path.join( self.directory, "{}-{}.jpg".format( self.name, self.count % self.keep ) )
+    os.replace( self.tmp_path, path )
+    self.count += 1
+    self.paths.append( path )
+
+  def abort( self ):
+    if self.file:
+      self.file.close()
+      os.unlink( self.tmp_path )
+      self.file = None
+
+
+class FrameRing( object ):
+
+  def __init__( self, size = 4 ):
+    self.slots   = collections.deque( maxlen = size )
+    self.spare   = []                  # buffers of frames pushed out of the ring, reused for the next frame
+    self.current = None
+    self.count   = 0
+
+  def frame_start( self, headers ):
+    self.current = self.spare.pop() if self.spare else bytearray()
+    del self.current[:]
+
+  def frame_data( self, data ):
+    self.current += data
+
+  def frame_end( self ):
+    if len( self.slots ) == self.slots.maxlen:
+      self.spare.append( self.slots[0] )
+    self.slots.append( self.current )
+    self.current = None
+    self.count  += 1
+
+  def abort( self ):
+    if self.current is not None:
+      self.spare.append( self.current )
+      self.current = None
+
+  def latest( self ):
+    # Most recent complete frame as bytes, or None
+    return bytes( self.slots[-1] ) if self.slots else None
+
+  def frames( self ):
+    return [ bytes( frame ) for frame in self.slots ]
+
+
+class FrameCounter( object ):
+
+  def __init__( self ):
+    self.count      = 0
+    self.bytes      = 0
+    self.last_frame = None             # monotonic time the last frame completed
+    self.gap_avg    = None             # moving average of the time between frames, seconds
+    self.gap_max    = 0.0              # longest gap since the last sample
+
+  def frame_start( self, headers ):
+    pass
+
+  def frame_data( self, data ):
+    self.bytes += len( data )
+
+  def frame_end( self ):
+    now = time.monotonic()
+    if self.last_frame is not None:
+      gap = now - self.last_frame
+      self.gap_avg = gap if self.gap_avg is None else self.gap_avg + 0.1 * ( gap - self.gap_avg )
+      if gap > self.gap_max: self.gap_max = gap
+    self.last_frame = now
+    self.count     += 1
+
+  def abort( self ):
+    pass
+
+
+##################################################
+def grab_frames( url, sink, count = 1, timeout = motion_webcontrol.DEFAULT_TIMEOUT ):
+  # Blocking:  reads `count` frames from the stream at url into sink.  Returns the number of frames read
+  host, port, path = motion_webcontrol.split_url( url )
+  conn = http.client.HTTPConnection( host, port, timeout = timeout )
+  try:
+    conn.request( "GET", path )
+    response = conn.getresponse()
+    if response.status >= 400:
+      raise StreamError( "{} returned HTTP {}".format( url, response.status ) )
+
+    parser = MjpegParser( boundary_of( response.getheader( "Content-Type", "" ) ), sink )
+    while parser.frames < count:
+      chunk = response.read1( CHUNK_SIZE )
+      if not chunk: break
+      parser.feed( chunk )
+    return parser.frames
+  except:
+    sink.abort()
+    raise
+  finally:
+    conn.close()
+
+async def async_grab_frames( url, sink, count = 1, timeout = motion_webcontrol.DEFAULT_TIMEOUT ):
+  # As grab_frames(), on the event loop.  timeout applies to each read rather than the whole grab
+  host, port, path = motion_webcontrol.split_url( url )
+  reader, writer = await asyncio.wait_for( asyncio.open_connection( host, port ), timeout )
+  try:
+    writer.write( "GET {} HTTP/1.1\r\nHost: {}:{}\r\n\r\n".format( path, host, port ).encode( 'ascii' ) )
+    await writer.drain()
+
+    status, headers = await asyncio.wait_for( motion_webcontrol.read_head( reader ), timeout )
+    if status >= 400:
+      raise StreamError( "{} returned HTTP {}".format( url, status ) )
+
+    parser = MjpegParser( boundary_of( headers.get( "content-type", "" ) ), sink )
+    while parser.frames < count:
+      chunk = await asyncio.wait_for( reader.read( CHUNK_SIZE ), timeout )
+      if not chunk: break
+      parser.feed( chunk )
+    return parser.frames
+  except:
+    sink.abort()
+    raise
+  finally:
+    writer.close()
+
+
+##################################################
+class StreamMonitor( object ):
+
+  def __init__( self, url, stall_timeout = 10, on_change = None, timeout = motion_webcontrol.DEFAULT_TIMEOUT ):
+    # on_change( monitor ) is called whenever the stream stalls or recovers, on the monitors' shared event loop thread.
+    # It must not block, and AppDaemon apps must not call their API from it
+    self.url           = url
+    self.stall_timeout = stall_timeout
+    self.on_change     = on_change
+    self.timeout       = timeout
+
+    self.counter    = FrameCounter()
+    self.connected  = False
+    self.stalled    = False
+    self.reconnects = 0
+    self.last_error = None
+    self.task       = None
+    self.sampled_at = time.monotonic()
+    self.sampled    = 0
+    self.frames_at_connect = 0
+
+  def start( self ):
+    self.task = asyncio.run_coroutine_threadsafe( self.run(), _monitor_loop() )
+    return self
+
+  def stop( self ):
+    if self.task: self.task.cancel()
+    self.task = None
+
+  def sample( self ):
+    # Frame rate and gaps since the previous sample, for publishing
+    now, counter = time.monotonic(), self.counter
+    fps = ( counter.count - self.sampled ) / max( now - self.sampled_at, 1e-6 )
+    status = { "fps"        : round( fps, 2 ),
+               "gap_avg"    : counter.gap_avg or 0.0,
+               "gap_max"    : counter.gap_max,
+               "frames"     : counter.count,
+               "bytes"      : counter.bytes,
+               "connected"  : self.connected,
+               "stalled"    : self.stalled,
+               "reconnects" : self.reconnects,
+               "last_error" : self.last_error }
+    self.sampled_at, self.sampled, counter.gap_max = now, counter.count, 0.0
+    return status
+
+  #########################################################
+  async def run( self ):
+    attempt = 0
+    while True:
+      try:
+        await self.watch()
+        self.last_error = "stream closed"
+      except asyncio.CancelledError:
+        raise
+      except ( StreamError, ) + motion_webcontrol.TRANSPORT_ERRORS as err:
+        self.last_error = str( err ) or type( err ).__name__
+      self.connected = False
+      self.set_stalled( True )
+
+      # Back off while the camera stays away, start over once it has delivered frames again
+      attempt = 0 if self.counter.count > self.frames_at_connect else attempt + 1
+      self.reconnects += 1
+      await asyncio.sleep( random.uniform( 0.5, 1 ) * min( RECONNECT_MAX, 2 ** min( attempt, 6 ) ) )
+
+  async def watch( self ):
+    self.frames_at_connect = self.counter.count
+    host, port, path = motion_webcontrol.split_url( self.url )
+    reader, writer = await asyncio.wait_for( asyncio.open_connection( host, port ), self.timeout )
+    try:
+      writer.write( "GET {} HTTP/1.1\r\nHost: {}:{}\r\n\r\n".format( path, host, port ).encode( 'ascii' ) )
+      await writer.drain()
+      status, headers = await asyncio.wait_for( motion_webcontrol.read_head( reader ), self.timeout )
+      if status >= 400:
+        raise StreamError( "{} returned HTTP {}".format( self.url, status ) )
+
+      parser = MjpegParser( boundary_of( headers.get( "content-type", "" ) ), self.counter )
+      self.connected = True
+      while True:
+        try:
+          chunk = await asyncio.wait_for( reader.read( CHUNK_SIZE ), self.stall_timeout )
+        except asyncio.TimeoutError:
+          raise StreamError( "no data for {}s".format( self.stall_timeout ) )
+        if not chunk: return
+        if parser.feed( chunk ):
+          self.set_stalled( False )
+        elif time.monotonic() - ( self.counter.last_frame or 0 ) > self.stall_timeout:
+          self.set_stalled( True )     # data is arriving but no frame has completed
+    finally:
+      writer.close()
+
+  def set_stalled( self, stalled ):
+    if stalled == self.stalled: return
+    self.stalled = stalled
+    if self.on_change:
+      try:
+        self.on_change( self )
+      except Exception as err:
+        self.last_error = "on_change: {}".format( err )
+
+
+_loop      = None
+_loop_lock = threading.Lock()
+
+def _monitor_loop():
+  # Event loop shared by every StreamMonitor, started on first use
+  global _loop
+  with _loop_lock:
+    if _loop is None:
+      _loop = asyncio.new_event_loop()
+      threading.Thread( target = _loop.run_forever, name = "motion_stream_monitor", daemon = True ).start()
+    return _loop
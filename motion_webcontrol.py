@@ -0,0 +1,919 @@
+import asyncio
+import bisect
+import heapq
+import http.client
+import random
+import re
+import socket
+import threading
+import time
+import urllib.parse
+
+##################################################
+# Motion webcontrol client
+#
+# Shared HTTP client for the motion daemon's webcontrol API.  One client exists per motion host ( host:port ) and
+# is shared by every app that points at a camera on that host.  Requests are sent as HTTP/1.1 keep-alive and the
+# sockets are held in a small bounded pool, so repeated calls reuse an open connection instead of paying the TCP
+# setup cost on every request.
+#
+# AsyncWebControlClient is the asyncio counterpart for apps running their callbacks on the AppDaemon event loop.  It
+# speaks the same keep-alive protocol over asyncio streams, so a slow or dead camera only parks a coroutine instead of
+# holding a worker thread, and many cameras can be driven concurrently from the loop.  Both clients are built on
+# BaseClient, which holds everything but the I/O:  the per camera state, the connection bookkeeping and the breaker and
+# retry decisions.
+#
+# Paths go into the HTTP request line as they are, so values in them have to be percent encoded;  config_get_path() and
+# config_set_path() build the config queries that way.  A path
+# holding spaces, control characters or anything outside ascii is refused with WebControlError before it is queued.
+#
+# Clients are handed out by get_client() / get_async_client() and reference counted;  apps should call release_client()
+# from terminate() so the pool is closed once the last user of a host goes away.
+#
+#  pool_size : maximum number of sockets held open to a host, and of requests in flight to it [ default = 2 ]
+#  timeout   : default deadline in seconds for a whole request:  the wait for a free socket, every attempt and the backoff
+#              between them [ default = 5 ]
+#  retries   : extra attempts made for idempotent requests, with jittered exponential backoff, as long as the deadline and
+#              the breaker allow [ default = 2 ]
+#
+# motion answers a host's webcontrol requests one at a time, so requests from every app on the host go through one
+# priority queue ( client.queue ) before they are sent:  detection start / pause first, then actions such as snapshots,
+# then config writes, then reads.  Requests of equal priority keep their order.  A request identical to one still waiting
+# in the queue is not queued again;  the caller shares the waiting request's answer.  That only happens while the waiting
+# request is the newest of its kind ( config, detection or action ) for the host, so a request queued after something
+# that may change its answer, such as hue=3 after hue=5 after hue=3, is always sent in its turn.  Set pool_size to 1 to keep motion
+# from ever holding more than one request of a host at a time, so the priorities apply strictly.
+#
+# client.queue.stats:
+#  queued       : requests that had to wait for a free slot
+#  deduplicated : requests answered by an identical queued request
+#  max_depth    : most requests seen waiting at once
+#  waited       : total seconds requests spent waiting
+#
+# Every camera thread has a CircuitBreaker ( client.breaker( "/1/" ) ).  After failure_threshold consecutive failed
+# attempts ( each retry counts, so a single call to a dead camera can open it ) the breaker opens and requests to that camera fail straight away with CameraUnavailable instead of waiting out
+# the timeout again.  Once reset_timeout has passed a single probe request is let through;  success closes the breaker,
+# failure opens it for another reset_timeout.  Errors reported by motion itself ( HTTP status ) do not count as failures.
+#
+# Connection usage is tracked in client.stats:
+#  opened   : new TCP connections made to the host
+#  reused   : requests served over an already open keep-alive connection
+#  requests : total requests sent
+#  dropped  : connections discarded ( closed by the server, errors, pool full )
+#
+# Every request is also timed into client.metrics, per camera thread and endpoint ( e.g. "/1/", "config/get" ):  call count,
+# a latency histogram, errors, timeouts, rejections by the breaker and bytes read.  Recording costs a couple of clock
+# reads and a counter update, so it is always on;  metrics.snapshot( "/1/" ) returns a copy for publishing.
+#
+# Each client also holds a PropertyCache per camera thread ( client.cache( "/1/" ) ), so every app driving the same
+# camera shares one view of its settings.  Reads are served from the cache until the entry is older than the TTL,
+# and writes go through it, which lets callers skip writes of a value the camera already has.
+#
+# The detection state of each camera thread is tracked locally in a DetectionState ( client.detection( "/1/" ) ).  It keeps
+# the state the user asked for apart from the state the camera is in, and counts the short "stabilisation" pauses taken
+# while image settings change.  Detection is paused while any pause is held and goes back to the requested state once
+# the last one is released, so overlapping changes never race each other.  The camera is only sent a start or pause
+# when its last known state differs from the target.
+#
+# NOTE: this module is shared between apps.  Add it to global_modules in appdaemon.yaml so it is not reloaded
+#       underneath running apps.
+##################################################
+
+DEFAULT_PORT      = 7999
+DEFAULT_POOL_SIZE = 2
+DEFAULT_TIMEOUT   = 5
+DEFAULT_RETRIES   = 2
+BACKOFF_BASE      = 0.25                                      # seconds, doubled on each retry
+
+PRIORITY_DETECTION = 0
+PRIORITY_ACTION    = 1
+PRIORITY_WRITE     = 2
+PRIORITY_READ      = 3
+LATENCY_BUCKETS   = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5 )    # histogram upper bounds, seconds
+
+
+class WebControlError( Exception ):
+  pass
+
+class CameraUnavailable( WebControlError ):
+  pass
+
+TRANSPORT_ERRORS = ( http.client.HTTPException, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError )
+TIMEOUT_ERRORS   = ( TimeoutError, socket.timeout, asyncio.TimeoutError )
+
+_UNSAFE_PATH_RE  = re.compile( r'[^\x21-\x7e]' )          # anything that cannot appear as is in an HTTP request line
+
+def camera_path( path ):
+  # "/1/config/get?query=hue" -> "/1/"
+  return "/{}/".format( path.split( "/" )[1] )
+
+def endpoint_of( path ):
+  # "/1/config/get?query=hue" -> "config/get"
+  return "/".join( path.split( "?" )[0].split( "/" )[2:4] )
+
+def section_of( path ):
+  # "/1/config/get?query=hue" -> "config"
+  return endpoint_of( path ).split( "/" )[0]
+
+def priority_of( path ):
+  endpoint = endpoint_of( path )
+  if endpoint in ( "detection/start", "detection/pause" ): return PRIORITY_DETECTION
+  if endpoint.startswith( "action/" ):                      return PRIORITY_ACTION
+  if endpoint == "config/set":                              return PRIORITY_WRITE
+  return PRIORITY_READ
+
+def config_get_path( camera, name ):
+  # ( "/1/", "hue" ) -> "/1/config/get?query=hue"
+  return "{}config/get?{}".format( camera, urllib.parse.urlencode( { "query" : name }, quote_via = urllib.parse.quote ) )
+
+def config_set_path( camera, name, value ):
+  # ( "/1/", "text_left", "HI THERE" ) -> "/1/config/set?text_left=HI%20THERE";  value as motion_parse.format_value gives it.
+  # Names and values are percent encoded, so spaces, & and # reach motion as part of the value
+  return "{}config/set?{}".format( camera, urllib.parse.urlencode( { name : value }, quote_via = urllib.parse.quote ) )
+
+def backoff( attempt ):
+  # Full jitter: anywhere between 0 and the exponential ceiling, so retries from many apps do not line up
+  return random.uniform( 0, BACKOFF_BASE * ( 2 ** attempt ) )
+
+
+##################################################
+class CircuitBreaker( object ):
+
+  CLOSED    = "closed"
+  OPEN      = "open"
+  HALF_OPEN = "half_open"
+
+  def __init__( self, failure_threshold = 3, reset_timeout = 30 ):
+    self.failure_threshold = failure_threshold
+    self.reset_timeout     = reset_timeout
+
+    self.state      = self.CLOSED
+    self.failures   = 0
+    self.opened_at  = 0
+    self.probing    = False
+    self.last_error = None
+    self.trips      = 0
+    self.lock       = threading.Lock()
+
+  def allow( self ):
+    with self.lock:
+      if self.state == self.CLOSED: return True
+      if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+        self.state = self.HALF_OPEN
+      if self.state == self.HALF_OPEN and not self.probing:
+        self.probing = True                                   # let exactly one probe through
+        return True
+      return False
+
+  def probe_due( self ):
+    with self.lock:
+      return self.state != self.CLOSED and not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout
+
+  def success( self ):
+    with self.lock:
+      self.state    = self.CLOSED
+      self.failures = 0
+      self.probing  = False
+
+  def failure( self, error ):
+    with self.lock:
+      self.failures  += 1
+      self.last_error = str( error ) or type( error ).__name__
+      self.probing    = False
+      if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+        if self.state != self.OPEN: self.trips += 1
+        self.state     = self.OPEN
+        self.opened_at = time.monotonic()
+
+
+##################################################
+class EndpointStats( object ):
+
+  __slots__ = ( "calls", "errors", "timeouts", "rejected", "bytes", "total", "max", "buckets" )
+
+  def __init__( self ):
+    self.calls    = 0
+    self.errors   = 0
+    self.timeouts = 0
+    self.rejected = 0
+    self.bytes    = 0
+    self.total    = 0.0                                       # seconds spent in completed or failed calls
+    self.max      = 0.0
+    self.buckets  = [ 0 ] * ( len( LATENCY_BUCKETS ) + 1 )     # last bucket catches anything above the top bound
+
+  def add( self, seconds, nbytes ):
+    self.calls += 1
+    self.bytes += nbytes
+    self.total += seconds
+    if seconds > self.max: self.max = seconds
+    self.buckets[ bisect.bisect_left( LATENCY_BUCKETS, seconds ) ] += 1
+
+  def percentile( self, pct ):
+    # Upper bound of the bucket holding the pct'th call, so the figure is never optimistic
+    rank = pct / 100.0 * self.calls
+    seen = 0
+    for index, count in enumerate( self.buckets ):
+      seen += count
+      if count and seen >= rank:
+        return LATENCY_BUCKETS[ index ] if index < len( LATENCY_BUCKETS ) else self.max
+    return 0.0
+
+  def as_dict( self ):
+    return { "calls"     : self.calls,
+             "errors"    : self.errors,
+             "timeouts"  : self.timeouts,
+             "rejected"  : self.rejected,
+             "bytes"     : self.bytes,
+             "mean"      : self.total / self.calls if self.calls else 0.0,
+             "p50"       : self.percentile( 50 ),
+             "p99"       : self.percentile( 99 ),
+             "max"       : self.max,
+             "histogram" : dict( zip( [ str( b ) for b in LATENCY_BUCKETS ] + [ "inf" ], self.buckets ) ) }
+
+
+class Metrics( object ):
+
+  def __init__( self ):
+    self.endpoints = {}                                       # ( camera path, endpoint ) -> EndpointStats
+    self.lock      = threading.Lock()
+
+  def stats( self, path ):
+    key   = ( camera_path( path ), endpoint_of( path ) )
+    stats = self.endpoints.get( key )
+    if stats is None:
+      stats = self.endpoints[ key ] = EndpointStats()
+    return stats
+
+  def record( self, path, seconds, nbytes ):
+    with self.lock:
+      self.stats( path ).add( seconds, nbytes )
+
+  def failed( self, path, seconds, error ):
+    with self.lock:
+      stats = self.stats( path )
+      if isinstance( error, CameraUnavailable ):
+        stats.rejected += 1                                   # failed fast, no time spent on the network
+        return
+      stats.add( seconds, 0 )
+      if isinstance( error, TIMEOUT_ERRORS ): stats.timeouts += 1
+      else:                                   stats.errors   += 1
+
+  def snapshot( self, camera = None ):
+    # { endpoint : stats dict } for one camera thread, or { ( camera, endpoint ) : stats dict } for the whole host
+    with self.lock:
+      if camera is None: return { key : self.endpoints[ key ].as_dict() for key in self.endpoints }
+      return { key[1] : self.endpoints[ key ].as_dict() for key in self.endpoints if key[0] == camera }
+
+
+##################################################
+class RequestTicket( object ):
+
+  def __init__( self, path, priority ):
+    self.path      = path
+    self.priority  = priority
+    self.followers = 0                                        # identical requests waiting on this one's answer
+    self.body      = None
+    self.error     = None
+    self.done      = threading.Event()
+    self.future    = None                                     # async clients:  resolved with the answer for followers
+
+  def finish( self, body, error ):
+    self.body, self.error = body, error
+    self.done.set()
+    if self.future is not None and not self.future.done():
+      if error is None: self.future.set_result( body )
+      else:             self.future.set_exception( error )
+
+  def wait( self ):
+    self.done.wait()
+    if self.error is not None: raise self.error
+    return self.body
+
+
+class BaseRequestQueue( object ):
+  # What the thread and asyncio queues share:  deduplication of identical requests and the count of requests in flight
+
+  def __init__( self, concurrency ):
+    self.concurrency = concurrency
+    self.active      = 0
+    self.heap        = []                                     # requests waiting for a slot, priority and order first
+    self.pending     = {}                                     # path -> ticket not yet admitted, for deduplication
+    self.newest      = {}                                     # section -> last ticket joined, only that one can be shared
+    self.order       = 0
+    self.lock        = threading.Lock()
+    self.stats       = { "queued" : 0, "deduplicated" : 0, "max_depth" : 0, "waited" : 0.0 }
+
+  def join( self, path, priority ):
+    # Returns ( ticket, True ) when the caller has to send the request, ( ticket, False ) to wait for an identical one
+    with self.lock:
+      section = section_of( path )
+      ticket  = self.pending.get( path )
+      if ticket is not None and self.newest.get( section ) is ticket:
+        ticket.followers += 1
+        self.stats[ "deduplicated" ] += 1
+        return ticket, False
+      ticket = self.pending[ path ] = self.newest[ section ] = RequestTicket( path, priority )
+      return ticket, True
+
+  def leave( self, ticket ):
+    with self.lock:
+      if self.pending.get( ticket.path ) is ticket: del self.pending[ ticket.path ]
+
+  def depth( self ):
+    with self.lock:
+      return len( self.heap )
+
+  def admit( self, ticket ):
+    self.active += 1
+    if self.pending.get( ticket.path ) is ticket: del self.pending[ ticket.path ]
+
+
+class RequestQueue( BaseRequestQueue ):
+
+  def __init__( self, concurrency ):
+    BaseRequestQueue.__init__( self, concurrency )
+    self.cond = threading.Condition( self.lock )              # heap entries are [ priority, order, ticket ]
+
+  def acquire( self, ticket, timeout ):
+    with self.cond:
+      if self.active < self.concurrency and not self.heap:
+        self.admit( ticket )
+        return
+
+      self.order += 1
+      entry = [ ticket.priority, self.order, ticket ]
+      heapq.heappush( self.heap, entry )
+      self.stats[ "queued" ]   += 1
+      self.stats[ "max_depth" ] = max( self.stats[ "max_depth" ], len( self.heap ) )
+
+      start    = time.monotonic()
+      deadline = start + timeout
+      while self.active >= self.concurrency or self.heap[0] is not entry:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          self.heap.remove( entry )
+          heapq.heapify( self.heap )
+          self.stats[ "waited" ] += time.monotonic() - start
+          self.cond.notify_all()
+          raise TimeoutError( "no free connection within {}s".format( timeout ) )
+        self.cond.wait( remaining )
+
+      heapq.heappop( self.heap )
+      self.stats[ "waited" ] += time.monotonic() - start
+      self.admit( ticket )
+      self.cond.notify_all()                                  # the next in line may fit in another free slot
+
+  def release( self ):
+    with self.cond:
+      self.active -= 1
+      self.cond.notify_all()
+
+
+class AsyncRequestQueue( BaseRequestQueue ):
+  # Heap entries are [ priority, order, future, ticket ];  everything but join, leave and depth runs on the event loop
+
+  def join( self, path, priority ):
+    ticket, leader = BaseRequestQueue.join( self, path, priority )
+    if not leader and ticket.future is None: ticket.future = asyncio.get_running_loop().create_future()
+    return ticket, leader
+
+  async def acquire( self, ticket ):
+    if self.active < self.concurrency and not self.heap:
+      self.admit( ticket )
+      return
+
+    self.order += 1
+    future = asyncio.get_running_loop().create_future()
+    heapq.heappush( self.heap, [ ticket.priority, self.order, future, ticket ] )
+    self.stats[ "queued" ]   += 1
+    self.stats[ "max_depth" ] = max( self.stats[ "max_depth" ], len( self.heap ) )
+
+    start = time.monotonic()
+    try:
+      await future                                            # resolved by wake() once admitted
+    except asyncio.CancelledError:
+      if future.done() and not future.cancelled(): self.release()     # admitted, then cancelled before we ran
+      raise
+    finally:
+      self.stats[ "waited" ] += time.monotonic() - start
+
+  def release( self ):
+    self.active -= 1
+    self.wake()
+
+  def wake( self ):
+    while self.heap and self.active < self.concurrency:
+      priority, order, future, ticket = heapq.heappop( self.heap )
+      if future.cancelled(): continue                         # its caller timed out while waiting
+      self.admit( ticket )
+      future.set_result( None )
+
+
+##################################################
+class BaseClient( object ):
+  # What the thread and asyncio clients share:  the per camera state, the connection bookkeeping and the decisions on
+  # whether a request may go out and whether a failed attempt is retried.  The subclasses only do the I/O
+
+  queue_class = None
+
+  def __init__( self, host, port = DEFAULT_PORT, pool_size = DEFAULT_POOL_SIZE, timeout = DEFAULT_TIMEOUT, retries = DEFAULT_RETRIES ):
+    self.host      = host
+    self.port      = port
+    self.pool_size = pool_size
+    self.timeout   = timeout
+    self.retries   = retries
+    self.users     = 0
+
+    self.idle     = []                                        # open connections ready for reuse
+    self.queue    = self.queue_class( pool_size )             # orders and bounds the requests in flight to the host
+    self.lock     = threading.Lock()
+    self.stats    = { "opened" : 0, "reused" : 0, "requests" : 0, "dropped" : 0, "retries" : 0, "rejected" : 0 }
+    self.metrics  = Metrics()
+    self.caches   = {}
+    self.breakers = {}
+    self.states   = {}
+
+  def count( self, stat ):
+    with self.lock:
+      self.stats[ stat ] += 1
+
+  #########################################################
+  def check_path( self, path ):
+    # Refuses a path that cannot go into a request line as it is ( spaces, control characters, anything outside ascii ),
+    # before it takes a place in the queue.  Values have to be percent encoded by the caller
+    if _UNSAFE_PATH_RE.search( path ):
+      raise WebControlError( "{!r} is not a valid webcontrol path".format( path ) )
+
+  def admit( self, path ):
+    # Returns the camera's breaker, or raises CameraUnavailable straight away while it is open
+    breaker = self.breaker( camera_path( path ) )
+    if not breaker.allow():
+      self.count( "rejected" )
+      raise CameraUnavailable( "{}:{}{} is unavailable ( {} )".format( self.host, self.port, camera_path( path ), breaker.last_error ) )
+    return breaker
+
+  def attempts( self, idempotent ):
+    return 1 + ( self.retries if idempotent else 0 )
+
+  def deadline( self, timeout ):
+    # One deadline covers the whole request:  the queue, every attempt and the backoff between them
+    return time.monotonic() + ( self.timeout if timeout is None else timeout )
+
+  def retry_delay( self, breaker, error, attempt, attempts, deadline ):
+    # After a failed attempt, which counts against the breaker:  seconds to back off before the next one, or None when
+    # the caller should give up and raise ( no attempts left, the breaker has opened or the deadline would pass )
+    breaker.failure( error )
+    if attempt + 1 >= attempts or breaker.state != breaker.CLOSED: return None
+    delay = backoff( attempt )
+    if time.monotonic() + delay >= deadline: return None
+    self.count( "retries" )
+    return delay
+
+  #########################################################
+  def release( self, conn ):
+    with self.lock:
+      if len( self.idle ) < self.pool_size:
+        self.idle.append( conn )
+        return
+    self.discard( conn )
+
+  def discard( self, conn ):
+    self.count( "dropped" )
+    self.close_connection( conn )
+
+  def cache( self, path, ttl = None ):
+    with self.lock:
+      return self.caches.setdefault( path, PropertyCache( ttl ) )
+
+  def breaker( self, path, failure_threshold = 3, reset_timeout = 30 ):
+    with self.lock:
+      return self.breakers.setdefault( path, CircuitBreaker( failure_threshold, reset_timeout ) )
+
+  def detection( self, path ):
+    with self.lock:
+      return self.states.setdefault( path, DetectionState() )
+
+  def close( self ):
+    with self.lock:
+      idle, self.idle = self.idle, []
+    for conn in idle:
+      self.close_connection( conn )
+
+
+class WebControlClient( BaseClient ):
+
+  queue_class = RequestQueue
+
+  def request( self, path, timeout = None, idempotent = False, priority = None ):
+    self.check_path( path )
+    start = time.perf_counter()
+    try:
+      body = self.dispatch( path, timeout, idempotent, priority_of( path ) if priority is None else priority )
+    except Exception as err:
+      self.metrics.failed( path, time.perf_counter() - start, err )
+      raise
+    self.metrics.record( path, time.perf_counter() - start, len( body ) )       # bytes as read off the wire
+    return body.decode( 'utf-8' )
+
+  def dispatch( self, path, timeout, idempotent, priority ):
+    ticket, leader = self.queue.join( path, priority )
+    if not leader: return ticket.wait()
+
+    try:
+      body = self.call( path, timeout, idempotent, ticket )
+    except BaseException as err:
+      self.queue.leave( ticket )
+      ticket.finish( None, err )
+      raise
+    ticket.finish( body, None )
+    return body
+
+  def call( self, path, timeout, idempotent, ticket ):
+    breaker  = self.admit( path )
+    attempts = self.attempts( idempotent )
+    deadline = self.deadline( timeout )
+    for attempt in range( attempts ):
+      try:
+        body = self.exchange( ticket, max( 0.001, deadline - time.monotonic() ) )    # 0 would make the socket non-blocking
+      except WebControlError:
+        breaker.success()                                     # motion answered, the camera is up
+        raise
+      except TRANSPORT_ERRORS as err:
+        delay = self.retry_delay( breaker, err, attempt, attempts, deadline )
+        if delay is None: raise
+        time.sleep( delay )
+        continue
+      breaker.success()
+      return body
+
+  def exchange( self, ticket, timeout ):
+    path = ticket.path
+    self.queue.acquire( ticket, timeout )
+    try:
+      conn, reused = self.acquire()
+      try:
+        status, body, keep = self.send( conn, path, timeout )
+      except TRANSPORT_ERRORS:
+        self.discard( conn )
+        if not reused: raise
+
+        # The server closed an idle keep-alive socket under us.  Retry once on a fresh connection
+        conn, reused = self.connect(), False
+        try:
+          status, body, keep = self.send( conn, path, timeout )
+        except TRANSPORT_ERRORS:
+          self.discard( conn )
+          raise
+
+      # The body has been read in full, so an error response still leaves the connection usable
+      if keep: self.release( conn )
+      else:    self.discard( conn )
+    finally:
+      self.queue.release()
+
+    if status >= 400:
+      raise WebControlError( "{} returned HTTP {}".format( path, status ) )
+    return body
+
+  def send( self, conn, path, timeout ):
+    conn.timeout = timeout
+    if conn.sock: conn.sock.settimeout( timeout )
+    conn.request( "GET", path, headers = { "Connection" : "keep-alive" } )
+    response = conn.getresponse()
+    body     = response.read()
+    self.count( "requests" )
+    return response.status, body, not response.will_close
+
+  def sync_detection( self, path ):
+    # Sends the start or pause camera thread `path` needs to match its DetectionState, if any
+    state = self.detection( path )
+    while True:
+      active = state.next_transition()
+      if active is None: return
+      try:
+        self.request( path + ( 'detection/start' if active else 'detection/pause' ), idempotent = True )
+      except:
+        state.failed()
+        raise
+      state.sent( active )
+
+  #########################################################
+  def acquire( self ):
+    with self.lock:
+      if self.idle:
+        self.stats[ "reused" ] += 1
+        return self.idle.pop(), True
+    return self.connect(), False
+
+  def connect( self ):
+    self.count( "opened" )
+    return http.client.HTTPConnection( self.host, self.port, timeout = self.timeout )
+
+  def close_connection( self, conn ):
+    conn.close()
+
+
+##################################################
+class AsyncWebControlClient( BaseClient ):
+
+  queue_class = AsyncRequestQueue
+
+  async def request( self, path, timeout = None, idempotent = False, priority = None ):
+    self.check_path( path )
+    start = time.perf_counter()
+    try:
+      body = await self.dispatch( path, timeout, idempotent, priority_of( path ) if priority is None else priority )
+    except Exception as err:
+      self.metrics.failed( path, time.perf_counter() - start, err )
+      raise
+    self.metrics.record( path, time.perf_counter() - start, len( body ) )       # bytes as read off the wire
+    return body.decode( 'utf-8' )
+
+  async def dispatch( self, path, timeout, idempotent, priority ):
+    ticket, leader = self.queue.join( path, priority )
+    if not leader: return await asyncio.shield( ticket.future )
+
+    try:
+      body = await self.call( path, timeout, idempotent, ticket )
+    except BaseException as err:
+      self.queue.leave( ticket )
+      ticket.finish( None, err if isinstance( err, Exception ) else WebControlError( "queued request was cancelled" ) )
+      raise
+    ticket.finish( body, None )
+    return body
+
+  async def call( self, path, timeout, idempotent, ticket ):
+    breaker  = self.admit( path )
+    attempts = self.attempts( idempotent )
+    deadline = self.deadline( timeout )
+    for attempt in range( attempts ):
+      try:
+        body = await asyncio.wait_for( self.exchange( ticket ), deadline - time.monotonic() )
+      except WebControlError:
+        breaker.success()
+        raise
+      except TRANSPORT_ERRORS as err:
+        delay = self.retry_delay( breaker, err, attempt, attempts, deadline )
+        if delay is None: raise
+        await asyncio.sleep( delay )
+        continue
+      breaker.success()
+      return body
+
+  async def exchange( self, ticket ):
+    path = ticket.path
+    await self.queue.acquire( ticket )
+    try:
+      conn, reused = await self.acquire()
+      try:
+        status, body, keep = await self.send( conn, path )
+      except TRANSPORT_ERRORS:
+        self.discard( conn )
+        if not reused: raise
+
+        # The server closed an idle keep-alive socket under us.  Retry once on a fresh connection
+        conn = await self.connect()
+        try:
+          status, body, keep = await self.send( conn, path )
+        except TRANSPORT_ERRORS:
+          self.discard( conn )
+          raise
+      except asyncio.CancelledError:
+        self.discard( conn )                                  # deadline hit mid response, the socket is unusable
+        raise
+
+      # The body has been read in full, so an error response still leaves the connection usable
+      if keep: self.release( conn )
+      else:    self.discard( conn )
+    finally:
+      self.queue.release()
+
+    if status >= 400:
+      raise WebControlError( "{} returned HTTP {}".format( path, status ) )
+    return body
+
+  async def send( self, conn, path ):
+    reader, writer = conn
+    writer.write( "GET {} HTTP/1.1\r\nHost: {}:{}\r\nConnection: keep-alive\r\n\r\n".format( path, self.host, self.port ).encode( 'ascii' ) )
+    await writer.drain()
+
+    status, headers = await read_head( reader )
+    body, keep      = await read_body( reader, headers )
+    self.count( "requests" )
+    return status, body, keep
+
+  async def sync_detection( self, path ):
+    # As WebControlClient.sync_detection.  A cancelled call releases the claim too, or it would be held for good
+    state = self.detection( path )
+    while True:
+      active = state.next_transition()
+      if active is None: return
+      try:
+        await self.request( path + ( 'detection/start' if active else 'detection/pause' ), idempotent = True )
+      except:
+        state.failed()
+        raise
+      state.sent( active )
+
+  #########################################################
+  async def acquire( self ):
+    while self.idle:
+      conn = self.idle.pop()
+      if conn[0].at_eof():                  # closed by the server while idle
+        self.discard( conn )
+        continue
+      self.count( "reused" )
+      return conn, True
+    return await self.connect(), False
+
+  async def connect( self ):
+    self.count( "opened" )
+    return await asyncio.open_connection( self.host, self.port )
+
+  def close_connection( self, conn ):
+    conn[1].close()
+
+
+async def read_head( reader ):
+  status_line = await reader.readline()
+  if not status_line: raise http.client.RemoteDisconnected( "connection closed before response" )
+
+  parts = status_line.decode( 'latin-1' ).split( None, 2 )
+  if len( parts ) < 2 or not parts[0].startswith( "HTTP/" ):
+    raise http.client.BadStatusLine( status_line )
+
+  headers = { "version" : parts[0] }
+  while True:
+    line = await reader.readline()
+    if line in ( b"\r\n", b"\n", b"" ): break
+    name, _, value = line.decode( 'latin-1' ).partition( ":" )
+    headers[ name.strip().lower() ] = value.strip()
+
+  return int( parts[1] ), headers
+
+async def read_body( reader, headers ):
+  connection = headers.get( "connection", "" ).lower()
+  keep       = connection == "keep-alive" or ( headers[ "version" ] == "HTTP/1.1" and connection != "close" )
+
+  if "chunked" in headers.get( "transfer-encoding", "" ).lower():
+    chunks = []
+    while True:
+      size = int( ( await reader.readline() ).split( b";" )[0], 16 )
+      if size == 0: break
+      chunks.append( await reader.readexactly( size ) )
+      await reader.readexactly( 2 )
+    while ( await reader.readline() ) not in ( b"\r\n", b"\n", b"" ): pass     # trailers
+    return b"".join( chunks ), keep
+
+  if "content-length" in headers:
+    return await reader.readexactly( int( headers[ "content-length" ] ) ), keep
+
+  # No framing ... the body runs to the end of the connection
+  return await reader.read(), False
+
+
+##################################################
+class PropertyCache( object ):
+
+  DEFAULT_TTL = 60
+
+  def __init__( self, ttl = None ):
+    self.ttl     = self.DEFAULT_TTL if ttl is None else ttl
+    self.entries = {}                                         # name -> ( value, time stored )
+    self.lock    = threading.Lock()
+    self.stats   = { "hits" : 0, "misses" : 0, "skipped_writes" : 0 }
+
+  def get( self, name ):
+    # Returns ( True, value ) for a fresh entry, ( False, None ) when the caller has to go to the camera
+    with self.lock:
+      entry = self.entries.get( name )
+      if entry is not None and time.monotonic() - entry[1] < self.ttl:
+        self.stats[ "hits" ] += 1
+        return True, entry[0]
+      self.stats[ "misses" ] += 1
+      return False, None
+
+  def put( self, name, value ):
+    with self.lock:
+      self.entries[ name ] = ( value, time.monotonic() )
+
+  def seed( self, values ):
+    now = time.monotonic()
+    with self.lock:
+      for name in values:
+        self.entries[ name ] = ( values[ name ], now )
+
+  def unchanged( self, name, value ):
+    # True when a write of value would not change what the camera already has
+    with self.lock:
+      entry = self.entries.get( name )
+      if entry is None or time.monotonic() - entry[1] >= self.ttl: return False
+      if entry[0] != value: return False
+      self.stats[ "skipped_writes" ] += 1
+      return True
+
+  def invalidate( self, name = None ):
+    with self.lock:
+      if name is None: self.entries.clear()
+      else:            self.entries.pop( name, None )
+
+
+class DetectionState( object ):
+
+  def __init__( self ):
+    self.desired = None                                       # what the user asked for, None until first known
+    self.actual  = None                                       # what the camera last confirmed, None when unknown
+    self.holds   = 0                                          # stabilisation pauses in progress
+    self.sending = None                                       # transition currently on the wire
+    self.lock    = threading.Lock()
+    self.stats   = { "transitions" : 0, "holds" : 0, "drift" : 0 }
+
+  def target( self ):
+    # State the camera should be in right now:  paused while any hold is taken, otherwise what the user asked for
+    with self.lock:
+      return False if self.holds else self.desired
+
+  def want( self, active ):
+    with self.lock:
+      self.desired = bool( active )
+
+  def hold( self ):
+    with self.lock:
+      self.holds += 1
+      self.stats[ "holds" ] += 1
+
+  def release( self ):
+    with self.lock:
+      self.holds = max( 0, self.holds - 1 )
+
+  def busy( self ):
+    with self.lock:
+      return self.holds > 0 or self.sending is not None
+
+  def next_transition( self ):
+    # The start ( True ) or pause ( False ) the camera needs to reach the target, or None.  The caller owns the
+    # transition until it reports sent() or failed();  anyone else asking meanwhile gets None
+    with self.lock:
+      target = False if self.holds else self.desired
+      if target is None or target == self.actual or self.sending is not None: return None
+      self.sending = target
+      return target
+
+  def sent( self, active ):
+    with self.lock:
+      self.actual  = active
+      self.sending = None
+      self.stats[ "transitions" ] += 1
+
+  def failed( self ):
+    with self.lock:
+      self.actual  = None                                     # the camera may or may not have switched
+      self.sending = None
+
+  def observe( self, active ):
+    # Records a detection/status read.  Adopts it as the wanted state the first time;  returns True when the camera
+    # was not in the state we believed it to be
+    with self.lock:
+      drift = self.actual is not None and self.actual != active
+      if drift: self.stats[ "drift" ] += 1
+      self.actual = active
+      if self.desired is None: self.desired = active
+      return drift
+
+
+##################################################
+_clients      = {}
+_clients_lock = threading.Lock()
+
+def split_url( url ):
+  # "http://camera:7999/1/" -> ( "camera", 7999, "/1/" )
+  parts = urllib.parse.urlsplit( url )
+  path  = parts.path or "/"
+  if not path.endswith( "/" ): path = path + "/"
+  return parts.hostname, parts.port or DEFAULT_PORT, path
+
+def get_client( url, pool_size = DEFAULT_POOL_SIZE, **options ):
+  # Returns the shared client for the url's host along with the camera path prefix ( e.g. "/1/" ).  pool_size and
+  # options ( timeout, retries ) only take effect for the first caller, which creates the client
+  return _get_client( WebControlClient, url, pool_size, options )
+
+def get_async_client( url, pool_size = DEFAULT_POOL_SIZE, **options ):
+  # As get_client(), for apps running on the event loop
+  return _get_client( AsyncWebControlClient, url, pool_size, options )
+
+def _get_client( cls, url, pool_size, options ):
+  host, port, path = split_url( url )
+  with _clients_lock:
+    client = _clients.get( ( host, port, cls ) )
+    if client is None:
+      client = cls( host, port, pool_size, **options )
+      _clients[ ( host, port, cls ) ] = client
+    client.users += 1
+  return client, path
+
+def release_client( client ):
+  with _clients_lock:
+    client.users -= 1
+    if client.users > 0: return
+    _clients.pop( ( client.host, client.port, type( client ) ), None )
+  client.close()
@@ -4,9 +4,19 @@ from datetime import datetime
 from datetime import timedelta
 from enum import Enum
 
-import urllib.request
+import asyncio
 import json
-import re
+import os
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import motion_events
+import motion_parse
+import motion_stream
+import motion_webcontrol
 
 ##################################################
 # MotionEye camera control
@@ -38,6 +48,29 @@ import re
 # Available App input parameters:
 # --------------------------------
 #  URL               [ required ] :  Url to the camera.  This should include the API port and the camera instance number.  E.g. http://camera:7999/1/
+#  update_interval   [ optional ] :  Minimum seconds between property writes driven by the UI sliders [ default = 0.5 ]
+#  stabilise_time    [ optional ] :  Seconds motion detection stays paused after an image setting changes [ default = 2 ]
+#  detection_reconcile [ optional ]: Seconds between checks that the camera's detection state still matches ours [ default = 300 ].  0 turns it off
+#  cache_ttl         [ optional ] :  Seconds a cached camera setting is trusted before it is read back from the camera [ default = 60 ]
+#  pool_size         [ optional ] :  Maximum number of keep-alive connections held open to the motion host [ default = 2 ].  The pool is shared by
+#                                    every app pointing at the same host, so the first app to start up sets the size
+#  timeout           [ optional ] :  Deadline in seconds for each webcontrol request, retries included [ default = 5 ]
+#  retries           [ optional ] :  Extra attempts for idempotent requests ( reads, config/set, detection ) [ default = 2 ]
+#  failure_threshold [ optional ] :  Consecutive failed attempts ( retries count ) before the camera is treated as down and calls fail fast [ default = 3 ]
+#  reset_timeout     [ optional ] :  Seconds between background probes while the camera is down [ default = 30 ]
+#  link_sensor       [ optional ] :  HASS sensor the connection state ( closed / open / half_open ) is published to.
+#                                    Defaults to sensor.<camera>_link when entity_id is set
+#  stream_url        [ optional ] :  Url of the camera's MJPEG stream.  Defaults to the camera host on motion's configured stream_port
+#  snapshot_dir      [ optional ] :  Directory ( on the AppDaemon host ) that fetched frames are written to.  Without it frames are
+#                                    kept in an in-memory ring buffer ( self.frames ) for other apps to read
+#  ring_size         [ optional ] :  Number of frames held in the in-memory ring buffer [ default = 4 ]
+#  frame_entity      [ optional ] :  HASS entity updated with the path of each frame written to snapshot_dir.  A local_file camera is pointed at the
+#                                    new file, any other entity has its state set to the path
+#  metrics_interval  [ optional ] :  Seconds between publishes of the webcontrol metrics [ default = 60 ].  0 turns publishing off
+#  metrics_sensor    [ optional ] :  Prefix of the per endpoint metric sensors;  sensor.kitchen_webcontrol publishes sensor.kitchen_webcontrol_config_set
+#                                    and so on.  Defaults to sensor.<camera>_webcontrol when entity_id is set
+#  metrics_file      [ optional ] :  JSON file ( on the AppDaemon host ) the metrics are also written to on every publish and at shutdown, for
+#                                    offline profiling.  Use one file per camera
 #  entity_id         [ optional ] :  HASS entity associated with the camera.  This is required to enable binding to events (see below)
 #  brightness_entity [ optional ] :  HASS input_number entity to bind to for image brightness value.  Numbers are remapped from motion's 0-255 scale to a 0-100 scale
 #  contrast_entity   [ optional ] :  HASS input_number entity to bind to for image contrast value. Numbers are remapped from motion's 0-255 scale to a 0-100 scale
@@ -45,27 +78,76 @@ import re
 #  saturation_entity [ optional ] :  HASS input_number entity to bind to for image saturation value. Numbers are remapped from motion's 0-255 scale to a 0-100 scale
 #  threshold_entity  [ optional ] :  HASS input_number entity to bind to for motion detection threshold value. Numbers is number of pixels
 #  detection_entity  [ optional ] :  HASS input_boolean entity to bind to for image contrast value. 
+#  monitor_stream    [ optional ] :  Watch the camera's MJPEG stream in the background and publish its health [ default = False ]
+#  stall_timeout     [ optional ] :  Seconds without a frame before the stream counts as stalled [ default = 10 ]
+#  health_interval   [ optional ] :  Seconds between updates of the stream health sensors [ default = 10 ]
+#  stream_sensor     [ optional ] :  Object id the stream health entities are named after [ default = <camera>_stream ], giving
+#                                    sensor.<camera>_stream_fps, sensor.<camera>_stream_gap and binary_sensor.<camera>_stream_stalled
+#  event_port        [ optional ] :  Port to receive motion's event hooks on ( see MOTION EVENTS below ).  Leave out to not listen for events
+#  event_host        [ optional ] :  Address the event listener binds to [ default = 0.0.0.0 ]
+#  event_name        [ optional ] :  Camera name the hooks use in their url [ default = object id of entity_id, otherwise the app name ]
+#  motion_sensor     [ optional ] :  binary_sensor turned on / off by motion's event start / end hooks [ default = binary_sensor.<camera>_motion ]
+#  presets           [ optional ] :  Named sets of properties that can be applied in one go with the motion_preset event, e.g.
+#
+#                                      presets:
+#                                        night: { brightness: 160, contrast: 90, threshold: 3000, detection: on }
+#                                        day:   { brightness: 110, contrast: 64, threshold: 1500 }
+#
+#                                    Values are in motion's own units, as for motion_prop_changed.  detection turns motion detection on or off
+#
+#  Start up is split in two.  initialize only checks the configuration and registers the listeners, so AppDaemon boots and
+#  reloads without waiting on any camera.  The warm-up then runs in the background:  the camera's whole
+#  configuration is read in a single config/list request along with its detection state, and used to fill the bound entities.  Cameras
+#  warm up in parallel rather than one after another.  A warm-up that fails, whether the camera cannot be reached or its answers
+#  cannot be used, is retried in the background until it succeeds.
+#  The time taken by initialize and by each warm-up phase is logged.
+#
+#  Camera settings are cached locally.  Writes go through the cache, so writing a value the camera already has never reaches the
+#  network, and reads are only sent to the camera once the cached value is older than cache_ttl.
+#
+#  Detection is driven by a local state machine ( motion_webcontrol.DetectionState ) shared by every app on the same camera.  The UI,
+#  events and the stabilisation pauses only change the wanted state;  a start or pause is sent only when the camera has to move.  The
+#  camera's real state is read on start up and every detection_reconcile seconds, and put right if something else changed it.
 #
 #  With valid HASS entities passed through the yaml configuration, the motion daemon's settings will be updated as values in the UI are changed.  This allows for live 
 #  updating the values from the UI.  For image related properties( brightness, contrast, hue, saturation ), the values are expected to be in the range of 0:100 from the UI.
-#  They are then remapped to the 0:255 range expected by motion.  Updating these values via the HASS entities also causes motion detection to be paused for 2s after the setting
-#  update.  This is designed to allow the image to stabilize and not cause a false alarm.
+#  They are then remapped to the 0:255 range expected by motion.  Updating these values via the HASS entities also causes motion detection to be paused for stabilise_time after the
+#  setting update.  This is designed to allow the image to stabilize and not cause a false alarm.  Overlapping pauses are counted, detection resumes once the last one ends.
+#
+#  Every webcontrol call is timed per endpoint ( config/get, config/set, detection/status ... ).  Each endpoint the camera has used gets a
+#  sensor whose state is the mean call time in ms, with the call count, errors, timeouts, calls refused while the camera was down, bytes
+#  read, p50 / p99 / max and the latency histogram as attributes.  Sensors are only updated when there were new calls.  The motion host's
+#  request queue is published alongside as <metrics_sensor>_queue:  the number of requests waiting, with the most seen waiting at once,
+#  how many had to wait, the mean wait and how many were answered by an identical queued request.
+#
+#  Slider changes are coalesced: while a slider is dragged only the latest value of each property is kept, and at most one batch of
+#  writes is sent per update_interval.  Every property changed within the same window is written under a single detection pause.
 #
 #  EVENT calls
 #  --------------------------------
-#  The motion daemon can also be interacted with via HASS events.  There are three events this daemon binds to and listens for:
+#  The motion daemon can also be interacted with via HASS events.  There are five events this daemon binds to and listens for:
 #
 #  motion_snapshot
-#    This event causes the camera to capture (and store locally) a single snapshot frame.
+#    This event causes the camera to capture (and store locally) a single snapshot frame.  When snapshot_dir is
+#    configured the latest frame is also pulled from the camera's stream into it and handed to HASS through frame_entity.
 # 
 #    event data:
 #      entity_id : entity ID of the camera to trigger.  An ID of "ALL" will cause all cameras to trigger
 #
+#  motion_grab_frames
+#    This event reads frames from the camera's MJPEG stream into snapshot_dir ( rotating through count files ) or the ring buffer
+#
+#    event data:
+#      entity_id : entity ID of the camera
+#      count     : number of frames to grab [ default = 1 ]
+#
 #
 #  motion_prop_changed
 #    This event updates an arbitrary property within the motion daemon.  It is a direct connection to the motion web API.  Property names and values are passed in the event data
 #    as key->value pairs.  Values are not rescaled and need to be validated against the motion web API documentation ( https://motion-project.github.io/motion_config.html#Configuration_OptionsAlpha ).
 #    For properties that also have a corrisponding registerd hass entity, the hass entity will be updated with the new value.  Any changes made via the event call will be reflected live in the UI
+#    All properties in the event are applied as one batch:  values the camera already has are skipped and detection is paused once for the whole set.
+#    When done a motion_props_applied event is fired with the camera's entity_id and the lists of applied and failed properties.
 #
 #    event data:
 #      entity_id     :  entity ID of the camera to update
@@ -80,13 +162,109 @@ import re
 #      entity_id  :  entity ID of the camera to update
 #      enabled    : [ True | False ]         
 #
+#  motion_preset
+#    This event applies one of the presets from the app config as a single batch ( see motion_prop_changed )
+#
+#    event data:
+#      entity_id  :  entity ID of the camera to update.  An ID of "ALL" applies the preset to every camera that has it
+#      preset     :  name of the preset
+#
+#  MOTION EVENTS
+#  --------------------------------
+#  With event_port set the app listens for motion's own event hooks, shared with every other camera app using the same port
+#  ( see motion_events.py ).  Point the hooks in the camera's motion config at it:
+#
+#    on_event_start  curl -s "http://appdaemon:8099/kitchen/start"
+#    on_event_end    curl -s "http://appdaemon:8099/kitchen/end"
+#    on_picture_save curl -s "http://appdaemon:8099/kitchen/picture?file=%f"
+#
+#  or send a UDP datagram "kitchen start", which avoids starting curl for every event.  start and end switch motion_sensor on and off,
+#  and every hook is fired on to HASS as a motion_event event with entity_id, type ( start, end, picture ... ), received ( unix time )
+#  and data, holding the hook's query parameters ( e.g. { "file" : "/var/lib/motion/01-20240101.jpg" } ).
+#
+#  STREAM HEALTH
+#  --------------------------------
+#  With monitor_stream on, the camera's MJPEG stream ( stream_url ) is kept open and its frames counted, without decoding them.  The
+#  frame rate and the average and longest gap between frames ( ms ) are published every health_interval.  The stalled binary_sensor
+#  switches as soon as no frame has arrived for stall_timeout, and a motion_stream_stalled or motion_stream_resumed event is fired
+#  with the camera's entity_id.  Every monitor in the process shares one background thread ( see motion_stream.StreamMonitor ).
+#
+#  ASYNC mode
+#  --------------------------------
+#  MotionEyeAsync takes the same configuration as MotionEye, but runs its webcontrol calls and callbacks as coroutines on
+#  the AppDaemon event loop.  A slow or unreachable camera then only parks a coroutine rather than tying up a worker thread
+#  for the whole socket timeout, and any number of cameras can be driven concurrently.  MotionEye remains the synchronous
+#  fallback.
+#
+#  kitchen_camera:
+#    module: motioneye
+#    class: MotionEyeAsync
+#    URL:               "http://192.168.1.10:7999/1/"
+#
+#  FLEET mode
+#  --------------------------------
+#  MotionEyeFleet drives many cameras ( and motion daemons ) from a single app.  Cameras are grouped by motion host and the
+#  motion_snapshot, motion_det_mode_changed and motion_prop_changed events are fanned out concurrently, one task per host, through
+#  a bounded worker pool.  Operations addressed to "ALL" cameras use motion's thread 0 endpoint, which applies an action or detection
+#  command to every camera on the host in a single request, as long as no camera on the host is paused for stabilisation or already
+#  switching.  Image settings pause detection for stabilise_time as in the single camera apps.  entity_id may also be a list of cameras.
+#
+#  Use the fleet in place of per camera MotionEye apps for these events, otherwise each camera will be triggered twice.
+#
+#  house_cameras:
+#    module: motioneye
+#    class: MotionEyeFleet
+#    workers: 4                                      [ optional, default = 4 ]
+#    stabilise_time: 2                               [ optional, default = 2 ]
+#    cameras:
+#      camera.kitchen: "http://192.168.1.10:7999/1/"
+#      camera.garage:  "http://192.168.1.10:7999/2/"
+#      camera.porch:
+#        URL:              "http://192.168.1.11:7999/1/"
+#        detection_entity: input_boolean.porch_detection
+#
 ############################################################### 
 
+IMAGE_PROPS      = ( 'brightness', 'contrast', 'hue', 'saturation' )    # properties that need a detection pause while the image settles
+
+# property -> ( entity arg, validity flag, scale from motion's value to the entity's )
+PROP_ENTITIES = { 'brightness' : ( 'brightness_entity', 'bright_valid',   100 / 255 ),
+                  'contrast'   : ( 'contrast_entity',   'contrast_valid', 100 / 255 ),
+                  'hue'        : ( 'hue_entity',        'hue_valid',      100 / 255 ),
+                  'saturation' : ( 'saturation_entity', 'sat_valid',      100 / 255 ),
+                  'threshold'  : ( 'threshold_entity',  'thresh_valid',   1 ) }
+WEBCONTROL_ERRORS = ( motion_webcontrol.WebControlError, ) + motion_webcontrol.TRANSPORT_ERRORS
+STREAM_ERRORS     = WEBCONTROL_ERRORS + ( motion_stream.StreamError, )
+
+
+def motion_value( value ):
+  # A value as motion will report it back once set, e.g. "on" -> True, 128.0 -> 128.0, "" -> None
+  return motion_parse.parse_value( motion_parse.format_value( value ) )
+
+def image_value( new ):
+  # An image slider's 0-100 value on motion's 0-255 scale
+  return round( float( new ) / 100 * 255 )
+
+def event_props( data ):
+  # The property -> value pairs of a motion_prop_changed event
+  return { name : data[ name ] for name in data if name != 'entity_id' }
+
+def parse_enabled( value ):
+  # motion_det_mode_changed's enabled -> True, False, or None when it is neither
+  value = str( value )
+  if value in ( 'True', 'true', 'On', 'on', '1' ):    return True
+  if value in ( 'False', 'false', 'Off', 'off', '0' ): return False
+  return None
+
+
 class MotionEye( hass.Hass ):
 
   def initialize( self ):
 
     self.log("Motioneye starting up")
+    self.started  = time.monotonic()
+    self.warm     = None                   # None while the first warm-up runs, then whether the camera state is loaded
+    self.ready_at = None
    
     ## Validate inputs
     self.url_valid = False
@@ -100,7 +278,16 @@ class MotionEye( hass.Hass ):
       self.entity_registered = True
       self.log("Using {} as entity ID for registering event calls".format( self.entity_id ) )
 
-    self.det_start_scheduler = None
+    self.snapshot_dir = self.args.get( "snapshot_dir" )
+    self.frame_entity = self.args.get( "frame_entity" )
+    self.frames       = motion_stream.FrameRing( int( self.args.get( "ring_size", 4 ) ) )
+
+    self.update_interval = float( self.args.get( "update_interval", 0.5 ) )
+    self.stabilise_time  = float( self.args.get( "stabilise_time", 2 ) )
+    self.pending_props   = {}              # property -> latest value waiting to be written
+    self.pending_lock    = threading.Lock()
+    self.flush_due       = False           # a flush is scheduled
+    self.last_flush      = 0
 
     self.bright_valid   = self.validate_param("brightness_entity", "input_number",  False )
     self.contrast_valid = self.validate_param("contrast_entity"  , "input_number",  False )
@@ -108,11 +295,16 @@ class MotionEye( hass.Hass ):
     self.sat_valid      = self.validate_param("saturation_entity", "input_number",  False )
     self.det_valid      = self.validate_param("detection_entity" , "input_boolean", False )
     self.thresh_valid   = self.validate_param("threshold_entity" , "input_number",  False )
+    self.presets        = self.args.get( "presets" ) or {}
 
     should_run = True
     if self.url_valid:
       self.log( "Camera URL set to {}".format( self.args[ "URL" ] ) )
       self.base_url = self.args["URL"]
+      self.client, self.base_path = self.open_client()
+      self.cache = self.client.cache( self.base_path, self.args.get( "cache_ttl" ) )
+      self.breaker = self.client.breaker( self.base_path, int( self.args.get( "failure_threshold", 3 ) ), float( self.args.get( "reset_timeout", 30 ) ) )
+      self.detection = self.client.detection( self.base_path )
     else:
       should_run = False
 
@@ -132,20 +324,49 @@ class MotionEye( hass.Hass ):
       self.log( "Detection entity set to {}".format( self.args[ "detection_entity" ] ) )
 
     if self.thresh_valid:
-      self.log( "Threshold entity set to {}".format( self.args[ "thrshold_entity" ] ) )
+      self.log( "Threshold entity set to {}".format( self.args[ "threshold_entity" ] ) )
 
     #########################################
     ## Set up callbacks
     if should_run:
       self.log( "Configuration Valid .... initializing" )
 
-      ##Update the UI with the current value
-      if self.bright_valid:   self.set_value( self.args["brightness_entity"], self.get_brightness()/255 * 100 )
-      if self.contrast_valid: self.set_value( self.args["contrast_entity"  ], self.get_contrast()  /255 * 100 )
-      if self.hue_valid:      self.set_value( self.args["hue_entity"       ], self.get_hue()       /255 * 100 )
-      if self.sat_valid:      self.set_value( self.args["saturation_entity"], self.get_saturation()/255 * 100 )
-      if self.det_valid:      self.set_value( self.args["detection_entity" ], self.get_det_mode()             )
-      if self.thresh_valid:   self.set_value( self.args["threshold_entity" ], self.get_threshold()            )
+      ##Publish the connection state and probe the camera while it is down
+      self.link_state  = None
+      self.link_sensor = self.args.get( "link_sensor" )
+      if not self.link_sensor and self.entity_registered:
+        self.link_sensor = "sensor.{}_link".format( self.entity_id.split( "." )[-1] )
+      self.link_timer = self.run_every( self.check_link, self.datetime() + timedelta( seconds = 1 ), 5 )
+
+      ##Publish the webcontrol metrics
+      self.metrics_calls  = {}             # endpoint -> calls at the last publish
+      self.queue_stats    = None           # host queue figures at the last publish
+      self.metrics_file   = self.args.get( "metrics_file" )
+      self.metrics_sensor = self.args.get( "metrics_sensor" )
+      if not self.metrics_sensor and self.entity_registered:
+        self.metrics_sensor = "sensor.{}_webcontrol".format( self.entity_id.split( "." )[-1] )
+      interval = float( self.args.get( "metrics_interval", 60 ) )
+      if interval > 0 and ( self.metrics_sensor or self.metrics_file ):
+        self.metrics_timer = self.run_every( self.publish_metrics, self.datetime() + timedelta( seconds = interval ), interval )
+
+      ##Watch the stream;  the monitor itself starts once the camera has told us its stream port
+      self.monitor        = None
+      self.stream_events  = None           # single worker thread publishing stalls and recoveries
+      self.monitor_stream = bool( self.args.get( "monitor_stream", False ) )
+      if self.monitor_stream:
+        self.stall_timeout = float( self.args.get( "stall_timeout", 10 ) )
+        self.stream_sensor = self.args.get( "stream_sensor", "{}_stream".format( self.frame_name() ) )
+        interval           = float( self.args.get( "health_interval", 10 ) )
+        self.health_timer  = self.run_every( self.publish_health, self.datetime() + timedelta( seconds = interval ), interval )
+
+      ##Receive motion's event hooks
+      self.events = None
+      if "event_port" in self.args: self.start_events()
+
+      ##Check the camera's detection state now and then
+      reconcile = float( self.args.get( "detection_reconcile", 300 ) )
+      if reconcile > 0:
+        self.reconcile_timer = self.run_every( self.reconcile_detection, self.datetime() + timedelta( seconds = reconcile ), reconcile )
 
       ##Configure the listeners
       if self.bright_valid:   self.listen_state( self.change_brightness, self.args["brightness_entity"] )
@@ -160,45 +381,322 @@ class MotionEye( hass.Hass ):
       self.listeners["snapshot"   ]                             = self.listen_event( self.snapshot_CB, "motion_snapshot") 
       if self.entity_registered: self.listeners["update_prop"]  = self.listen_event( self.update_setting_event_CB, "motion_prop_changed"    , entity_id = self.entity_id )   
       if self.entity_registered: self.listeners["detection"  ]  = self.listen_event( self.det_mode_CB            , "motion_det_mode_changed", entity_id = self.entity_id )
+      if self.entity_registered: self.listeners["frames"     ]  = self.listen_event( self.grab_frames_CB         , "motion_grab_frames"     , entity_id = self.entity_id )
+      if self.presets:           self.listeners["preset"     ]  = self.listen_event( self.preset_CB              , "motion_preset" )
+
+      ##Update the UI with the current value, once everything the warm-up reads is in place
+      self.start_camera()
+
+      self.log( "Initialized in {:.0f}ms, camera state is loading in the background".format( ( time.monotonic() - self.started ) * 1000 ) )
+
+  ###########################################################
+  def open_client( self ):
+    return motion_webcontrol.get_client( self.base_url, **self.client_options() )
+
+  def client_options( self ):
+    return { "pool_size" : int( self.args.get( "pool_size", motion_webcontrol.DEFAULT_POOL_SIZE ) ),
+             "timeout"   : float( self.args.get( "timeout", motion_webcontrol.DEFAULT_TIMEOUT ) ),
+             "retries"   : int( self.args.get( "retries", motion_webcontrol.DEFAULT_RETRIES ) ) }
+
+  def start_camera( self ):
+    # Warm up from a worker thread so initialize returns straight away and cameras start up in parallel
+    self.run_in( self.warm_up, 0 )
+
+  def warm_up( self, kwargs = {} ):
+    timings = []
+    try:
+      self.seed_entities( timings )
+    except Exception as err:
+      self.warm_up_failed( err )
+      return
+    self.camera_ready( timings )
+
+  def warm_up_failed( self, err ):
+    # Any failure leaves the camera cold, so check_link retries the warm-up;  only the first is logged
+    # Some errors ( asyncio.TimeoutError ) have no message, their type is all there is to report
+    name = type( err ).__name__
+    if isinstance( err, WEBCONTROL_ERRORS ): reason, detail = "Camera not reachable", str( err ) or name
+    else:                                    reason, detail = "Camera warm-up failed", "{}: {}".format( name, err ) if str( err ) else name
+    if self.warm is not False: self.error( "{}, retrying in the background: {}".format( reason, detail ), level="WARNING" )
+    self.warm = False
+
+  def camera_ready( self, timings ):
+    self.warm = True
+    if self.ready_at is not None:
+      self.log( "Camera is reachable again" )
+      return
+    self.ready_at = time.monotonic()
+    self.log( "Camera ready {:.0f}ms after start up ( {} )".format( ( self.ready_at - self.started ) * 1000, ", ".join( timings ) ) )
+
+  def phase( self, timings, name, mark ):
+    now = time.monotonic()
+    timings.append( "{} {:.0f}ms".format( name, ( now - mark ) * 1000 ) )
+    return now
+
+  def seed_entities( self, timings ):
+    # motion serves a host's requests one at a time, so the config and detection reads go out back to back
+    mark   = time.monotonic()
+    config = self.get_config()
+    mark   = self.phase( timings, "config", mark )
+
+    self.cache.seed( config )
+    for entity, prop_name, scale in self.bound_entities():
+      self.set_value( entity, self.config_value( config, prop_name ) * scale )
+    mark = self.phase( timings, "entities", mark )
+
+    # Start up reconcile:  adopt the camera's detection state, or put it back to what was wanted before it went away
+    self.read_det_mode()
+    self.sync_detection()
+    self.show_detection( self.detection.desired )
+    mark = self.phase( timings, "detection", mark )
+
+    if self.monitor_stream and self.monitor is None:
+      try:
+        self.start_monitor( self.stream_url() )
+      except STREAM_ERRORS as err:
+        self.error( "Cannot monitor the stream: {}".format( err ), level="WARNING" )
+      self.phase( timings, "stream", mark )
+
+  def config_value( self, config, prop_name ):
+    # Fall back to a single property read for anything the config dump did not include
+    if prop_name in config: return config[ prop_name ]
+    return float( self.get_property( prop_name ) )
+
+  def bound_entities( self ):
+    # ( entity, property, scale from motion's value to the entity's ) of every valid entity bound to a camera property
+    return [ ( self.args[ entity_arg ], prop_name, scale ) for prop_name, ( entity_arg, valid, scale ) in PROP_ENTITIES.items() if getattr( self, valid ) ]
+
+  ###########################################################
+  def check_link( self, kwargs = {} ):
+    if self.warm_up_due(): self.warm_up()
+    self.publish_link()
+
+  def warm_up_due( self ):
+    # Retries a warm-up that could not reach the camera, and while the breaker is open probes the camera in the background
+    # and resyncs the UI once it answers again
+    if not ( self.breaker.probe_due() or ( self.warm is False and self.breaker.state == self.breaker.CLOSED ) ): return False
+    self.cache.invalidate()
+    return True
+
+  def publish_link( self ):
+    if self.link_changed(): self.set_state( self.link_sensor, state = self.link_state, attributes = self.link_attributes() )
+
+  def link_changed( self ):
+    if not self.link_sensor or self.breaker.state == self.link_state: return False
+    self.link_state = self.breaker.state
+    return True
+
+  def link_attributes( self ):
+    return { "camera"     : self.base_url,
+             "failures"   : self.breaker.failures,
+             "trips"      : self.breaker.trips,
+             "last_error" : self.breaker.last_error }
 
   ###########################################################
+  def start_monitor( self, url ):
+    if self.stream_events is None: self.stream_events = ThreadPoolExecutor( max_workers = 1 )
+    self.monitor = motion_stream.StreamMonitor( url, self.stall_timeout, self.stream_changed, self.client.timeout ).start()
+    self.log( "Monitoring stream {}".format( url ) )
+
+  def stream_changed( self, monitor ):
+    # Runs on the stream monitor's event loop thread as soon as the stream stalls or recovers.  AppDaemon would schedule
+    # API calls made there on that loop instead of its own, so the change is handed to a plain thread.  There is only one,
+    # so stalls and recoveries are published in the order they happened
+    self.stream_events.submit( self.publish_stream_change, monitor.stalled, monitor.url, monitor.last_error )
+
+  def publish_stream_change( self, stalled, url, error ):
+    try:
+      self.set_state( "binary_sensor.{}_stalled".format( self.stream_sensor ), state = "on" if stalled else "off",
+                      attributes = { "device_class" : "problem", "stream" : url, "last_error" : error } )
+      self.fire_event( "motion_stream_stalled" if stalled else "motion_stream_resumed",
+                       entity_id = self.entity_id if self.entity_registered else self.name, stream = url, error = error )
+    except Exception as err:
+      self.error( "Publishing the stream state failed: {}".format( err ), level="WARNING" )
+
+  def publish_health( self, kwargs = {} ):
+    for entity, state, attributes in self.health_states():
+      self.set_state( entity, state = state, attributes = attributes )
+
+  def health_states( self ):
+    # ( entity, state, attributes ) of each stream health sensor, from a fresh sample
+    if self.monitor is None: return []
+    health = self.monitor.sample()
+    return [ ( "sensor.{}_fps".format( self.stream_sensor ), health[ "fps" ], self.health_attributes( health, "fps" ) ),
+             ( "sensor.{}_gap".format( self.stream_sensor ), round( health[ "gap_avg" ] * 1000 ),
+               dict( self.health_attributes( health, "ms" ), max_gap = round( health[ "gap_max" ] * 1000 ) ) ) ]
+
+  def health_attributes( self, health, unit ):
+    return { "unit_of_measurement" : unit,
+             "stream"              : self.monitor.url,
+             "frames"              : health[ "frames" ],
+             "bytes"               : health[ "bytes" ],
+             "connected"           : health[ "connected" ],
+             "reconnects"          : health[ "reconnects" ] }
+
+  ###########################################################
+  def start_events( self ):
+    self.event_name    = str( self.args.get( "event_name", self.frame_name() ) )
+    self.motion_sensor = self.args.get( "motion_sensor", "binary_sensor.{}_motion".format( self.frame_name() ) )
+    self.motion_count  = 0
+    self.events        = motion_events.get_listener( int( self.args[ "event_port" ] ), self.args.get( "event_host", motion_events.DEFAULT_HOST ) )
+    self.events.register( self.event_name, self.motion_event )
+    self.log( "Listening for motion events for {} on port {}".format( self.event_name, self.events.port ) )
+
+  def motion_event( self, event, data ):
+    # Runs on the event listener's dispatcher thread, never on an AppDaemon worker
+    if event in ( "start", "end" ):
+      if event == "start": self.motion_count += 1
+      self.set_state( self.motion_sensor, state = "on" if event == "start" else "off",
+                      attributes = { "device_class" : "motion",
+                                     "camera"       : self.base_url,
+                                     "events"       : self.motion_count,
+                                     "last_event"   : data[ "received" ] } )
+    # The hook's query parameters go under data, so they cannot take the place of fire_event's own arguments ( namespace ... )
+    params = dict( ( key, data[ key ] ) for key in data if key != "received" )
+    self.fire_event( "motion_event", entity_id = self.entity_id if self.entity_registered else self.name, type = event,
+                     received = data[ "received" ], data = params )
+
+  ###########################################################
+  def publish_metrics( self, kwargs = {} ):
+    metrics = self.client.metrics.snapshot( self.base_path )
+    for entity, state, attributes in self.metric_states( metrics ):
+      self.set_state( entity, state = state, attributes = attributes )
+    if self.metrics_file: self.dump_metrics( metrics )
+
+  def metric_states( self, metrics ):
+    # ( entity, state, attributes ) of each metric sensor with something new to show
+    if not self.metrics_sensor: return []
+    states = [ ( self.metric_entity( endpoint ), round( metrics[ endpoint ][ "mean" ] * 1000, 1 ), self.metric_attributes( metrics[ endpoint ] ) )
+               for endpoint in self.updated_endpoints( metrics ) ]
+    queue = self.updated_queue()
+    if queue:
+      depth = queue.pop( "depth" )
+      states.append( ( self.metric_entity( "queue" ), depth, queue ) )
+    return states
+
+  def updated_queue( self ):
+    # Host request queue figures, or None when nothing changed since the last publish
+    queue = dict( self.client.queue.stats, depth = self.client.queue.depth() )
+    if queue == self.queue_stats: return None
+    self.queue_stats = dict( queue )
+    return { "depth"        : queue[ "depth" ],
+             "host"         : "{}:{}".format( self.client.host, self.client.port ),
+             "max_depth"    : queue[ "max_depth" ],
+             "queued"       : queue[ "queued" ],
+             "deduplicated" : queue[ "deduplicated" ],
+             "mean_wait_ms" : round( queue[ "waited" ] / queue[ "queued" ] * 1000, 1 ) if queue[ "queued" ] else 0.0 }
+
+  def updated_endpoints( self, metrics ):
+    updated = []
+    for endpoint in metrics:
+      calls = metrics[ endpoint ][ "calls" ] + metrics[ endpoint ][ "rejected" ]
+      if self.metrics_calls.get( endpoint ) == calls: continue
+      self.metrics_calls[ endpoint ] = calls
+      updated.append( endpoint )
+    return updated
+
+  def metric_entity( self, endpoint ):
+    # "config/get" -> sensor.kitchen_webcontrol_config_get
+    return "{}_{}".format( self.metrics_sensor, endpoint.replace( "/", "_" ) )
+
+  def metric_attributes( self, stats ):
+    return { "unit_of_measurement" : "ms",
+             "camera"              : self.base_url,
+             "calls"               : stats[ "calls" ],
+             "errors"              : stats[ "errors" ],
+             "timeouts"            : stats[ "timeouts" ],
+             "rejected"            : stats[ "rejected" ],
+             "bytes"               : stats[ "bytes" ],
+             "p50_ms"              : round( stats[ "p50" ] * 1000, 1 ),
+             "p99_ms"              : round( stats[ "p99" ] * 1000, 1 ),
+             "max_ms"              : round( stats[ "max" ] * 1000, 1 ),
+             "histogram"           : stats[ "histogram" ] }
+
+  def dump_metrics( self, metrics ):
+    # Written to a temp file and renamed so a reader never sees half a report
+    report = { "camera" : self.base_url, "time" : time.time(), "endpoints" : metrics }
+    try:
+      fd, tmp_path = tempfile.mkstemp( dir = os.path.dirname( os.path.abspath( self.metrics_file ) ), suffix = ".part" )
+      with os.fdopen( fd, "w" ) as f:
+        json.dump( report, f, indent = 2 )
+      os.replace( tmp_path, self.metrics_file )
+    except OSError as err:
+      self.error( "Writing metrics to {} failed: {}".format( self.metrics_file, err ), level="WARNING" )
+
+  ###########################################################
+  def addressed( self, data ):
+    # Whether an event is for this camera, by its entity_id or as ALL
+    target = data.get( "entity_id" )
+    return target == "ALL" or ( self.entity_registered and target == self.entity_id )
+
   def snapshot_CB( self, event_name, data, kwargs ):
-    #check if we should fire
-    if 'entity_id' in data:
-      should_fire = False
-      if data["entity_id"] == "ALL":                                      should_fire = True
-      if self.entity_registered and data["entity_id"] == self.entity_id:  should_fire = True
-      if should_fire:
-        self.log("Snapshot triggered")
-        self.trigger_snapshot()        
+    if not self.addressed( data ): return
+    self.log("Snapshot triggered")
+    try:
+      self.trigger_snapshot()
+      if self.snapshot_dir: self.fetch_frames( 1 )
+    except STREAM_ERRORS as err:
+      self.error( "Snapshot failed: {}".format( err ), level="WARNING" )
+
+  def grab_frames_CB( self, event_name, data, kwargs ):
+    try:
+      self.fetch_frames( int( data.get( "count", 1 ) ) )
+    except STREAM_ERRORS as err:
+      self.error( "Frame grab failed: {}".format( err ), level="WARNING" )
   
   #############################################################
   def update_setting_event_CB( self, event_name, data, kwargs ):
-    for item in data:
-      propName = item
-      propVal  = data[item]
-      if propName == 'entity_id': continue
-
-      success  = self.set_property( propName, propVal )
-      if success:
-        if propName == 'brightness' and self.bright_valid:   self.set_value( self.args["brightness_entity"], float(propVal)/255 * 100 )
-        if propName == 'contrast'   and self.contrast_valid: self.set_value( self.args["contrast_entity"  ], float(propVal)/255 * 100 )
-        if propName == 'hue'        and self.hue_valid:      self.set_value( self.args["hue_entity"       ], float(propVal)/255 * 100 )
-        if propName == 'saturation' and self.sat_valid:      self.set_value( self.args["saturation_entity"], float(propVal)/255 * 100 )
-        if propName == 'threshold'  and self.thresh_valid:   self.set_value( self.args["threshold_entity" ], float(propVal)           )
-      else: self.error("{} is not a valid property".format(propName))
-      
+    results = self.apply_properties( event_props( data ) )
+    self.report_results( results )
+
+  def preset_CB( self, event_name, data, kwargs ):
+    preset = self.preset_for( data )
+    if preset is None: return
+
+    props, detection = preset
+    results = self.apply_properties( props )
+    if detection is not None:
+      try:
+        self.set_det_mode( detection )
+        self.show_detection( self.detection.desired )
+        results[ 'detection' ] = True
+      except WEBCONTROL_ERRORS as err:
+        self.error( "Setting detection failed: {}".format( err ), level="WARNING" )
+        results[ 'detection' ] = False
+    self.report_results( results )
+
+  def preset_for( self, data ):
+    # ( properties, detection or None ) of the preset a motion_preset event applies to this camera, or None
+    if not self.addressed( data ): return None
+
+    name = data.get( "preset" )
+    if name not in self.presets:
+      if data.get( "entity_id" ) != "ALL": self.error( "Unknown preset {}".format( name ), level="WARNING" )
+      return None
+
+    self.log( "Applying preset {}".format( name ) )
+    props     = dict( self.presets[ name ] )
+    detection = props.pop( 'detection', None )
+    return props, None if detection is None else motion_value( detection )
+
+  def report_results( self, results ):
+    event = self.results_event( results )
+    if event: self.fire_event( "motion_props_applied", **event )
+
+  def results_event( self, results ):
+    # Logs what could not be set;  returns the motion_props_applied event data, or None without an entity to report for
+    failed = [ name for name in results if not results[ name ] ]
+    if failed: self.error( "{} could not be set".format( ", ".join( failed ) ), level="WARNING" )
+    if not self.entity_registered: return None
+    return { "entity_id" : self.entity_id, "applied" : [ name for name in results if results[ name ] ], "failed" : failed }
+
   #################################################
   def det_mode_CB( self, event_name, data, kwargs ):
-      if 'enabled' in data:
-        mode = data['enabled']
-        if mode == 'True' or mode == 'true' or mode == 'On' or mode == 'on' or mode == '1': 
-          self.start_detection()
-          if self.det_valid: self.set_value( self.args["detection_entity"], "On" )
-    
-        if mode == 'False' or mode == 'false' or mode == 'Off' or mode == 'off' or mode == '0': 
-          self.stop_detection()
-          if self.det_valid: self.set_value( self.args["detection_entity"], "Off" )
+    active = parse_enabled( data.get( 'enabled' ) )
+    if active is None: return
+    if active: self.start_detection()
+    else:      self.stop_detection()
+    self.show_detection( active )
 
   ###################################################################
   def state_change( self, entity, attribute, old, new, kwargs ):
@@ -206,100 +704,228 @@ class MotionEye( hass.Hass ):
     self.log( attribute )
     self.log( "{} -> {}".format( old, new ) )
   
+  def change_image_prop( self, prop_name, new ):
+    value = image_value( new )
+    self.queue_property( prop_name, value )
+    return value
+
+  def queue_property( self, prop_name, value ):
+    delay = self.pend_property( prop_name, value )
+    if delay is not None: self.run_in( self.flush_properties, delay )
+
+  def pend_property( self, prop_name, value ):
+    # Latest value wins;  the write goes out with the next flush, at most one per update_interval.  Returns the delay to
+    # schedule that flush after, or None when one is already scheduled
+    with self.pending_lock:
+      self.pending_props[ prop_name ] = value
+      if self.flush_due: return None
+      self.flush_due = True
+      return max( 0, self.last_flush + self.update_interval - time.monotonic() )
+
+  def take_pending( self ):
+    # The pending writes that would change the camera;  the queue starts over empty
+    with self.pending_lock:
+      pending, self.pending_props = self.pending_props, {}
+      self.flush_due  = False
+      self.last_flush = time.monotonic()
+    return { prop : pending[ prop ] for prop in pending if not self.cache.unchanged( prop, pending[ prop ] ) }
+
+  def flush_properties( self, kwargs = {} ):
+    changes = self.take_pending()
+    if not changes: return
+
+    # One detection hold covers every image property in the batch
+    if any( prop in IMAGE_PROPS for prop in changes ):
+      try:
+        self.hold_detection()
+      except WEBCONTROL_ERRORS as err:
+        self.error( "Camera unavailable, dropping {}: {}".format( list( changes ), err ), level="WARNING" )
+        return
+
+    for prop in changes:
+      self.set_property( prop, changes[ prop ] )
+
   def change_brightness( self, entity, attribute, old, new, kwargs ):
-    det_mode = self.get_det_mode()
-    self.pause_detection()
-    new_val = self.set_brightness( float(new)/100*255 )
-    if det_mode: self.schedule_det_start()
+    new_val = self.change_image_prop( 'brightness', new )
     self.log( "Brightness updated to {} [ {} ]".format( new, new_val ) )
 
   def change_contrast( self, entity, attribute, old, new, kwargs ):
-    det_mode = self.get_det_mode()
-    self.pause_detection()
-    new_val = self.set_contrast( float(new)/100*255 )
-    if det_mode: self.schedule_det_start()
+    new_val = self.change_image_prop( 'contrast', new )
     self.log( "Contrast updated to {} [ {} ]".format( new, new_val ) )
 
   def change_hue( self, entity, attribute, old, new, kwargs ):
-    det_mode = self.get_det_mode()
-    self.pause_detection()
-    new_val = self.set_hue( float(new)/100*255 )
-    if det_mode: self.schedule_det_start()
+    new_val = self.change_image_prop( 'hue', new )
     self.log( "Hue updated to {} [ {} ]".format( new, new_val ) )
 
   def change_saturation( self, entity, attribute, old, new, kwargs ):
-    det_mode = self.get_det_mode()
-    self.pause_detection()
-    new_val = self.set_saturation( float(new)/100*255 )
-    if det_mode: self.schedule_det_start()
+    new_val = self.change_image_prop( 'saturation', new )
     self.log( "Saturation updated to {} [ {} ]".format( new, new_val ) )
 
   def change_threshold( self, entity, attribute, old, new, kwargs ):
-    new_val = self.set_threshold( new )
+    self.queue_property( 'threshold', int( float( new ) ) )
     self.log( "Threshold set to {}".format( new ) )
 
   def change_detection( self, entity, attribute, old, new, kwargs ):
-    if new == "On" : 
-      self.start_detection()
-    else:
-      self.pause_detection()
+    # input_booleans report "on" / "off";  our own show_detection() echoes back here and changes nothing
+    try:
+      if new in ( "on", "On" ):
+        self.start_detection()
+      else:
+        self.pause_detection()
+    except WEBCONTROL_ERRORS as err:
+      self.error( "Detection change failed: {}".format( err ), level="WARNING" )
     self.log( "Detection updated to {}".format( new ) )
 
   ##################################################################
+  def invalidate_cache( self, prop_name = None ):
+    # Drop cached settings ( all of them when prop_name is None ) so the next read goes to the camera
+    self.cache.invalidate( prop_name )
+
+  def get_config( self ):
+    # Whole camera config in a single round trip
+    html = self.client.request( self.base_path + 'config/list', idempotent = True )
+    return motion_parse.parse_config( html )
+
   def get_property( self, prop_name ):
-    url_stub = 'config/get?query={}'.format( prop_name )
-    full_url = '{}{}'.format(self.base_url, url_stub )
+    hit, value = self.cache.get( prop_name )
+    if hit: return value
 
-    with urllib.request.urlopen( full_url ) as response:
-      html = response.read().decode('utf-8')
+    html  = self.client.request( motion_webcontrol.config_get_path( self.base_path, prop_name ), idempotent = True )
+    value = motion_parse.parse_property( html, prop_name )
+    self.cache.put( prop_name, value )
+    return value
 
-    match = re.findall( '{}\s=\s([\d]+)'.format( prop_name ), html )
-    return match[0]
-  
   def set_property( self, prop_name, value ):
-    self.log( "Setting {} to {}".format( prop_name, value ) )
-    url_stub = 'config/set?{}={}'.format( prop_name, value )
-    full_url = '{}{}'.format(self.base_url, url_stub )
+    needed, new_val = self.prepare_write( prop_name, value )
+    if not needed: return True
 
     try:
-      with urllib.request.urlopen( full_url ) as response:
-        html = response.read().decode('utf-8')
-    except:
-      self.log( "ERROR" )
-      return False
+      self.client.request( self.set_path( prop_name, new_val ), idempotent = True )
+    except WEBCONTROL_ERRORS as err:
+      return self.write_failed( prop_name, err )
 
+    self.cache.put( prop_name, new_val )
     return True
 
+  def prepare_write( self, prop_name, value ):
+    # ( whether the camera needs the write, the value as motion will report it back )
+    new_val = motion_value( value )
+    if self.cache.unchanged( prop_name, new_val ):
+      self.log( "{} already set to {}".format( prop_name, value ) )
+      return False, new_val
+    self.log( "Setting {} to {}".format( prop_name, value ) )
+    return True, new_val
+
+  def set_path( self, prop_name, value ):
+    return motion_webcontrol.config_set_path( self.base_path, prop_name, motion_parse.format_value( value ) )
+
+  def write_failed( self, prop_name, err ):
+    self.error( "Setting {} failed: {}".format( prop_name, err ), level="WARNING" )
+    self.cache.invalidate( prop_name )
+    return False
+
+  def apply_properties( self, props ):
+    # Writes a set of properties as one batch under a single detection hold.  Returns { property : True | False }.
+    # motion answers webcontrol requests one at a time, so the writes go out back to back on one keep-alive connection
+    values, changes, results = self.prepare_batch( props )
+
+    if any( name in IMAGE_PROPS for name in changes ):
+      try:
+        self.hold_detection()
+      except WEBCONTROL_ERRORS as err:
+        return self.batch_dropped( values, changes, err )
+
+    for name in changes:
+      results[ name ] = self.set_property( name, values[ name ] )
+
+    for name in values:
+      if results[ name ]: self.show_property( name, values[ name ] )
+    return results
+
+  def prepare_batch( self, props ):
+    # ( { name : value as motion reports it }, the names the camera does not have yet, results so far )
+    values  = { name : motion_value( props[ name ] ) for name in props }
+    changes = [ name for name in values if not self.cache.unchanged( name, values[ name ] ) ]
+    return values, changes, { name : True for name in values }
+
+  def batch_dropped( self, values, changes, err ):
+    self.error( "Camera unavailable, dropping {}: {}".format( changes, err ), level="WARNING" )
+    return { name : name not in changes for name in values }
+
+  def show_property( self, prop_name, value ):
+    # Mirrors a camera value onto its bound HASS entity, if it has one
+    shown = self.property_entity( prop_name, value )
+    if shown: self.set_value( *shown )
+
+  def property_entity( self, prop_name, value ):
+    # ( bound entity, value on the entity's scale ), or None when the property has no entity to show it on
+    if prop_name not in PROP_ENTITIES or type( value ) not in ( int, float ): return None
+    entity_arg, valid, scale = PROP_ENTITIES[ prop_name ]
+    return ( self.args[ entity_arg ], value * scale ) if getattr( self, valid ) else None
+
  #####################################
   def trigger_snapshot( self ):
     url_stub = 'action/snapshot'
-    full_url = '{}{}'.format(self.base_url, url_stub )
+    html = self.client.request( self.base_path + url_stub )
+
+  def fetch_frames( self, count = 1 ):
+    # Streams frames straight into snapshot_dir or the ring buffer, then points HASS at the newest one
+    sink = self.frame_sink( count )
+    url  = self.stream_url()
+    got  = motion_stream.grab_frames( url, sink, count, self.client.timeout )
+    self.log( "Fetched {} frames from {}".format( got, url ) )
+    if got and self.snapshot_dir: self.publish_frame( sink.paths[-1] )
+
+  def frame_sink( self, count ):
+    if self.snapshot_dir: return motion_stream.FileSink( self.snapshot_dir, self.frame_name(), keep = count )
+    return self.frames
+
+  def frame_name( self ):
+    return self.entity_id.split( "." )[-1] if self.entity_registered else self.name
+
+  def stream_url( self ):
+    if "stream_url" in self.args: return self.args[ "stream_url" ]
+    return self.port_url( self.get_property( 'stream_port' ) )
 
-    with urllib.request.urlopen( full_url ) as response:
-      html = response.read().decode('utf-8') 
+  def port_url( self, port ):
+    if not port: raise motion_stream.StreamError( "streaming is disabled on this camera ( stream_port = {} )".format( port ) )
+    return "http://{}:{}/".format( self.client.host, port )
+
+  def publish_frame( self, path ):
+    if not self.frame_entity: return
+    if self.frame_entity.startswith( "camera." ):
+      self.call_service( "local_file/update_file_path", entity_id = self.frame_entity, file_path = path )
+    else:
+      self.set_state( self.frame_entity, state = path )
  
  #####################################
   def get_det_mode( self ):
-    url_stub = 'detection/status'
-    full_url = '{}{}'.format(self.base_url, url_stub )
+    # Whether detection is wanted on;  only asks the camera when nothing is known yet
+    if self.detection.desired is not None: return self.detection.desired
+    return self.read_det_mode()
 
-    with urllib.request.urlopen( full_url ) as response:
-      html = response.read().decode('utf-8')
+  def read_det_mode( self ):
+    return self.observe_detection( self.client.request( self.base_path + 'detection/status', idempotent = True ) )
 
-    match = re.findall( 'Detection\sstatus\s([\w]+)', html )
-    return match[0] == 'ACTIVE'
+  def observe_detection( self, html ):
+    active = motion_parse.parse_detection_status( html )
+    if self.detection.observe( active ):
+      self.log( "Camera detection was changed behind our back ( now {} )".format( "on" if active else "off" ) )
+    return active
 
   ###############################
   def set_det_mode( self, mode ):
-    if mode:
-      url_stub = 'detection/start'
-    else:
-      url_stub = 'detection/pause'
+    self.detection.want( mode )
+    self.sync_detection()
 
-    full_url = '{}{}'.format(self.base_url, url_stub )
+  def sync_detection( self ):
+    # Sends the transitions the camera needs to match the state machine, if any
+    self.client.sync_detection( self.base_path )
 
-    with urllib.request.urlopen( full_url ) as response:
-      html = response.read().decode('utf-8')
+  def show_detection( self, active ):
+    # input_booleans have no set_value service
+    if not self.det_valid or active is None: return
+    self.call_service( "input_boolean/turn_on" if active else "input_boolean/turn_off", entity_id = self.args["detection_entity"] )
 
   ################################
   def pause_detection( self, kwargs = {} ):
@@ -308,12 +934,35 @@ class MotionEye( hass.Hass ):
   def start_detection( self, kwargs = {} ):
     self.set_det_mode( True )
 
-  def schedule_det_start( self ):
-    if self.det_start_scheduler:
-      self.log("Killing old scheduler")
-      self.cancel_timer( self.det_start_scheduler )
-    self.log("Scheduling detection enabled in 2s")
-    self.det_start_scheduler = self.run_in( self.start_detection, 2 )
+  def stop_detection( self, kwargs = {} ):
+    self.set_det_mode( False )
+
+  def hold_detection( self ):
+    # Pauses detection for stabilise_time while the image settles.  Holds overlap;  detection returns to the wanted
+    # state when the last one is released
+    if self.detection.desired is None: self.read_det_mode()
+    self.detection.hold()
+    try:
+      self.sync_detection()
+    except:
+      self.detection.release()
+      raise
+    self.run_in( self.release_detection, self.stabilise_time )
+
+  def release_detection( self, kwargs = {} ):
+    self.detection.release()
+    try:
+      self.sync_detection()
+    except WEBCONTROL_ERRORS as err:
+      self.error( "Restoring detection failed: {}".format( err ), level="WARNING" )
+
+  def reconcile_detection( self, kwargs = {} ):
+    if self.breaker.state != self.breaker.CLOSED or self.detection.busy(): return
+    try:
+      self.read_det_mode()
+      self.sync_detection()
+    except WEBCONTROL_ERRORS as err:
+      self.error( "Detection check failed: {}".format( err ), level="WARNING" )
 
 
  ######################################
@@ -339,10 +988,10 @@ class MotionEye( hass.Hass ):
 
  ######################################
   def set_hue( self, value ):
-    self.set_property( 'saturation', value )
+    self.set_property( 'hue', value )
 
   def get_hue( self ):
-    return float( self.get_property( 'saturation' ) )
+    return float( self.get_property( 'hue' ) )
 
  ######################################
   def set_threshold( self, value ):
@@ -353,7 +1002,24 @@ class MotionEye( hass.Hass ):
 
 #######################################
   def terminate( self ):
-    pass
+    if getattr( self, "monitor", None ):
+      self.monitor.stop()
+      self.monitor = None
+    if getattr( self, "stream_events", None ):
+      self.stream_events.shutdown( wait = False )
+      self.stream_events = None
+    if getattr( self, "events", None ):
+      self.events.unregister( self.event_name )
+      motion_events.release_listener( self.events )
+      self.events = None
+    if getattr( self, "client", None ):
+      self.log( "Webcontrol connections to {}: {}".format( self.client.host, self.client.stats ) )
+      self.log( "Request queue: {}".format( self.client.queue.stats ) )
+      self.log( "Property cache: {}".format( self.cache.stats ) )
+      self.log( "Detection: {}".format( self.detection.stats ) )
+      if getattr( self, "metrics_file", None ): self.dump_metrics( self.client.metrics.snapshot( self.base_path ) )
+      motion_webcontrol.release_client( self.client )
+      self.client = None
 
  
   #########################################################
@@ -372,7 +1038,7 @@ class MotionEye( hass.Hass ):
         self.error("{} is an invalid entity for {}".format( self.args[param], param ), level=err_level )
         return False
       if param_type not in self.args[param]:
-        self.error("{} is not a {} and cannot be used".format( self.args[param]. param_type ), level=err_level )
+        self.error("{} is not a {} and cannot be used".format( self.args[param], param_type ), level=err_level )
         return False
       return True 
 
@@ -394,3 +1060,502 @@ class MotionEye( hass.Hass ):
 
     return False
 
+
+###################################################################
+class MotionEyeAsync( MotionEye ):
+  # Only the methods that wait on the camera or on AppDaemon are overridden, as coroutines;  everything they decide is
+  # left to the MotionEye helpers they call
+
+  def open_client( self ):
+    return motion_webcontrol.get_async_client( self.base_url, **self.client_options() )
+
+  async def warm_up( self, kwargs = {} ):
+    timings = []
+    try:
+      await self.seed_entities( timings )
+    except Exception as err:
+      self.warm_up_failed( err )
+      return
+    self.camera_ready( timings )
+
+  async def seed_entities( self, timings ):
+    # The config and detection reads go one after the other:  while the breaker is half open it lets a single probe
+    # through, and a second request in flight beside it would be refused
+    mark   = time.monotonic()
+    config = await self.get_config()
+    await self.read_det_mode()
+    mark   = self.phase( timings, "camera state", mark )
+
+    self.cache.seed( config )
+    for entity, prop_name, scale in self.bound_entities():
+      await self.set_value( entity, await self.config_value( config, prop_name ) * scale )
+
+    await self.sync_detection()
+    await self.show_detection( self.detection.desired )
+    mark = self.phase( timings, "entities", mark )
+
+    if self.monitor_stream and self.monitor is None:
+      try:
+        self.start_monitor( await self.stream_url() )
+      except STREAM_ERRORS as err:
+        self.error( "Cannot monitor the stream: {}".format( err ), level="WARNING" )
+      self.phase( timings, "stream", mark )
+
+  async def config_value( self, config, prop_name ):
+    if prop_name in config: return config[ prop_name ]
+    return float( await self.get_property( prop_name ) )
+
+  ###########################################################
+  async def check_link( self, kwargs = {} ):
+    if self.warm_up_due(): await self.warm_up()
+    await self.publish_link()
+
+  async def publish_link( self ):
+    if self.link_changed(): await self.set_state( self.link_sensor, state = self.link_state, attributes = self.link_attributes() )
+
+  async def publish_health( self, kwargs = {} ):
+    for entity, state, attributes in self.health_states():
+      await self.set_state( entity, state = state, attributes = attributes )
+
+  async def publish_metrics( self, kwargs = {} ):
+    metrics = self.client.metrics.snapshot( self.base_path )
+    for entity, state, attributes in self.metric_states( metrics ):
+      await self.set_state( entity, state = state, attributes = attributes )
+    if self.metrics_file: self.dump_metrics( metrics )
+
+  ###########################################################
+  async def snapshot_CB( self, event_name, data, kwargs ):
+    if not self.addressed( data ): return
+    self.log("Snapshot triggered")
+    try:
+      await self.trigger_snapshot()
+      if self.snapshot_dir: await self.fetch_frames( 1 )
+    except STREAM_ERRORS as err:
+      self.error( "Snapshot failed: {}".format( err ), level="WARNING" )
+
+  async def grab_frames_CB( self, event_name, data, kwargs ):
+    try:
+      await self.fetch_frames( int( data.get( "count", 1 ) ) )
+    except STREAM_ERRORS as err:
+      self.error( "Frame grab failed: {}".format( err ), level="WARNING" )
+
+  async def update_setting_event_CB( self, event_name, data, kwargs ):
+    results = await self.apply_properties( event_props( data ) )
+    await self.report_results( results )
+
+  async def preset_CB( self, event_name, data, kwargs ):
+    preset = self.preset_for( data )
+    if preset is None: return
+
+    props, detection = preset
+    results = await self.apply_properties( props )
+    if detection is not None:
+      try:
+        await self.set_det_mode( detection )
+        await self.show_detection( self.detection.desired )
+        results[ 'detection' ] = True
+      except WEBCONTROL_ERRORS as err:
+        self.error( "Setting detection failed: {}".format( err ), level="WARNING" )
+        results[ 'detection' ] = False
+    await self.report_results( results )
+
+  async def report_results( self, results ):
+    event = self.results_event( results )
+    if event: await self.fire_event( "motion_props_applied", **event )
+
+  async def det_mode_CB( self, event_name, data, kwargs ):
+    active = parse_enabled( data.get( 'enabled' ) )
+    if active is None: return
+    if active: await self.start_detection()
+    else:      await self.stop_detection()
+    await self.show_detection( active )
+
+  ###################################################################
+  async def queue_property( self, prop_name, value ):
+    delay = self.pend_property( prop_name, value )
+    if delay is not None: await self.run_in( self.flush_properties, delay )
+
+  async def flush_properties( self, kwargs = {} ):
+    changes = self.take_pending()
+    if not changes: return
+
+    if any( prop in IMAGE_PROPS for prop in changes ):
+      try:
+        await self.hold_detection()
+      except WEBCONTROL_ERRORS as err:
+        self.error( "Camera unavailable, dropping {}: {}".format( list( changes ), err ), level="WARNING" )
+        return
+
+    for prop in changes:
+      await self.set_property( prop, changes[ prop ] )
+
+  async def change_image_prop( self, prop_name, new ):
+    value = image_value( new )
+    await self.queue_property( prop_name, value )
+    return value
+
+  async def change_brightness( self, entity, attribute, old, new, kwargs ):
+    new_val = await self.change_image_prop( 'brightness', new )
+    self.log( "Brightness updated to {} [ {} ]".format( new, new_val ) )
+
+  async def change_contrast( self, entity, attribute, old, new, kwargs ):
+    new_val = await self.change_image_prop( 'contrast', new )
+    self.log( "Contrast updated to {} [ {} ]".format( new, new_val ) )
+
+  async def change_hue( self, entity, attribute, old, new, kwargs ):
+    new_val = await self.change_image_prop( 'hue', new )
+    self.log( "Hue updated to {} [ {} ]".format( new, new_val ) )
+
+  async def change_saturation( self, entity, attribute, old, new, kwargs ):
+    new_val = await self.change_image_prop( 'saturation', new )
+    self.log( "Saturation updated to {} [ {} ]".format( new, new_val ) )
+
+  async def change_threshold( self, entity, attribute, old, new, kwargs ):
+    await self.queue_property( 'threshold', int( float( new ) ) )
+    self.log( "Threshold set to {}".format( new ) )
+
+  async def change_detection( self, entity, attribute, old, new, kwargs ):
+    try:
+      if new in ( "on", "On" ):
+        await self.start_detection()
+      else:
+        await self.pause_detection()
+    except WEBCONTROL_ERRORS as err:
+      self.error( "Detection change failed: {}".format( err ), level="WARNING" )
+    self.log( "Detection updated to {}".format( new ) )
+
+  ##################################################################
+  async def get_config( self ):
+    html = await self.client.request( self.base_path + 'config/list', idempotent = True )
+    return motion_parse.parse_config( html )
+
+  async def get_property( self, prop_name ):
+    hit, value = self.cache.get( prop_name )
+    if hit: return value
+
+    html  = await self.client.request( motion_webcontrol.config_get_path( self.base_path, prop_name ), idempotent = True )
+    value = motion_parse.parse_property( html, prop_name )
+    self.cache.put( prop_name, value )
+    return value
+
+  async def set_property( self, prop_name, value ):
+    needed, new_val = self.prepare_write( prop_name, value )
+    if not needed: return True
+
+    try:
+      await self.client.request( self.set_path( prop_name, new_val ), idempotent = True )
+    except WEBCONTROL_ERRORS as err:
+      return self.write_failed( prop_name, err )
+
+    self.cache.put( prop_name, new_val )
+    return True
+
+  async def apply_properties( self, props ):
+    # As MotionEye.apply_properties, with the writes in flight together ( bounded by the client's pool )
+    values, changes, results = self.prepare_batch( props )
+
+    if any( name in IMAGE_PROPS for name in changes ):
+      try:
+        await self.hold_detection()
+      except WEBCONTROL_ERRORS as err:
+        return self.batch_dropped( values, changes, err )
+
+    written = await asyncio.gather( *[ self.set_property( name, values[ name ] ) for name in changes ] )
+    results.update( zip( changes, written ) )
+
+    for name in values:
+      if results[ name ]: await self.show_property( name, values[ name ] )
+    return results
+
+  async def show_property( self, prop_name, value ):
+    shown = self.property_entity( prop_name, value )
+    if shown: await self.set_value( *shown )
+
+  async def trigger_snapshot( self ):
+    await self.client.request( self.base_path + 'action/snapshot' )
+
+  async def fetch_frames( self, count = 1 ):
+    sink = self.frame_sink( count )
+    url  = await self.stream_url()
+    got  = await motion_stream.async_grab_frames( url, sink, count, self.client.timeout )
+    self.log( "Fetched {} frames from {}".format( got, url ) )
+    if got and self.snapshot_dir: await self.publish_frame( sink.paths[-1] )
+
+  async def stream_url( self ):
+    if "stream_url" in self.args: return self.args[ "stream_url" ]
+    return self.port_url( await self.get_property( 'stream_port' ) )
+
+  async def publish_frame( self, path ):
+    if not self.frame_entity: return
+    if self.frame_entity.startswith( "camera." ):
+      await self.call_service( "local_file/update_file_path", entity_id = self.frame_entity, file_path = path )
+    else:
+      await self.set_state( self.frame_entity, state = path )
+
+  async def get_det_mode( self ):
+    if self.detection.desired is not None: return self.detection.desired
+    return await self.read_det_mode()
+
+  async def read_det_mode( self ):
+    return self.observe_detection( await self.client.request( self.base_path + 'detection/status', idempotent = True ) )
+
+  async def set_det_mode( self, mode ):
+    self.detection.want( mode )
+    await self.sync_detection()
+
+  async def sync_detection( self ):
+    await self.client.sync_detection( self.base_path )
+
+  async def show_detection( self, active ):
+    if not self.det_valid or active is None: return
+    await self.call_service( "input_boolean/turn_on" if active else "input_boolean/turn_off", entity_id = self.args["detection_entity"] )
+
+  async def pause_detection( self, kwargs = {} ):
+    await self.set_det_mode( False )
+
+  async def start_detection( self, kwargs = {} ):
+    await self.set_det_mode( True )
+
+  async def stop_detection( self, kwargs = {} ):
+    await self.set_det_mode( False )
+
+  async def hold_detection( self ):
+    if self.detection.desired is None: await self.read_det_mode()
+    self.detection.hold()
+    try:
+      await self.sync_detection()
+    except:
+      self.detection.release()
+      raise
+    await self.run_in( self.release_detection, self.stabilise_time )
+
+  async def release_detection( self, kwargs = {} ):
+    self.detection.release()
+    try:
+      await self.sync_detection()
+    except WEBCONTROL_ERRORS as err:
+      self.error( "Restoring detection failed: {}".format( err ), level="WARNING" )
+
+  async def reconcile_detection( self, kwargs = {} ):
+    if self.breaker.state != self.breaker.CLOSED or self.detection.busy(): return
+    try:
+      await self.read_det_mode()
+      await self.sync_detection()
+    except WEBCONTROL_ERRORS as err:
+      self.error( "Detection check failed: {}".format( err ), level="WARNING" )
+
+  ######################################
+  async def set_brightness( self, value ):
+    await self.set_property( 'brightness', value )
+
+  async def get_brightness( self ):
+    return float( await self.get_property( 'brightness' ) )
+
+  async def set_contrast( self, value ):
+    await self.set_property( 'contrast', value )
+
+  async def get_contrast( self ):
+    return float( await self.get_property( 'contrast' ) )
+
+  async def set_saturation( self, value ):
+    await self.set_property( 'saturation', value )
+
+  async def get_saturation( self ):
+    return float( await self.get_property( 'saturation' ) )
+
+  async def set_hue( self, value ):
+    await self.set_property( 'hue', value )
+
+  async def get_hue( self ):
+    return float( await self.get_property( 'hue' ) )
+
+  async def set_threshold( self, value ):
+    await self.set_property( 'threshold', value )
+
+  async def get_threshold( self ):
+    return int( await self.get_property( 'threshold' ) )
+
+
+###################################################################
+class FleetCamera( object ):
+
+  def __init__( self, entity_id, url, detection_entity = None ):
+    self.entity_id        = entity_id
+    self.detection_entity = detection_entity
+    self.client, self.path = motion_webcontrol.get_client( url )
+    self.cache            = self.client.cache( self.path )
+    self.detection        = self.client.detection( self.path )
+
+  def sync_detection( self ):
+    self.client.sync_detection( self.path )
+
+  def send_transition( self, active ):
+    # Sends a transition claimed with detection.next_transition() and reports it back, as client.sync_detection() does
+    try:
+      self.client.request( self.path + ( 'detection/start' if active else 'detection/pause' ), idempotent = True )
+    except:
+      self.detection.failed()
+      raise
+    self.detection.sent( active )
+
+  def hold_detection( self ):
+    # As MotionEye.hold_detection, without scheduling the release
+    if self.detection.desired is None:
+      self.detection.observe( motion_parse.parse_detection_status( self.client.request( self.path + 'detection/status', idempotent = True ) ) )
+    self.detection.hold()
+    try:
+      self.sync_detection()
+    except:
+      self.detection.release()
+      raise
+
+  def release_detection( self ):
+    self.detection.release()
+    self.sync_detection()
+
+
+class MotionEyeFleet( hass.Hass ):
+
+  def initialize( self ):
+    self.log( "Motioneye fleet starting up" )
+
+    self.cameras = {}                  # entity_id -> FleetCamera
+    self.hosts   = {}                  # ( host, port ) -> [ FleetCamera ]
+
+    cameras = self.args.get( "cameras", {} )
+    for entity_id in cameras:
+      conf = cameras[ entity_id ]
+      if type( conf ) is str: conf = { "URL" : conf }
+      if "URL" not in conf:
+        self.error( "{} has no URL and will be ignored".format( entity_id ), level="WARNING" )
+        continue
+
+      camera = FleetCamera( entity_id, conf[ "URL" ], conf.get( "detection_entity" ) )
+      self.cameras[ entity_id ] = camera
+      self.hosts.setdefault( ( camera.client.host, camera.client.port ), [] ).append( camera )
+
+    if not self.cameras:
+      self.error( "No cameras configured", level="CRITICAL" )
+      return
+
+    self.log( "Managing {} cameras on {} motion hosts".format( len( self.cameras ), len( self.hosts ) ) )
+    self.stabilise_time = float( self.args.get( "stabilise_time", 2 ) )
+    self.pool = ThreadPoolExecutor( max_workers = int( self.args.get( "workers", 4 ) ) )
+
+    self.listen_event( self.snapshot_CB,             "motion_snapshot" )
+    self.listen_event( self.det_mode_CB,             "motion_det_mode_changed" )
+    self.listen_event( self.update_setting_event_CB, "motion_prop_changed" )
+
+  def terminate( self ):
+    if getattr( self, "pool", None ):
+      self.pool.shutdown( wait = False )
+    for camera in getattr( self, "cameras", {} ).values():
+      motion_webcontrol.release_client( camera.client )
+
+  ###########################################################
+  def targets( self, data ):
+    # Returns the cameras addressed by an event, grouped per host, and whether the event was for ALL cameras
+    entity_id = data.get( "entity_id" )
+    if entity_id == "ALL": return dict( self.hosts ), True
+
+    ids    = entity_id if type( entity_id ) is list else [ entity_id ]
+    groups = {}
+    for camera in [ self.cameras[ i ] for i in ids if i in self.cameras ]:
+      groups.setdefault( ( camera.client.host, camera.client.port ), [] ).append( camera )
+    return groups, False
+
+  def fan_out( self, name, groups, work ):
+    # One task per host;  motion serves a host's requests one at a time so there is nothing to gain within a host
+    for host in groups:
+      future = self.pool.submit( work, groups[ host ] )
+      future.add_done_callback( lambda f, host = host: self.task_done( name, host, f ) )
+
+  def task_done( self, name, host, future ):
+    if future.exception():
+      self.error( "{} failed on {}:{} : {}".format( name, host[0], host[1], future.exception() ), level="WARNING" )
+
+  ###########################################################
+  def snapshot_CB( self, event_name, data, kwargs ):
+    groups, everything = self.targets( data )
+    self.log( "Snapshot triggered on {} hosts".format( len( groups ) ) )
+    if everything: self.fan_out( "snapshot", groups, lambda cams : self.host_request( cams, 'action/snapshot' ) )
+    else:          self.fan_out( "snapshot", groups, lambda cams : self.camera_requests( cams, 'action/snapshot' ) )
+
+  def det_mode_CB( self, event_name, data, kwargs ):
+    active = parse_enabled( data.get( 'enabled' ) )
+    if active is None: return
+
+    groups, everything = self.targets( data )
+    if everything: self.fan_out( "detection", groups, lambda cams : self.host_detection( cams, active ) )
+    else:          self.fan_out( "detection", groups, lambda cams : self.camera_detection( cams, active ) )
+
+    service = "input_boolean/turn_on" if active else "input_boolean/turn_off"
+    for cams in groups.values():
+      for camera in cams:
+        if camera.detection_entity: self.call_service( service, entity_id = camera.detection_entity )
+
+  def update_setting_event_CB( self, event_name, data, kwargs ):
+    props = event_props( data )
+    if not props: return
+
+    groups = self.targets( data )[0]
+    self.fan_out( "property update", groups, lambda cams : self.set_properties( cams, props ) )
+
+  ###########################################################
+  def host_request( self, cameras, url_stub ):
+    # Thread 0 applies the command to every camera on the host in one round trip
+    cameras[0].client.request( '/0/' + url_stub )
+
+  def camera_requests( self, cameras, url_stub ):
+    for camera in cameras:
+      camera.client.request( camera.path + url_stub )
+
+  def host_detection( self, cameras, active ):
+    # Thread 0 is only used when every camera on the host can take the transition now.  A camera held for stabilisation
+    # or already switching keeps its claim with its DetectionState, and the host falls back to per camera requests
+    for camera in cameras: camera.detection.want( active )
+    claims = [ camera.detection.next_transition() for camera in cameras ]
+
+    if all( claim == active for claim in claims ):
+      try:
+        self.host_request( cameras, 'detection/start' if active else 'detection/pause' )
+      except:
+        for camera in cameras: camera.detection.failed()
+        raise
+      for camera in cameras: camera.detection.sent( active )
+    else:
+      failures = []
+      for camera, claim in zip( cameras, claims ):
+        if claim is None: continue
+        try:
+          camera.send_transition( claim )
+        except WEBCONTROL_ERRORS as err:
+          failures.append( err )
+      if failures: raise failures[0]
+
+    for camera in cameras: camera.sync_detection()
+
+  def camera_detection( self, cameras, active ):
+    # Only cameras not already in the wanted state are sent anything
+    for camera in cameras:
+      camera.detection.want( active )
+      camera.sync_detection()
+
+  def set_properties( self, cameras, props ):
+    # Image settings pause the camera's detection for stabilise_time, through the same DetectionState hold as MotionEye
+    values = dict( ( name, motion_value( props[ name ] ) ) for name in props )
+    for camera in cameras:
+      changes = [ name for name in values if not camera.cache.unchanged( name, values[ name ] ) ]
+      if any( name in IMAGE_PROPS for name in changes ):
+        camera.hold_detection()
+        self.run_in( self.release_detection, self.stabilise_time, camera = camera.entity_id )
+
+      for name in changes:
+        camera.client.request( motion_webcontrol.config_set_path( camera.path, name, motion_parse.format_value( values[ name ] ) ), idempotent = True )
+        camera.cache.put( name, values[ name ] )
+
+  def release_detection( self, kwargs ):
+    try:
+      self.cameras[ kwargs[ "camera" ] ].release_detection()
+    except WEBCONTROL_ERRORS as err:
+      self.error( "Restoring detection on {} failed: {}".format( kwargs[ "camera" ], err ), level="WARNING" )
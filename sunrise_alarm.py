@@ -1,8 +1,14 @@
 import appdaemon.plugins.hass.hassapi as hass
+import collections
+import re
+import time
 from datetime import datetime
 from datetime import timedelta
 from enum import Enum
 
+import sunrise_fade
+import sunrise_schedule
+
 ##################################################
 #
 # time_entity   : hass input_datetime for alarm time
@@ -10,156 +16,441 @@ from enum import Enum
 # pre_trip      : hass input_number for minutes before alarm to start lights [ default = 30 ]
 # enabled_entity: hass input_boolean to control alarm enable/disable ( optional )
 # weekend_entity: hass input_boolean to enable/disable alarm on weekends ( optional )
-# 
+# max_transition: longest transition in seconds handed to a light in one go [ default = 600 ]
+# fade_sensor   : sensor each fade's figures are published to [ default = sensor.<alarm name>_sunrise ].  false turns it off
+# history       : number of past fades kept in the sensor's history attribute [ default = 10 ]
+# log_steps     : log every fade step as it is sent [ default = false ]
+#
+# alarms        : map of alarm name to its own set of the settings above, so one app can run the alarms of many rooms
+#                 ( optional ).  Settings an alarm does not give are taken from the app's.  Each alarm may also have
+#   days        : weekdays it rings on, e.g. [ mon, tue, wed, thu, fri ] [ default = every day ]
+#
+# Without `alarms` the app runs the single alarm its own settings describe.
+#
+#   sunrise:
+#     module : sunrise_alarm
+#     class  : SunriseAlarm
+#     enabled_entity : input_boolean.alarms
+#     alarms :
+#       bedroom :
+#         time_entity : input_datetime.bedroom_alarm
+#         lights      : [ light.bedside, light.ceiling ]
+#         days        : [ mon, tue, wed, thu, fri ]
+#       nursery :
+#         time_entity : input_datetime.nursery_alarm
+#         lights      : [ light.nursery ]
+#
+# The fade follows a perceptual brightness curve and is handed to the lights as a few long transitions, so the bulbs
+# ramp smoothly on their own between service calls ( see sunrise_fade.py ).  Lights that do not report transition
+# support are stepped once a minute instead.  Lights heading to the same level over the same transition are set with a
+# single light/turn_on for all of them, and the number of calls each step took is logged.
+#
+# The fade is planned up front as offsets from its start, and each step is scheduled for the wall clock time the plan
+# gives it rather than a delay after the previous one, so call latency and timer jitter do not add up.  A step that runs
+# late takes any later steps that are also due with it and shortens its transitions, so the lights still reach full at
+# the alarm time.
+#
+# Each fade keeps running totals rather than logging every light:  steps run, service calls made and how long they
+# took, how late the steps ran against the plan, steps merged, lights taken over, how long the fade took and how far
+# from the alarm time it finished.  These are logged in one line and published to fade_sensor when the fade ends, its
+# state being the finish drift in seconds, with the last `history` fades as an attribute.  The sensor reads "running"
+# while a fade is under way, and "stopped" after a fade that was stopped before it finished ( the reason is in the
+# outcome attribute ).
+#
+# On start up the app reads the state of every light and input_* entity in one go and validates its settings against
+# that snapshot rather than asking about each entity in turn.  The controlled lights are then followed with listen_state,
+# so their starting brightness is already known when an alarm trips, however many lights it has.
+#
+# A running fade stops as soon as its alarm is disabled:  its next step is dropped from the schedule and any light still
+# in the middle of a transition is held at the level it has reached.  The fade also watches its lights, and one that is
+# switched off or set well away from where the fade has it ( by hand or by another automation ) is left alone for the
+# rest of that fade.  The fade stops once every light has been taken over this way.
+#
+# Every alarm shares one scheduler:  a min-heap holding each alarm's next trip and next fade step, with a single
+# AppDaemon timer set for the earliest of them ( see sunrise_schedule.py ).  Changing an alarm only updates its own heap
+# entries, and the timer is only moved when the earliest entry comes forward.
+#
+
+DAYS             = [ "mon", "tue", "wed", "thu", "fri", "sat", "sun" ]
+SNAPSHOT_DOMAINS = [ "light", "input_datetime", "input_number", "input_boolean" ]
+HISTORY          = 10
+OVERRIDE_LEVELS  = 16                    # brightness a light may stray outside its current ramp before it counts as taken over
 
 class dim_mode( Enum ):
   level = 0             # bring all lights in the room up to match the brightest
   scale = 1             # leave all lights as they are and scale independantly
 
 
+class FadeStats( object ):
+  # Running totals for one fade, so a step costs a few additions rather than a log line per light
+  __slots__ = ( "started", "steps", "calls", "merged", "late_max", "late_total", "call_max", "call_total", "released",
+                "outcome", "duration", "drift" )
+
+  def __init__( self, started ):
+    self.started    = started
+    self.steps      = 0
+    self.calls      = 0
+    self.merged     = 0
+    self.late_max   = 0.0
+    self.late_total = 0.0
+    self.call_max   = 0.0                  # slowest service call, seconds
+    self.call_total = 0.0
+    self.released   = 0
+    self.outcome    = "running"
+    self.duration   = 0.0
+    self.drift      = None
+
+  def step( self, lateness, merged, seconds ):
+    # seconds : per call time of the step's service calls
+    self.steps      += 1
+    self.merged     += merged
+    self.calls      += len( seconds )
+    self.late_max    = max( self.late_max, lateness )
+    self.late_total += lateness
+    self.call_max    = max( [ self.call_max ] + seconds )
+    self.call_total += sum( seconds )
+
+  def as_dict( self ):
+    return { "started"        : self.started.isoformat(),
+             "outcome"        : self.outcome,
+             "steps"          : self.steps,
+             "calls"          : self.calls,
+             "merged"         : self.merged,
+             "released"       : self.released,
+             "late_max_s"     : round( self.late_max, 1 ),
+             "late_mean_s"    : round( self.late_total / self.steps, 1 ) if self.steps else 0.0,
+             "call_mean_ms"   : round( self.call_total / self.calls * 1000, 1 ) if self.calls else 0.0,
+             "call_max_ms"    : round( self.call_max * 1000, 1 ),
+             "duration_min"   : round( self.duration / 60, 1 ),
+             "drift_s"        : None if self.drift is None else round( self.drift, 1 ) }
+
+
+class Alarm( object ):
+  # One alarm:  its settings and the state of its fade while one is running
+
+  def __init__( self, name, args ):
+    self.name           = name
+    self.args           = args
+    self.lights         = []
+    self.time           = None
+    self.pre_trip       = timedelta( minutes = 30 )
+    self.enabled        = True
+    self.weekends       = True
+    self.days           = None             # weekday numbers it rings on, None for every day
+    self.max_transition = float( args.get( "max_transition", sunrise_fade.MAX_TRANSITION ) )
+    self.log_steps      = bool( args.get( "log_steps", False ) )
+    self.sensor         = args.get( "fade_sensor", "sensor.{}_sunrise".format( re.sub( r"\W+", "_", str( name ).lower() ) ) )
+    self.history        = collections.deque( maxlen = int( args.get( "history", HISTORY ) ) )
+
+    self.running          = False
+    self.ramps            = {}             # light -> ( sent at, from level, to level, transition ) of the last call
+    self.released         = set()          # lights taken over by hand during this fade
+    self.stages           = []             # ( seconds from fade_start, { light : ( level, transition ) } )
+    self.current_stage    = 0
+    self.current_level    = {}
+    self.stats            = None           # FadeStats of the running or last fade
+    self.fade_start       = None           # planned start, the trip time
+    self.fade_end         = None           # planned end, the alarm time
+    self.finish           = None           # when the last transition sent ends
+
+  def trip_time( self, now ):
+    # Next time after now that the fade should start
+    start = datetime.combine( now.date(), self.time ) - self.pre_trip
+    while start <= now: start += timedelta( days = 1 )
+    return start
+
+  def rings_on( self, day ):
+    # day : datetime.date the alarm goes off
+    if day.weekday() >= 5 and not self.weekends: return False     # weekdays are 0:4
+    return self.days is None or day.weekday() in self.days
+
+  def level_now( self, light, now ):
+    # Where the fade has the light at the moment, part way along its ramp
+    sent, low, high, transition = self.ramps[ light ]
+    done = min( 1.0, max( 0.0, ( now - sent ).total_seconds() / transition ) ) if transition else 1.0
+    return low + ( high - low ) * done
+
+  def diverged( self, light, state, old = None ):
+    # state, old : the light's new and previous state, as listen_state( attribute = "all" ) gives them
+    if light not in self.ramps or light in self.released: return False
+    sent, low, high, transition = self.ramps[ light ]
+    if not state or state.get( "state" ) == "off":
+      # Off is only a takeover once the fade has had the light on;  before its first step it is meant to be off
+      return high > 0 or bool( old and old.get( "state" ) == "on" )
+    level = state.get( "attributes", {} ).get( "brightness" )
+    if level is None: return False
+    return level < min( low, high ) - OVERRIDE_LEVELS or level > max( low, high ) + OVERRIDE_LEVELS
+
+
 class SunriseAlarm( hass.Hass ):
 
   def initialize( self ):
     self.log("Sunrise Alarm starting up")
- 
-    self.time_valid   = self.validate_param( "time_entity", "input_datetime", True )
-    self.lights_valid = self.validate_param( "lights", "light", True )
-    self.mode         = dim_mode.scale
- 
-    if self.time_valid and ( any( self.lights_valid.values() ) ):
-
-      self.alarm_h          = False
-      self.should_interrupt = False
-
-      ###################################################
-      self.active_lights = []
-      for light_id in self.lights_valid:
-        if self.lights_valid[light_id]:
-          self.active_lights.append( light_id )
-
- 
-      ####################################################
-      if self.validate_param( "pre_trip", "input_number"):
-        self.pre_trip = datetime.timedelta( minutes = self.get_state( self.args[ "pre_trip" ] ) )
-        self.log( "Alarm starting up with {} minutes of pre-trip".format( self.pre_trip ) )
-        self.listen_state( self.new_pretrip, self.args[ "pre_trip" ] )
-      else:
-        self.pre_trip = timedelta( minutes = 30 )
-        self.log( "Alarm starting up with default {} minutes of pre-trip".format( self.pre_trip ))
-
-      ####################################################
-      if self.validate_param("enabled_entity", "input_boolean" ):
-        self.alarm_enabled = self.get_state( self.args["enabled_entity"] ) == "on"
-        self.log( "Alarm staring up with alarm in {} state".format( self.alarm_enabled ) )
-
-        self.listen_state( self.new_enable, self.args["enabled_entity"] )
-      else:
-        self.alarm_enabled = True
-        self.error("enable_entity not provided.  Alarm will not be controllable", level="WARNING")
-
-      ####################################################
-      if self.validate_param("weekend_entity", "input_boolean"):
-        self.weekends_enabled = self.get_state( self.args["weekend_entity"] ) == "on"
-        self.log( "Alarm staring up with weekends in {} state".format( self.weekends_enabled ) )
-
-        self.listen_state( self.new_wknd, self.args["weekend_entity"] )
-      else:
-        self.weekends_enabled = True
-        self.error("weekend_entity not provided.  Alarm will function everyday", level="WARNING")
-
-      ### Configure the alarm callback
-      alarm_time_entity    = self.args["time_entity"]
-      self.listen_state( self.new_time, self.args["time_entity"] )
-      self.alarm_time = datetime.strptime( self.get_state( self.args["time_entity"] ), '%H:%M:%S' )
-      self.log("Alarm starting up set to {}".format( self.alarm_time.time()  ) )
-
-      if self.alarm_enabled:
-        self.set_alarm( )
+
+    self.mode      = dim_mode.scale
+    self.schedule  = sunrise_schedule.Schedule()
+    self.timer     = None
+    self.timer_due = None
+    self.wakeups   = 0
+
+    # One read of every entity the alarms can use, instead of a call per entity
+    self.states = {}
+    for domain in SNAPSHOT_DOMAINS:
+      self.states.update( self.get_state( domain ) or {} )
+
+    if "alarms" in self.args:
+      configs = {}
+      for name, args in self.args[ "alarms" ].items():
+        config = dict( self.args )
+        config.pop( "alarms" )
+        if config.get( "fade_sensor" ): config.pop( "fade_sensor" )      # one sensor per alarm, only false carries over
+        config.update( args or {} )
+        configs[ name ] = config
+    else:
+      configs = { self.name : self.args }
+
+    self.alarms = {}
+    for name, args in configs.items():
+      alarm = self.setup_alarm( name, args )
+      if alarm: self.alarms[ name ] = alarm
+
+    if not self.alarms:
+      self.error( "No usable alarm configured", level="CRITICAL" )
+      return
+
+    # Keep the snapshot of the controlled lights current
+    for light in set( light for alarm in self.alarms.values() for light in alarm.lights ):
+      self.listen_state( self.light_changed, light, attribute = "all" )
+
+    for alarm in self.alarms.values():
+      if alarm.enabled: self.set_alarm( alarm )
 
     ### Debug
-   # self.sequence_lights( None )
+   # self.sequence_lights( self.alarms[ self.name ] )
+
+  #########################################################
+  def setup_alarm( self, name, args ):
+    time_valid   = self.validate_param( "time_entity", "input_datetime", True, args )
+    lights_valid = self.validate_param( "lights", "light", True, args )
+
+    if not time_valid or not lights_valid or not any( lights_valid.values() ):
+      self.error( "[{}] Alarm needs a time entity and at least one light".format( name ), level="CRITICAL" )
+      return None
+
+    alarm = Alarm( name, args )
+
+    ###################################################
+    for light_id in lights_valid:
+      if lights_valid[light_id]:
+        alarm.lights.append( light_id )
+
+    ####################################################
+    if self.validate_param( "pre_trip", "input_number", args = args ):
+      alarm.pre_trip = timedelta( minutes = float( self.state_of( args[ "pre_trip" ] ) ) )
+      self.log( "[{}] Alarm starting up with {} minutes of pre-trip".format( name, alarm.pre_trip ) )
+      self.listen_state( self.new_pretrip, args[ "pre_trip" ], alarm = name )
+    else:
+      self.log( "[{}] Alarm starting up with default {} minutes of pre-trip".format( name, alarm.pre_trip ))
+
+    ####################################################
+    if self.validate_param("enabled_entity", "input_boolean", args = args ):
+      alarm.enabled = self.state_of( args["enabled_entity"] ) == "on"
+      self.log( "[{}] Alarm staring up with alarm in {} state".format( name, alarm.enabled ) )
+
+      self.listen_state( self.new_enable, args["enabled_entity"], alarm = name )
+    else:
+      self.error("[{}] enable_entity not provided.  Alarm will not be controllable".format( name ), level="WARNING")
+
+    ####################################################
+    if self.validate_param("weekend_entity", "input_boolean", args = args ):
+      alarm.weekends = self.state_of( args["weekend_entity"] ) == "on"
+      self.log( "[{}] Alarm staring up with weekends in {} state".format( name, alarm.weekends ) )
+
+      self.listen_state( self.new_wknd, args["weekend_entity"], alarm = name )
+    else:
+      self.error("[{}] weekend_entity not provided.  Alarm will function everyday".format( name ), level="WARNING")
+
+    ####################################################
+    if "days" in args:
+      days       = [ str( day ).lower()[:3] for day in args["days"] ]
+      alarm.days = [ DAYS.index( day ) for day in days if day in DAYS ]
+      for day in days:
+        if day not in DAYS: self.error( "[{}] {} is not a day of the week".format( name, day ), level="WARNING" )
+      self.log( "[{}] Alarm rings on {}".format( name, ", ".join( DAYS[ day ] for day in alarm.days ) ) )
+
+    ### Configure the alarm callback
+    self.listen_state( self.new_time, args["time_entity"], alarm = name )
+    alarm.time = datetime.strptime( self.state_of( args["time_entity"] ), '%H:%M:%S' ).time()
+    self.log("[{}] Alarm starting up set to {}".format( name, alarm.time ) )
+
+    return alarm
 
  #######################################
   def terminate( self ):
-    pass
+    if self.timer: self.cancel_timer( self.timer )
 
   ###########################################################
   def new_time( self, entity, attribute, old, new, kwargs ):
-    self.log( "Time changed to {}".format( new ) )
-    self.kill_alarm()
-    self.alarm_time   = datetime.strptime( new, '%H:%M:%S' )
-    if self.alarm_enabled: self.set_alarm()
-  
+    alarm = self.alarms[ kwargs[ "alarm" ] ]
+    self.log( "[{}] Time changed to {}".format( alarm.name, new ) )
+    alarm.time = datetime.strptime( new, '%H:%M:%S' ).time()
+    if alarm.enabled: self.set_alarm( alarm )
+
   ###########################################################
   def new_pretrip( self, entity, attribute, old, new, kwargs ):
+    alarm = self.alarms[ kwargs[ "alarm" ] ]
 
+    new = float( new )
     if new < 10:   #10 minute minimum fade in time
       self.log( "Pre-trip time less than 10 minute minimum...defaulting", level="WARNING" )
       new = 10
-      self.set_state( entity, new )
+      self.set_state( entity, state = new )
 
-    self.log( "Pre-trip time changed to {}".format( new ) )
-    self.kill_alarm()
-    self.pre_trip = timedelta( minutes = self.get_state( new ) )
-    if self.alarm_enabled: set_alarm()
+    self.log( "[{}] Pre-trip time changed to {}".format( alarm.name, new ) )
+    alarm.pre_trip = timedelta( minutes = new )
+    if alarm.enabled: self.set_alarm( alarm )
 
 
   #########################################################
   def new_enable( self, entity, attributes, old, new, kwargs ):
-    self.log( "Alarm enable switched to {}".format( new ) )
-    self.alarm_enabled = new == "on"
+    alarm = self.alarms[ kwargs[ "alarm" ] ]
+    self.log( "[{}] Alarm enable switched to {}".format( alarm.name, new ) )
+    alarm.enabled = new == "on"
+
+    if alarm.enabled :
+      self.set_alarm( alarm )
+    else:
+      self.kill_alarm( alarm )
+      self.stop_fade( alarm, "alarm disabled", hold = True )
 
-    if self.alarm_enabled :
-      self.set_alarm( )
-    else: 
-      self.should_interrupt = True
-      self.kill_alarm()
 
-  
   #########################################################
-  def new_wknd( self, entity, attributes, old, new, kwargs ):
-    self.log( "Alarm on weekends switched to {}".format( new ) )
-    self.weekends_enabled = new == "on"
- 
+  def light_changed( self, entity, attribute, old, new, kwargs ):
+    if new: self.states[ entity ] = new
+    else:   self.states.pop( entity, None )
+
+    # A light the fade did not put there has been taken over;  leave it be
+    for alarm in self.alarms.values():
+      if not alarm.running or not alarm.diverged( entity, new, old ): continue
+      alarm.released.add( entity )
+      alarm.stats.released = alarm.stats.released + 1
+      self.log( "[{}] {} changed outside the fade, leaving it alone".format( alarm.name, entity ) )
+      if alarm.released.issuperset( alarm.lights ): self.stop_fade( alarm, "every light taken over" )
+
   #########################################################
-  def set_alarm( self ):
-    self.kill_alarm()
-    alarm_time   = ( self.alarm_time - self.pre_trip ).time()
-    self.alarm_h = self.run_daily( self.sequence_lights, alarm_time )
+  def new_wknd( self, entity, attributes, old, new, kwargs ):
+    alarm = self.alarms[ kwargs[ "alarm" ] ]
+    self.log( "[{}] Alarm on weekends switched to {}".format( alarm.name, new ) )
+    alarm.weekends = new == "on"
 
-  def kill_alarm( self ):
-    if( self.alarm_h ): 
-      self.cancel_timer( self.alarm_h )
-      self.alarm_h = False
-    
+  #########################################################
+  def set_alarm( self, alarm ):
+    # Replaces the alarm's trip in the schedule
+    self.schedule.push( alarm.trip_time( self.datetime() ), ( alarm.name, "trip" ), alarm )
+    self.arm()
+
+  def kill_alarm( self, alarm ):
+    self.schedule.cancel( ( alarm.name, "trip" ) )
+
+  def stop_fade( self, alarm, reason, hold = False ):
+    # Drops the fade's next step;  with hold, lights still ramping are stopped where they are
+    self.schedule.cancel( ( alarm.name, "fade" ) )
+    if not alarm.running: return
+    alarm.running = False
+    now           = self.datetime()
+
+    if hold:
+      targets = {}
+      for light, ( sent, low, high, transition ) in alarm.ramps.items():
+        if light not in alarm.released and now < sent + timedelta( seconds = transition ):
+          targets[ light ] = ( int( round( alarm.level_now( light, now ) ) ), 0 )
+      for level, transition, lights in sunrise_fade.group_targets( targets ):
+        self.call_service( "light/turn_on", entity_id = lights[0] if len( lights ) == 1 else lights, brightness = level )
+    self.log( "[{}] Fade stopped, {}".format( alarm.name, reason ) )
+    self.fade_done( alarm, "stopped: " + reason, now )
+
+  def fade_done( self, alarm, outcome, end ):
+    # end : when the fade stopped changing the lights
+    stats          = alarm.stats
+    stats.outcome  = outcome
+    stats.duration = ( end - stats.started ).total_seconds()
+    if outcome == "done": stats.drift = ( end - alarm.fade_end ).total_seconds()
+    alarm.history.append( stats.as_dict() )
+    self.publish_fade( alarm )
+
+  def publish_fade( self, alarm ):
+    if not alarm.sensor: return
+    stats = alarm.stats.as_dict()
+    if alarm.running:                 state = "running"
+    elif stats[ "drift_s" ] is None:  state = "stopped"          # no finish to measure
+    else:                             state = stats[ "drift_s" ]
+    self.set_state( alarm.sensor, state = state, attributes = dict( stats, unit_of_measurement = "s", alarm = alarm.name,
+                                                                    history = list( alarm.history ) ) )
+
+  def arm( self ):
+    # Points the timer at the earliest entry, unless it already fires at or before it.  A timer left early by a
+    # cancelled entry just wakes up, finds nothing due and re-arms
+    due = self.schedule.next_due()
+    if due is None or ( self.timer_due is not None and self.timer_due <= due ): return
+    if self.timer: self.cancel_timer( self.timer )
+    self.timer_due = due
+    self.timer     = self.run_in( self.wake, max( 0, ( due - self.datetime() ).total_seconds() ) )
+
+  def wake( self, kwargs ):
+    self.timer     = None
+    self.timer_due = None
+    self.wakeups   = self.wakeups + 1
+
+    now = self.datetime()
+    for due, ( name, kind ), alarm in self.schedule.pop_due( now ):
+      try:
+        if kind == "trip":
+          self.schedule.push( alarm.trip_time( now ), ( name, "trip" ), alarm )
+          self.sequence_lights( alarm, due )
+        else:
+          self.set_lights( alarm )
+      except Exception as err:
+        self.error( "[{}] {} failed: {}".format( name, kind, err ), level="WARNING" )
+    self.arm()
 
 
   #########################################################
-  def validate_param( self, param, param_type = "" , required = False ):
+  def known_entity( self, entity ):
+    # Checked against the snapshot for the domains it holds
+    if entity.split( "." )[0] in SNAPSHOT_DOMAINS: return entity in self.states
+    return self.entity_exists( entity )
+
+  def state_of( self, entity ):
+    entry = self.states.get( entity )
+    if entry is None: return self.get_state( entity )
+    return entry[ "state" ]
+
+  def validate_param( self, param, param_type = "" , required = False, args = None ):
 
     err_level = "CRITICAL" if required else "WARNING"
+    args      = self.args if args is None else args
 
-    if param not in self.args:
+    if param not in args:
       self.error("{} was not found in config".format( param ), level=err_level)
       return False
-   
-    val = self.args[param]
-    
+
+    val = args[param]
+
     if type( val ) is str:
-      if not self.entity_exists( val ):
-        self.error("{} is an invalid entity for {}".format( self.args[param], param ), level=err_level )
+      if not self.known_entity( val ):
+        self.error("{} is an invalid entity for {}".format( args[param], param ), level=err_level )
         return False
-      if param_type not in self.args[param]:
-        self.error("{} is not a {} and cannot be used".format( self.args[param]. param_type ), level=err_level )
+      if param_type not in args[param]:
+        self.error("{} is not a {} and cannot be used".format( args[param], param_type ), level=err_level )
         return False
-      return True 
+      return True
 
     if type( val ) is list:
       valid_props = {}
 
       for entity in val:
         #Check if the entity exists
-        valid_props[ entity ] = self.entity_exists(entity)
+        valid_props[ entity ] = self.known_entity(entity)
         if not valid_props[ entity ] : self.error( "{} entity does not exist".format( entity ), level=err_level )
 
         #Compare the name against the param_type
@@ -167,86 +458,106 @@ class SunriseAlarm( hass.Hass ):
           if param_type not in entity:
             self.error("{} is not a {} and cannot be used".format( entity, param_type ), level="WARNING" )
             valid_props[ entity ] = False
-             
+
       return valid_props
 
     return False
 
 
- 
+
   ##########################################################
-  def sequence_lights( self, kwargs ) : 
+  def sequence_lights( self, alarm, start ) :
+    # start : the planned trip time;  the whole fade is timed from it
 
-    ## Check to see if it's a weekend and needs to be ignored
-    is_weekend = self.date().weekday() >=5     # weekdays are 0:4
-    if is_weekend and not self.weekends_enabled: return
+    ## Check to see if it's a day the alarm is off;  the fade can start the day before the alarm goes off
+    if not alarm.rings_on( ( start + alarm.pre_trip ).date() ): return
 
-    self.log( "Alarm trip ... starting sequence" )
+    self.log( "[{}] Alarm trip ... starting sequence".format( alarm.name ) )
 
     #If the light is already up, abort
     min_level = 0
-    self.current_level = {}
-
-    for light in self.active_lights:
-      level = self.get_state( light, attribute='brightness' )
+    alarm.current_level = {}
+    smooth              = {}
+    starts              = {}
+
+    for light in alarm.lights:
+      attributes = self.states.get( light ) or {}
+      attributes = attributes.get( "attributes", {} )
+      level      = attributes.get( "brightness" )
       if not level: level = 0
-      self.current_level[ light ] = level     #cache the current level for dim calc
+      alarm.current_level[ light ] = level     #cache the current level for dim calc
+      starts[ light ]              = level
+      smooth[ light ]              = sunrise_fade.supports_transition( attributes )
 
       if level > (255/2):
-        self.log( "Room already lit to {}... aborting".format( level ) )
-        return  
-      
+        self.log( "[{}] Room already lit to {}... aborting".format( alarm.name, level ) )
+        return
+
       #Brightest light in the room...used to set starting point
-      if level > min_level: 
-        min_level = level 
-
-    #Level the lights if so required
-    if self.mode is dim_mode.scale and len( self.active_lights ) > 1:
-      for light in self.active_lights:
-        self.current_level[ light ] = min_level
-        self.call_service( "light/turn_on", entity_id = light, brightness = min_level )
-        
-    
-    #Compute the lighting stages
-    self.time_delta = 1   # 1 minute time delta between steps    
-    self.light_delta = {}
-    self.stages      = (self.pre_trip.seconds / 60) / self.time_delta
-
-    for light in self.active_lights:
-      starting_level            = self.current_level[ light ]
-      ending_level              = 255
-      self.light_delta[ light ] = ( ending_level - starting_level ) / self.stages
+      if level > min_level:
+        min_level = level
 
-    #Run the first adjustment and schedule the next one
-    self.current_stage = 1
-    self.set_lights( None )
+    #Level the lights if so required.  The first segment fades each light from where it is, so no separate call is needed
+    if self.mode is dim_mode.scale and len( alarm.lights ) > 1:
+      for light in alarm.lights:
+        alarm.current_level[ light ] = min_level
 
-  ##########################################################################
-  def set_lights( self, kwargs ):
+    #Plan the fade segments
+    alarm.stages = sunrise_fade.plan_fade( alarm.current_level, alarm.pre_trip.total_seconds(), smooth, max_transition = alarm.max_transition )
+    if alarm.log_steps: self.log( "[{}] Fading {} lights in {} steps".format( alarm.name, len( alarm.lights ), len( alarm.stages ) ) )
 
-    #abort signal
-    if self.should_interrupt:
-      self.log("Interrupt signal received.  Aborting")
-      self.should_interrupt = False
-      return
+    #Run the first adjustment and schedule the next one
+    alarm.current_stage = 0
+    alarm.stats         = FadeStats( self.datetime() )
+    alarm.fade_start    = start
+    alarm.fade_end      = start + alarm.pre_trip
+    alarm.finish        = start
+    alarm.running       = True
+    alarm.released      = set()
+    alarm.ramps         = { light : ( start, level, level, 0 ) for light, level in starts.items() }
+    self.publish_fade( alarm )
+    self.set_lights( alarm )
 
-    #set the lights
-    for light in self.active_lights:
-      new_level = self.current_level[ light ] + self.light_delta[ light ]
-      self.log( "Adjusting {} to {}".format( light, new_level ) )
-      self.call_service( "light/turn_on", entity_id = light, brightness = new_level )
-      self.current_level[ light ] = new_level      
-
-    self.current_stage = self.current_stage + 1
-   
-    #schedule the next update
-    if self.current_stage <= self.stages:
-      self.light_thread = self.run_in( self.set_lights, self.time_delta*60 ) 
+  ##########################################################################
+  def set_lights( self, alarm ):
+
+    if not alarm.running: return
+
+    #catch up with the plan:  a late step takes every later step already due with it
+    now     = self.datetime()
+    elapsed = ( now - alarm.fade_start ).total_seconds()
+    stage   = alarm.current_stage
+    targets, alarm.current_stage = sunrise_fade.catch_up( alarm.stages, stage, elapsed )
+    targets = { light : target for light, target in targets.items() if light not in alarm.released }
+    lateness = elapsed - alarm.stages[ stage ][0]
+
+    #set the lights, one call per group of lights sharing a level and transition
+    groups  = sunrise_fade.group_targets( targets )
+    seconds = []
+    for new_level, transition, lights in groups:
+      if alarm.log_steps: self.log( "Adjusting {} to {} over {}s".format( ", ".join( lights ), new_level, transition ) )
+      for light in lights:                   # before the call, so the state change it causes is recognised as the fade's
+        alarm.ramps[ light ]         = ( now, alarm.level_now( light, now ), new_level, transition )
+        alarm.current_level[ light ] = new_level
+      entity_id = lights[0] if len( lights ) == 1 else lights
+      mark      = time.perf_counter()
+      if transition: self.call_service( "light/turn_on", entity_id = entity_id, brightness = new_level, transition = transition )
+      else:          self.call_service( "light/turn_on", entity_id = entity_id, brightness = new_level )
+      seconds.append( time.perf_counter() - mark )
+      alarm.finish = max( alarm.finish, now + timedelta( seconds = transition ) )
+
+    alarm.stats.step( lateness, alarm.current_stage - stage - 1, seconds )
+    if alarm.log_steps:
+      self.log( "[{}] Step {} of {}: {} lights in {} calls, {:.1f}s late".format( alarm.name, alarm.current_stage, len( alarm.stages ),
+                len( targets ), len( groups ), lateness ) )
+
+    #schedule the next update at its planned time
+    if alarm.current_stage < len( alarm.stages ):
+      due = alarm.fade_start + timedelta( seconds = alarm.stages[ alarm.current_stage ][0] )
+      self.schedule.push( due, ( alarm.name, "fade" ), alarm )
     else:
-      self.log("All done")
-
-
-
-
-
-
+      alarm.running = False
+      self.fade_done( alarm, "done", alarm.finish )
+      stats = alarm.stats
+      self.log("[{}] All done, {} steps, {} service calls ( {:.0f}ms mean ), {} steps merged, worst lateness {:.1f}s, finished {:+.1f}s from the alarm time".format(
+               alarm.name, stats.steps, stats.calls, stats.call_total / ( stats.calls or 1 ) * 1000, stats.merged, stats.late_max, stats.drift ) )
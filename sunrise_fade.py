@@ -0,0 +1,119 @@
+##################################################
+# Sunrise fade planning
+#
+# Plans a fade from each light's current brightness up to full as a few long segments which the bulbs run themselves with
+# light/turn_on's `transition`, rather than a brightness change every minute.
+#
+# The fade follows a perceptual curve:  perceived brightness goes roughly as level ** ( 1 / GAMMA ), so the fade is
+# linear in that space and the level rises slowly at first and quickly at the end, as a real sunrise appears to.  A bulb
+# ramps linearly between the levels it is given, so each segment is made as long as it can be while that straight ramp
+# stays within TOLERANCE of the curve ( short at the dark end, long at the bright end ) and no longer than the longest
+# transition the lights are trusted with.  Lights that cannot transition are stepped every STEP_TIME seconds instead.
+#
+#   steps = plan_fade( { "light.lamp" : 0, "light.strip" : 0 }, 1800, { "light.lamp" : True, "light.strip" : False } )
+#   for offset, targets in steps:             # seconds from the start of the fade, { light : ( level, transition ) }
+#     for level, transition, lights in group_targets( targets ):
+#       ...                                     # one light/turn_on for all of `lights`
+#
+# Lights that start from the same level and share a capability get the same plan, so most steps collapse to one service
+# call per group.
+#
+# The offsets are meant to be run against the wall clock from the planned start of the fade.  When a step runs late,
+# catch_up() merges in every later step that is also due and shortens the transitions so each light still lands on the
+# level the plan has for it at the planned time.
+##################################################
+
+FULL               = 255
+GAMMA              = 2.2
+TOLERANCE          = 0.02                # largest error of a segment against the curve, as a fraction of full perceived brightness
+MAX_TRANSITION     = 600                 # seconds, longest transition handed to a light
+MIN_SEGMENT        = 5                   # seconds, shortest segment planned for a light that can transition
+MERGE_SLACK        = 1                   # seconds, steps due this soon are sent with the one being run
+STEP_TIME          = 60                  # seconds between steps for lights that cannot transition
+SUPPORT_TRANSITION = 32                  # light supported_features bit
+
+
+def perceived( level ):
+  return ( min( max( level, 0 ), FULL ) / float( FULL ) ) ** ( 1.0 / GAMMA )
+
+def level_at( start, end, fraction ):
+  # Brightness level a fraction of the way through the fade
+  p0, p1 = perceived( start ), perceived( end )
+  return FULL * ( p0 + ( p1 - p0 ) * fraction ) ** GAMMA
+
+def chord_error( start, end, a, b, samples = 8 ):
+  # Largest perceived difference between the curve and a linear ramp between its levels at fractions a and b
+  la, lb = level_at( start, end, a ), level_at( start, end, b )
+  worst  = 0.0
+  for i in range( 1, samples ):
+    f     = i / float( samples )
+    worst = max( worst, abs( perceived( la + ( lb - la ) * f ) - perceived( level_at( start, end, a + ( b - a ) * f ) ) ) )
+  return worst
+
+def segment_ends( start, end, duration, max_transition = MAX_TRANSITION ):
+  # Fractions of the fade at which each segment ends, the last one being 1.0
+  longest  = min( 1.0, max_transition / float( duration ) ) if max_transition else 1.0
+  shortest = min( longest, MIN_SEGMENT / float( duration ) )
+  ends, a  = [], 0.0
+  while a < 1.0:
+    b = min( 1.0, a + longest )
+    if chord_error( start, end, a, b ) > TOLERANCE:
+      lo, hi = min( b, a + shortest ), b
+      for i in range( 20 ):
+        mid = ( lo + hi ) / 2
+        if chord_error( start, end, a, mid ) > TOLERANCE: hi = mid
+        else:                                             lo = mid
+      b = lo
+    ends.append( b )
+    a = b
+  return ends
+
+def step_ends( start, end, duration ):
+  # Evenly spaced steps, no more of them than there are brightness levels to climb
+  count = max( 1, min( int( round( duration / float( STEP_TIME ) ) ), int( end - start ) ) )
+  return [ ( i + 1 ) / float( count ) for i in range( count ) ]
+
+def plan_fade( starts, duration, caps = None, end = FULL, max_transition = MAX_TRANSITION ):
+  # starts : light -> starting brightness,  caps : light -> True when the light can transition [ default = all can ]
+  # Returns [ ( offset, { light : ( level, transition ) } ) ] in offset order;  transition is 0 for a stepped light
+  caps    = caps or {}
+  curves  = {}
+  steps   = {}
+  for light, start in starts.items():
+    smooth = caps.get( light, True )
+    key    = ( start, smooth )
+    if key not in curves:
+      curves[ key ] = segment_ends( start, end, duration, max_transition ) if smooth else step_ends( start, end, duration )
+
+    a, last = 0.0, start
+    for b in curves[ key ]:
+      level = int( round( level_at( start, end, b ) ) )
+      if level <= last: continue                                      # no visible change yet, fold it into the next step
+      if smooth: steps.setdefault( round( a * duration, 1 ), {} )[ light ] = ( level, round( ( b - a ) * duration, 1 ) )
+      else:      steps.setdefault( round( b * duration, 1 ), {} )[ light ] = ( level, 0 )
+      a, last = b, level
+
+  return sorted( steps.items() )
+
+def catch_up( steps, index, elapsed ):
+  # Runs step `index` of a fade `elapsed` seconds after its planned start, merged with every later step due by then.
+  # Returns ( { light : ( level, transition ) }, index of the next step )
+  targets = {}
+  while index < len( steps ) and ( not targets or steps[ index ][0] <= elapsed + MERGE_SLACK ):
+    offset, step = steps[ index ]
+    for light, ( level, transition ) in step.items():
+      if transition: transition = round( max( 0, offset + transition - elapsed ), 1 )     # end where the plan ends the segment
+      targets[ light ] = ( level, transition )
+    index += 1
+  return targets, index
+
+def group_targets( targets ):
+  # { light : ( level, transition ) } -> [ ( level, transition, [ lights ] ) ], one entry per service call needed
+  groups = {}
+  for light, target in targets.items():
+    groups.setdefault( target, [] ).append( light )
+  return [ ( level, transition, sorted( lights ) ) for ( level, transition ), lights in sorted( groups.items() ) ]
+
+def supports_transition( attributes ):
+  # attributes : the light's state attributes
+  return bool( int( attributes.get( "supported_features" ) or 0 ) & SUPPORT_TRANSITION )
@@ -0,0 +1,55 @@
+import heapq
+import itertools
+
+##################################################
+# Shared alarm schedule
+#
+# A min-heap of ( due, key ) entries for everything one app has to do at a given time, so a single AppDaemon timer set
+# for the earliest entry can drive any number of alarms.  Each key has at most one live entry:  pushing a key again
+# replaces its entry and cancel() drops it.  Replaced and cancelled entries are left in the heap and skipped when they
+# reach the top, so every change is a single O( log n ) push.
+#
+#   schedule.push( due, ( "bedroom", "trip" ), alarm )
+#   schedule.next_due()                       # earliest live due time, None when empty
+#   schedule.pop_due( now )                   # [ ( due, key, data ) ] of every live entry due by now, in due order
+##################################################
+
+class Schedule( object ):
+
+  def __init__( self ):
+    self.heap  = []                                           # ( due, sequence, key, data )
+    self.live  = {}                                           # key -> sequence of its current entry
+    self.count = itertools.count()
+
+  def __len__( self ):
+    return len( self.live )
+
+  def push( self, due, key, data = None ):
+    seq = next( self.count )
+    self.live[ key ] = seq
+    heapq.heappush( self.heap, ( due, seq, key, data ) )
+    if len( self.heap ) > 2 * len( self.live ) + 16: self.compact()
+
+  def cancel( self, key ):
+    self.live.pop( key, None )
+
+  def scheduled( self, key ):
+    return key in self.live
+
+  def next_due( self ):
+    while self.heap and self.live.get( self.heap[0][2] ) != self.heap[0][1]:
+      heapq.heappop( self.heap )
+    return self.heap[0][0] if self.heap else None
+
+  def pop_due( self, now ):
+    due = []
+    while self.next_due() is not None and self.heap[0][0] <= now:
+      when, seq, key, data = heapq.heappop( self.heap )
+      del self.live[ key ]
+      due.append( ( when, key, data ) )
+    return due
+
+  def compact( self ):
+    # Drops the replaced and cancelled entries once they outnumber the live ones
+    self.heap = [ entry for entry in self.heap if self.live.get( entry[2] ) == entry[1] ]
+    heapq.heapify( self.heap )